@@ -0,0 +1,80 @@
+"""
+Measures how many bytes of a shapefile's .shp, .shx and .dbf files are read
+when drawing a classified map of all of it, compared to drawing the same map without
+a classification, both with and without numpyspeed.
+
+Usage: python benchmark_classify.py shapefilepath fieldname [classifytype, default natural breaks]
+
+Classifying a layer first collects the values of all the features in view and
+then renders them with their class symbols. The values only come from the .dbf
+file, so the .shp file should be read about as many times as for the map
+without a classification, ie once.
+
+The files are opened through wrappers that count the bytes read from them.
+The wrappers cannot be memory-mapped, so with numpyspeed each mapped file is
+read in full once instead, which still shows how many times it is gone through.
+"""
+
+import sys, os, time, tempfile, collections
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geovis
+
+class CountingFile:
+    "a file opened for reading that adds up how many bytes are read from it"
+    def __init__(self, filepath, mode="rb", counts=None):
+        self.file = open(filepath, mode)
+        self.extension = os.path.splitext(filepath)[1].lower()
+        self.counts = counts
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.counts[self.extension] += len(data)
+        return data
+    def seek(self, *args):
+        return self.file.seek(*args)
+    def tell(self):
+        return self.file.tell()
+    def close(self):
+        return self.file.close()
+
+def CountBytesRead(shapefilepath, fieldname, classifytype):
+    "draws the map, classified on the field if given, and returns the number of bytes read from each file, and the time it took"
+    counts = collections.defaultdict(int)
+    geovis.pyshp.open = lambda filepath, mode="rb": CountingFile(filepath, mode, counts)
+    filehandle, savepath = tempfile.mkstemp(suffix=".png")
+    os.close(filehandle)
+    try:
+        starttime = time.time()
+        newmap = geovis.NewMap()
+        layer = geovis.Layer(shapefilepath)
+        if fieldname:
+            layer.AddClassification("fillcolor", fieldname, symbolrange=[geovis.Color("white"), geovis.Color("red")], classifytype=classifytype, nrclasses=5)
+        newmap.AddToMap(layer)
+        newmap.SaveMap(savepath)
+        drawtime = time.time() - starttime
+    finally:
+        del geovis.pyshp.open
+        os.remove(savepath)
+    return counts, drawtime
+
+if __name__ == "__main__":
+    shapefilepath = sys.argv[1]
+    fieldname = sys.argv[2]
+    classifytype = sys.argv[3] if len(sys.argv) > 3 else "natural breaks"
+    geovis.SHOWPROGRESS = False
+    geovis.SetMapDimensions(1000, 500)
+    #zoom out just far enough that the whole shapefile is drawn, keeping the width/height ratio of the projection
+    xmin, ymin, xmax, ymax = geovis.pyshp.Reader(shapefilepath).bbox
+    halfwidth = max(xmax-xmin, (ymax-ymin)*geovis.PROJ_XYRATIO) / 2.0 * 1.01
+    halfheight = halfwidth / geovis.PROJ_XYRATIO
+    midx, midy = (xmin+xmax)/2.0, (ymin+ymax)/2.0
+    geovis.SetMapZoom([midx-halfwidth, midx+halfwidth], [midy-halfheight, midy+halfheight])
+    filesizes = dict((extension, os.path.getsize(os.path.splitext(shapefilepath)[0] + extension)) for extension in (".shp",".shx",".dbf"))
+    print("%s: %s" % (os.path.basename(shapefilepath), ", ".join("%s %i bytes" % (extension, filesizes[extension]) for extension in sorted(filesizes))))
+    for numpyspeed in (True, False):
+        if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+            continue
+        geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+        for label, classifyfield in (("unclassified", None), ("classified", fieldname)):
+            counts, drawtime = CountBytesRead(shapefilepath, classifyfield, classifytype)
+            passes = ", ".join("%s %i bytes (%.2f passes)" % (extension, counts[extension], counts[extension] / float(filesizes[extension])) for extension in sorted(filesizes))
+            print("numpyspeed %s, %s: %s, drawn in %.3fs" % (numpyspeed, label, passes, drawtime))
@@ -0,0 +1,56 @@
+"""
+Measures how long a cold "import geovis" takes, each time in a fresh Python
+process, and fails if the median import time is over the given budget or if
+importing geovis already imported any of the heavy modules that should only be
+imported once they are used (numpy, the renderers, tkinter, colour etc).
+
+Usage: python benchmark_import.py [budget in seconds, default 1.0] [number of runs, default 10]
+
+The import is run without a screen (DISPLAY is removed), so it also checks that
+geovis can be imported on a headless server. Short-lived scripts that
+only read a shapefile pay this cost every time they start.
+"""
+
+import sys, os, subprocess
+
+#modules that should not be imported by just importing geovis
+HEAVYMODULES = ["numpy", "PIL", "aggdraw", "cairo", "pydraw", "Tkinter", "geovis.colour", "multiprocessing", "threading", "Queue"]
+REPOFOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#the code run in each fresh process, printing the import time and which of the heavy modules were imported
+IMPORTCODE = """
+import sys, time
+sys.path.insert(0, %r)
+beforeimport = set(sys.modules)
+starttime = time.time()
+import geovis
+importtime = time.time() - starttime
+imported = [name for name in %r if name in sys.modules and name not in beforeimport]
+print("%%f %%s" %% (importtime, ",".join(imported)))
+""" % (REPOFOLDER, HEAVYMODULES)
+
+def TimeImport():
+    env = dict(os.environ)
+    env.pop("DISPLAY", None)
+    env.pop("GEOVIS_MAPSIZE", None)
+    output = subprocess.check_output([sys.executable, "-c", IMPORTCODE], env=env)
+    importtime, _, imported = output.strip().splitlines()[-1].partition(" ")
+    return float(importtime), [name for name in imported.split(",") if name]
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    #the first run warms up the disk cache and compiles the .pyc files, so it is not counted
+    TimeImport()
+    results = [TimeImport() for _ in xrange(runs)]
+    times = sorted(importtime for importtime,imported in results)
+    median = times[len(times)//2]
+    print("import geovis, %i runs: min %.3fs, median %.3fs, max %.3fs (budget %.3fs)" % (runs, times[0], median, times[-1], budget))
+    failed = False
+    imported = sorted(set(name for importtime,names in results for name in names))
+    if imported:
+        print("FAILED: importing geovis also imported %s" % ", ".join(imported))
+        failed = True
+    if median > budget:
+        print("FAILED: the median import time is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,71 @@
+"""
+Measures how many features of a shapefile are read and prepared when drawing
+a map that is zoomed in on part of it, and how long that takes, both with and
+without numpyspeed.
+
+Usage: python benchmark_view.py shapefilepath xmin ymin xmax ymax [renderer, default PIL]
+
+For comparison it also counts how many features the old visibility test let
+through, which wrongly accepted any feature that overlapped the view either
+horizontally or vertically, so that zoomed in maps still prepared and drew
+nearly every feature of the shapefile.
+"""
+
+import sys, os, time, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geovis
+
+def CountPrepared(shapefilepath, zoom, renderer):
+    "draws the zoomed in map and returns the number of features that were prepared for drawing, and the time it took"
+    x2x, y2y = zoom
+    geovis.SetMapZoom(x2x, y2y)
+    counter = [0]
+    prepshape = geovis.Shapefile._PrepShape
+    def CountingPrepShape(self, *args, **kwargs):
+        counter[0] += 1
+        return prepshape(self, *args, **kwargs)
+    geovis.Shapefile._PrepShape = CountingPrepShape
+    filehandle, savepath = tempfile.mkstemp(suffix=".png")
+    os.close(filehandle)
+    try:
+        starttime = time.time()
+        newmap = geovis.NewMap(renderer=renderer)
+        newmap.AddToMap(geovis.Layer(shapefilepath))
+        newmap.SaveMap(savepath)
+        drawtime = time.time() - starttime
+    finally:
+        geovis.Shapefile._PrepShape = prepshape
+        os.remove(savepath)
+    return counter[0], drawtime
+
+def CountOldTest(shapefilepath, zoom):
+    "the number of features that the old either-horizontally-or-vertically test accepted"
+    x2x, y2y = zoom
+    count = 0
+    for shape in geovis.pyshp.Reader(shapefilepath).iterShapes():
+        if shape.shapeType == geovis.NULL:
+            continue
+        if hasattr(shape, "bbox"):
+            xmin,ymin,xmax,ymax = shape.bbox
+        else:
+            xmin,ymin = xmax,ymax = shape.points[0]
+        if (xmin < x2x[1] and xmax > x2x[0]) or (ymin < y2y[1] and ymax > y2y[0]):
+            count += 1
+    return count
+
+if __name__ == "__main__":
+    shapefilepath = sys.argv[1]
+    xmin, ymin, xmax, ymax = [float(value) for value in sys.argv[2:6]]
+    renderer = sys.argv[6] if len(sys.argv) > 6 else "PIL"
+    geovis.SHOWPROGRESS = False
+    geovis.SetMapDimensions(1000, 500)
+    zoom = ([xmin,xmax], [ymin,ymax])
+    total = len(geovis.pyshp.Reader(shapefilepath))
+    print("%s: %i features, zoomed in on %s" % (os.path.basename(shapefilepath), total, zoom))
+    print("old visibility test would prepare %i features" % CountOldTest(shapefilepath, zoom))
+    for numpyspeed in (True, False):
+        if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+            continue
+        geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+        prepared, drawtime = CountPrepared(shapefilepath, zoom, renderer)
+        print("numpyspeed %s: prepared %i features, drawn in %.3fs" % (numpyspeed, prepared, drawtime))
@@ -42,6 +42,7 @@ Python Geographic Visualizer (GeoVis)
     - [.DrawRectangle](#drawrectangle)
     - [.SaveMap](#savemap)
     - [.ViewMap](#viewmap)
+  - [geovis.RenderBatch](#geovisrenderbatch)
   - [geovis.SaveShapefileImage](#geovissaveshapefileimage)
   - [geovis.SetMapBackground](#geovissetmapbackground)
   - [geovis.SetMapDimensions](#geovissetmapdimensions)
@@ -136,6 +137,13 @@ offering the "customoptions" argument option).
 | fillcolor | the hex color of the fill
 | outlinewidth | the width of the outline if any, given as proportion of the fillsize. A float between 0 and 1
 | outlinecolor | the hex color of the outline
+| simplify | how many pixels the drawn lines and polygon outlines may stray from their real shape, leaving out the points that hardly change how they look. Greatly speeds up drawing very detailed layers on a small map, eg a tolerance of 0.5 is hardly visible. Requires numpy. Default is no simplification, unless the reducevectors rendering option is set, see SetRenderingOptions
+| simplifymethod | the algorithm used to simplify, either "douglas-peucker" (default), which keeps the points furthest from the simplified line, or "visvalingam", which leaves out the points that make up the smallest areas and tends to give smoother outlines
+| cullsize | the size in pixels below which lines and polygons are too small to be seen and are not drawn as they are, judging by their bounding box before any of their coordinates are read. Greatly speeds up drawing layers with very many small features on a map of the whole world, eg a cullsize of 1 leaves out everything smaller than a pixel. Default is to draw everything
+| cullmode | what to do with the lines and polygons smaller than the cullsize, either "skip" (default) to leave them out, or "pixel" to draw each as a single pixel at its center, so that clusters of small features still show up. Where several of them fall in the same pixel only the last one is drawn, since it would cover the others anyway
+| clip | whether to cut away the parts of lines and polygons that are outside the map before drawing them, so that zoomed in maps of large features only cost as much as the part that is seen. True by default, but only done by the PIL and aggdraw renderers when numpy is installed
+| renderorder | the order to draw the features in, since those drawn last end up on top. Either the name of an attribute field, to draw the features from the lowest to the highest value, or the name of a classified size symbol type, eg "fillsize", to draw the features from the biggest to the smallest symbol so that big symbols don't hide the small ones. Each feature is read directly from where it is stored in the file, so this is nearly as fast as drawing them in the order they are stored, which is the default
+| renderdescending | True to draw the features in the reverse of the renderorder. False by default
 
 ### Text Options
 
@@ -182,15 +190,14 @@ They are:
 
 # IMPORTS
 #builtins
-import sys, os, itertools, array, random, math, datetime, platform, operator
-import threading, Queue, multiprocessing
-import Tkinter as tk
-import tkFileDialog, tkColorChooser
+import sys, os, itertools, array, random, math, datetime, platform, operator, copy, bisect
 #customized
-import messages, listy, guihelper
+import messages, listy, guihelper, querying, spatialindex, geometrycache, simplification, clipping, classbreaks, lazyimport
 #third party modules
 import shapefile_fork as pyshp
-import colour
+#heavier modules are only imported once they are used, to keep importing geovis fast
+numpy = lazyimport.LazyModule("numpy", globals())
+colour = lazyimport.LazyModule("colour", globals())
 
 # GLOBAL VARS
 OSSYSTEM = platform.system().lower()
@@ -226,28 +233,20 @@ PYSHPTYPE_AS_TEXT = {\
     MULTIPOINTM:"MultiPointM",
     MULTIPATCH:"MultiPatch"}
 #default rendering options
-try:
-    import numpy
-    NUMPYSPEED = True
-except:
-    NUMPYSPEED = False
+NUMPYSPEED = lazyimport.IsInstalled("numpy")
 REDUCEVECTORS = False
 SHOWPROGRESS = True
+GEOMETRYCACHE = None
+PROCESSES = 1
 #some map stuff
 MAPBACKGROUND = None
-try:
-    import aggdraw
-    RENDERER = "aggdraw"
-except:
-    try:
-        import PIL
-        RENDERER = "PIL"
-    except:
-        try:
-            import cairo
-            RENDERER = "pycairo"
-        except:
-            RENDERER = "tkinter"
+#the renderer is only picked and imported when the first map is made, unless set by the user (see _ImportRenderer)
+RENDERER = None
+RENDERERMODULES = dict([("aggdraw","aggdraw"),
+                        ("PIL","PIL"),
+                        ("pydraw","pydraw"),
+                        ("pycairo","cairo"),
+                        ("tkinter","Tkinter")])
 #setup coordinate system (this can be done by user too, see SetMapZoom function towards the bottom)
 PROJ_XYRATIO = 2.0
 XMIN,XMAX = (-180,180)
@@ -259,30 +258,78 @@ XWIDTH = x2x[1]-x2x[0]
 YHEIGHT = y2y[1]-y2y[0]
 XOFFSET = nw[0]
 YOFFSET = nw[1]
-#set mapdims to window size
-mapdimstest = tk.Tk()
-width = int(mapdimstest.winfo_screenwidth())
-height = int(mapdimstest.winfo_screenheight())
-if width/float(height) < PROJ_XYRATIO:
-    #snap to world ratio in case screenratio is different
-    height = width/PROJ_XYRATIO
-MAPWIDTH = width
-MAPHEIGHT = height
-mapdimstest.destroy()
-del mapdimstest
-#update mapdims
-def _UpdateMapDims():
-    if NUMPYSPEED:
-        global ZOOMDIM, OFFSET, TRANSLATION, RENDERAREA, SCALING        
-        ZOOMDIM = numpy.array([XWIDTH,YHEIGHT])
-        OFFSET = numpy.array([0.0,0.0])*-1 #move x or y by normal +- coordinates (not compat with zoom yet
-        TRANSLATION = numpy.array([XOFFSET, -YOFFSET]) + OFFSET
-        RENDERAREA = numpy.array([MAPWIDTH, -MAPWIDTH/PROJ_XYRATIO])
-        SCALING = RENDERAREA / ZOOMDIM
-    else:
-        #?? evrything is done with set zoom...?
-        pass
-_UpdateMapDims()
+#set mapdims to a default size, which can be configured as "WIDTHxHEIGHT" with the GEOVIS_MAPSIZE environment variable
+#if not configured, the mapdims are changed to the screen size once the first map is made (see _MapDimsFromScreen)
+#that way no tkinter window is needed just to import geovis, eg on a server without a screen
+MAPSIZEFROMSCREEN = True
+MAPWIDTH,MAPHEIGHT = (1600,800)
+if os.environ.get("GEOVIS_MAPSIZE"):
+    MAPWIDTH,MAPHEIGHT = [int(dim) for dim in os.environ["GEOVIS_MAPSIZE"].lower().split("x")]
+    MAPSIZEFROMSCREEN = False
+#each map copies these settings into its own map context when it is made (see _MapContext)
+def _ZoomExtents(x2x, y2y):
+    "returns the xmin,xmax,ymin,ymax of the given zoom extents, widened to the width/height ratio of the projection, followed by the xwidth,yheight,xoffset,yoffset used for converting coordinates to pixels"
+    xmin,xmax = (x2x[0],x2x[1])
+    ymin,ymax = (y2y[0],y2y[1])
+    inxwidth = xmax-xmin
+    inyheight = ymax-ymin
+    #SUMTIN WEIRD, BOTH ZOOMS NEED TO BE TRUE AND MAYBE CHANGED, NOT JUST ONE, SO MAYBE ALWAYS TIMES UP AND NEVER DIVIDE DOWN
+    if inxwidth > inyheight*PROJ_XYRATIO:
+        #automatically override xlimits to be centered middle of given extents, but with a new width thats proportional to the projection widt/height ratio
+        midx = sum(x2x)/float(len(x2x))
+        halfxwidth = inyheight/PROJ_XYRATIO/2.0
+        xmin,xmax = (midx-halfxwidth, midx+halfxwidth)
+    elif inyheight*PROJ_XYRATIO > inxwidth:
+        #automatically override ylimits to be centered middle of given extents, but with a new height thats proportional to the projection widt/height ratio
+        midy = sum(y2y)/float(len(y2y))
+        halfyheight = inxwidth/PROJ_XYRATIO/2.0
+        ymin,ymax = (midy-halfyheight, midy+halfyheight)
+    nw = (-1*min(x2x),max(y2y))
+    #cant use old width/height from original input but instead recalculate using the updated X/YMAX/MIN bc they were changed to preserve a certain ratio
+    xwidth = xmax-xmin
+    yheight = ymax-ymin
+    return xmin,xmax,ymin,ymax,xwidth,yheight,nw[0],nw[1]
+def _BoxesInView(boxes, viewbox):
+    "returns a numpy mask of which of the xmin,ymin,xmax,ymax rows of boxes intersect the xmin,ymin,xmax,ymax view box, including those that only touch it"
+    viewxmin,viewymin,viewxmax,viewymax = viewbox
+    return (boxes[:,0] <= viewxmax) & (boxes[:,2] >= viewxmin) & (boxes[:,1] <= viewymax) & (boxes[:,3] >= viewymin)
+def _MapDimsFromScreen():
+    "sets the mapdims to the screen size the first time a map is made, unless the mapdims have been configured or set by the user, or if there is no screen"
+    global MAPSIZEFROMSCREEN, MAPWIDTH, MAPHEIGHT
+    if not MAPSIZEFROMSCREEN:
+        return
+    MAPSIZEFROMSCREEN = False
+    try:
+        _ImportTkinter()
+        mapdimstest = tk.Tk()
+    except Exception:
+        #no tkinter or no screen, so keep the default size
+        return
+    width = int(mapdimstest.winfo_screenwidth())
+    height = int(mapdimstest.winfo_screenheight())
+    mapdimstest.destroy()
+    if width/float(height) < PROJ_XYRATIO:
+        #snap to world ratio in case screenratio is different
+        height = width/PROJ_XYRATIO
+    MAPWIDTH = width
+    MAPHEIGHT = height
+def _ImportTkinter():
+    "tkinter is only imported once a window is actually needed"
+    global tk, tkFileDialog, tkColorChooser
+    import Tkinter as tk
+    import tkFileDialog, tkColorChooser
+def _ImportRenderer(renderer=None):
+    "imports the module of the given renderer, or if no renderer is given, picks the first renderer whose module can be imported in the order aggdraw, PIL, pycairo, or else tkinter"
+    if renderer:
+        __import__(RENDERERMODULES[renderer])
+        return renderer
+    for renderer in ("aggdraw","PIL","pycairo"):
+        try:
+            __import__(RENDERERMODULES[renderer])
+            return renderer
+        except ImportError:
+            pass
+    return "tkinter"
 #define colorstyles
 COLORSTYLES = dict([("strong", dict( [("intensity",1), ("brightness",0.5)]) ),
                     ("dark", dict( [("intensity",0.8), ("brightness",0.2)]) ),
@@ -294,49 +341,105 @@ COLORSTYLES = dict([("strong", dict( [("intensity",1), ("brightness",0.5)]) ),
 
 
 # INTERNAL CLASSES
+class _MapContext:
+    """
+The size, zoom extent, background and renderer of one map, and the conversion from coordinates to pixels that follows from them.
+Each map gets its own context when it is made, so that rendering never reads or changes the module-wide map settings, and several maps can be drawn at the same time, eg in different threads.
+Any setting that is not given is copied from the current map settings (see SetMapDimensions, SetMapZoom, SetMapBackground and SetRenderingOptions).
+"""
+    def __init__(self, width=None, height=None, x2x=None, y2y=None, background="not specified", renderer=None):
+        global RENDERER
+        if width is None or height is None:
+            _MapDimsFromScreen()
+        if renderer is None:
+            if RENDERER is None:
+                RENDERER = _ImportRenderer()
+            renderer = RENDERER
+        else:
+            _ImportRenderer(renderer)
+        self.renderer = renderer
+        self.width = MAPWIDTH if width is None else width
+        self.height = MAPHEIGHT if height is None else height
+        self.background = MAPBACKGROUND if background == "not specified" else background
+        self.projxyratio = PROJ_XYRATIO
+        if x2x is None and y2y is None:
+            zoom = (XMIN,XMAX,YMIN,YMAX,XWIDTH,YHEIGHT,XOFFSET,YOFFSET)
+        else:
+            zoom = _ZoomExtents(x2x or (XMIN,XMAX), y2y or (YMIN,YMAX))
+        self.xmin,self.xmax,self.ymin,self.ymax,self.xwidth,self.yheight,self.xoffset,self.yoffset = zoom
+        self._UpdateTransform()
+    def Extent(self):
+        "the zoom extent as xmin,ymin,xmax,ymax"
+        return (self.xmin, self.ymin, self.xmax, self.ymax)
+    def PixelSize(self):
+        "the width of one pixel of the map in coordinate units"
+        return self.xwidth / float(self.width)
+    def Scaled(self, factor):
+        "returns a copy of the context for drawing the same map at a multiple of its size"
+        scaled = copy.copy(self)
+        scaled.width = self.width*factor
+        scaled.height = self.height*factor
+        scaled._UpdateTransform()
+        return scaled
+    def _UpdateTransform(self):
+        if NUMPYSPEED:
+            zoomdim = numpy.array([self.xwidth,self.yheight])
+            self.translation = numpy.array([self.xoffset, -self.yoffset])
+            renderarea = numpy.array([self.width, -self.width/self.projxyratio])
+            self.scaling = renderarea / zoomdim
+
 class _PyShpShape:
-    def __init__(self, shapefile, fieldnames, uniqid, coords, shapetype, bbox=None):
+    #the pixel coordinates of each part, set when the shape is converted along with a whole batch of shapes
+    _pixelcoords = None
+    _pixelcontext = None
+    def __init__(self, shapefile, fieldnames, uniqid, coords, shapetype, bbox=None, rawrecord=None):
         """
 every shapetype is always multi (upon entry) so have to be looped through when retrieved.
 """
         self._shapefile = shapefile
         self.fieldnames = fieldnames
+        self._rawrecord = rawrecord
         self.id = uniqid
         self.coords = coords
         #print coords
-        if not bbox:
+        if bbox is None:
             #this is only needed for single points
             x,y = coords[0][0]
             bbox = [x,y,x,y]
         self.bbox = bbox
         self.type = shapetype
-    def to_tkinter(self):
-        convertedcoords = (self._MapCoords(eachmulti) for eachmulti in self.coords)
+    def to_tkinter(self, context, simplify=None, simplifymethod="douglas-peucker"):
+        convertedcoords = (self._MapCoords(eachmulti, context, simplify, simplifymethod) for eachmulti in self.coords)
         formattedcoords = convertedcoords
         return (eachmulti for eachmulti in formattedcoords)
-    def to_PIL(self):
-        convertedcoords = (self._MapCoords(eachmulti) for eachmulti in self.coords)
+    def to_PIL(self, context, simplify=None, simplifymethod="douglas-peucker", clipbox=None):
+        if self._pixelcontext is context:
+            #already converted along with its batch, and PIL reads the float32 views directly without copying them
+            return self._PixelCoords(simplify, simplifymethod, clipbox)
+        convertedcoords = (self._MapCoords(eachmulti, context, simplify, simplifymethod) for eachmulti in self.coords)
         formattedcoords = convertedcoords
         return (array.array("f",eachmulti) for eachmulti in formattedcoords)
-    def to_aggdraw(self):
-        convertedcoords = (self._MapCoords(eachmulti) for eachmulti in self.coords)
+    def to_aggdraw(self, context, simplify=None, simplifymethod="douglas-peucker", clipbox=None):
+        if self._pixelcontext is context:
+            #already converted along with its batch, and aggdraw takes the float32 views as they are
+            return self._PixelCoords(simplify, simplifymethod, clipbox)
+        convertedcoords = (self._MapCoords(eachmulti, context, simplify, simplifymethod) for eachmulti in self.coords)
         formattedcoords = convertedcoords
         return (array.array("f",eachmulti) for eachmulti in formattedcoords)
-    def to_pydraw(self):
-        convertedcoords = (self._MapCoords(eachmulti) for eachmulti in self.coords)
+    def to_pydraw(self, context, simplify=None, simplifymethod="douglas-peucker"):
+        convertedcoords = (self._MapCoords(eachmulti, context, simplify, simplifymethod) for eachmulti in self.coords)
         formattedcoords = (self.__pairwise(eachmulti) for eachmulti in convertedcoords)
         return (eachmulti for eachmulti in formattedcoords)
-    def to_pycairo(self):
-        convertedcoords = (self._MapCoords(eachmulti) for eachmulti in self.coords)
+    def to_pycairo(self, context, simplify=None, simplifymethod="douglas-peucker"):
+        convertedcoords = (self._MapCoords(eachmulti, context, simplify, simplifymethod) for eachmulti in self.coords)
         formattedcoords = (self.__pairwise(eachmulti) for eachmulti in convertedcoords)
         return (eachmulti for eachmulti in formattedcoords)
     def GetAttributes(self, fieldname=None):
         if fieldname:
-            rowdict = dict(zip(self.fieldnames, self._shapefile.record(self.id)))
-            fieldvalue = rowdict[fieldname]
+            fieldvalue = self._GetRow([fieldname])[0]
             return fieldvalue
         else:
-            entirerow = self._shapefile.record(self.id)
+            entirerow = self._GetRow(self.fieldnames)
             return entirerow
     def GetTime(self):
         shapetime = dict()
@@ -356,7 +459,7 @@ every shapetype is always multi (upon entry) so have to be looped through when r
             return datetime.datetime(**shapetime)
         except:
             print(shapetime)
-    def GetAvgCenter(self):
+    def GetAvgCenter(self, context):
         """
 so far only simple nonnumpy
 """
@@ -369,36 +472,58 @@ so far only simple nonnumpy
             avgx = (x1+x2)/2.0
             avgy = (y1+y2)/2.0
         avgcenter = [(avgx,avgy)]
-        avgcenter = self._MapCoords(avgcenter)
+        avgcenter = self._MapCoords(avgcenter, context)
         return avgcenter
-    def GetMultiCenters(self):
+    def GetMultiCenters(self, context):
         """
 so far only simple nonnumpy
 """
         for single in self.coords:
             xs = [xy[0] for xy in single]
             xmid = sum(xs)/float(len(xs))
-            xmid = self._MapCoords(xmid)
+            xmid = self._MapCoords(xmid, context)
             ys = [xy[1] for xy in single]
             ymid = sum(ys)/float(len(ys))
-            ymid = self._MapCoords(ymid)
+            ymid = self._MapCoords(ymid, context)
             yield (xmid,ymid)
     #internal use only
+    def _GetRow(self, fieldnames):
+        #decode the row that was read alongside the shape, or look it up if the shape was fetched on its own
+        if self._rawrecord is not None:
+            return self._shapefile.decodeRecord(self._rawrecord, fieldnames)
+        else:
+            return self._shapefile.record(self.id, fields=fieldnames)
     def __pairwise(self, coords, batchsize=2):
         """
 only used when sending coordinates to pycairo, bc can only draw as a path one xy point at a time
 """
         return [pair for pair in itertools.izip(*[iter(coords)] * batchsize)]
-    def _MapCoords(self, incoords):
+    def _PixelCoords(self, simplify=None, simplifymethod="douglas-peucker", clipbox=None):
+        """
+serves up the flat pixel coordinates of each part from the views into the batch buffer, only copying the parts that are clipped or simplified.
+parts are first clipped to the clipbox if given, which leaves out polygon rings outside it and may cut lines into several pieces.
+"""
+        for eachmulti in self._pixelcoords:
+            if clipbox is None:
+                pieces = [eachmulti]
+            elif self.type == "polygon":
+                pieces = [clipping.ClipPolygon(eachmulti, clipbox)]
+            else:
+                pieces = clipping.ClipLine(eachmulti, clipbox)
+            for piece in pieces:
+                if not len(piece):
+                    continue
+                if simplify:
+                    piece = simplification.Simplify(piece, simplify, simplifymethod)
+                yield piece.ravel()
+    def _MapCoords(self, incoords, context, simplify=None, simplifymethod="douglas-peucker"):
         """
-takes single set of coords, not multicoords
+takes single set of coords, not multicoords, and converts them to pixels of the given map context, optionally simplified so they stray no more than the simplify tolerance in pixels
 """
         if NUMPYSPEED:
-            converted = (incoords + TRANSLATION) * SCALING
-            #for smoother drawings comment out the rint and vstack commands below
-            if REDUCEVECTORS:
-                converted = numpy.rint(converted).astype(int)
-                converted = numpy.vstack((converted[0], converted[1:][numpy.any(converted[1:]!=converted[:-1], axis=1)]))
+            converted = (incoords + context.translation) * context.scaling
+            if simplify:
+                converted = simplification.Simplify(converted, simplify, simplifymethod)
             aslist = converted.flatten()
             return aslist
         else:
@@ -406,8 +531,8 @@ takes single set of coords, not multicoords
             previous = None
             for point in incoords:
                 inx, iny = point
-                newx = (XOFFSET+inx)/XWIDTH*MAPWIDTH
-                newy = MAPHEIGHT-(YOFFSET+iny)/YHEIGHT*MAPHEIGHT
+                newx = (context.xoffset+inx)/context.xwidth*context.width
+                newy = context.height-(context.yoffset+iny)/context.yheight*context.height
                 if REDUCEVECTORS:
                     newpoint = (int(newx),int(newy))
                     if newpoint != previous:
@@ -433,6 +558,60 @@ class _GeojShape(_PyShpShape):
             bbox = [x,y,x,y]
             self.bbox = bbox
 
+class _Selection:
+    """
+A set of selected feature ids, stored compactly as one flag per feature (a numpy boolean array if numpyspeed is enabled, otherwise a bytearray).
+Supports len(), fast membership tests with "in", looping through the selected ids in order, and the set operators | (union), & (intersection), - (difference) and ~ (inversion).
+"""
+    def __init__(self, length, ids=None, mask=None):
+        if NUMPYSPEED:
+            if mask is not None:
+                self.mask = numpy.array(mask, dtype=bool)
+            else:
+                self.mask = numpy.zeros(length, dtype=bool)
+                if ids is not None:
+                    self.mask[numpy.array(list(ids), dtype=int)] = True
+        else:
+            if mask is not None:
+                self.mask = bytearray(1 if flag else 0 for flag in mask)
+            else:
+                self.mask = bytearray(length)
+                if ids is not None:
+                    for uniqid in ids:
+                        self.mask[uniqid] = 1
+    def __len__(self):
+        if isinstance(self.mask, bytearray):
+            return len(self.mask) - self.mask.count(b"\x00")
+        else:
+            return int(numpy.count_nonzero(self.mask))
+    def __contains__(self, uniqid):
+        return 0 <= uniqid < len(self.mask) and bool(self.mask[uniqid])
+    def __iter__(self):
+        if isinstance(self.mask, bytearray):
+            return (uniqid for uniqid,flag in enumerate(self.mask) if flag)
+        else:
+            return iter(self.mask.nonzero()[0].tolist())
+    def __repr__(self):
+        return "<Selection of %i out of %i features>" % (len(self), len(self.mask))
+    def __or__(self, other):
+        return self.__Combine(other, operator.or_)
+    def __and__(self, other):
+        return self.__Combine(other, operator.and_)
+    def __sub__(self, other):
+        return self.__Combine(other, lambda a,b: a & ~b & 1)
+    def __invert__(self):
+        if isinstance(self.mask, bytearray):
+            return _Selection(len(self.mask), mask=[not flag for flag in self.mask])
+        else:
+            return _Selection(len(self.mask), mask=~self.mask)
+    def __Combine(self, other, func):
+        if len(self.mask) != len(other.mask):
+            raise ValueError("Can only combine selections from the same shapefile")
+        if isinstance(self.mask, bytearray) or isinstance(other.mask, bytearray):
+            return _Selection(len(self.mask), mask=[func(a,b) for a,b in itertools.izip(bytearray(self.mask), bytearray(other.mask))])
+        else:
+            return _Selection(len(self.mask), mask=func(self.mask, other.mask))
+
 class Shapefile:
     #builtins
     """
@@ -443,11 +622,21 @@ Opens and reads a shapefile. Supports looping through it to extract one PyShpSha
 | shapefilepath | the filepath of the shapefile, including the .shp extension
 | showprogress | True if wanting to display a progressbar while looping through the shapefile (default), otherwise False (default)
 | progresstext | a textstring to print alongside the progressbar to help identify why it is being looped
+| keepinmemory | True if the geometries and any attribute columns should be kept in memory once they have been read, so that looping through the shapefile many times, eg to draw it on many maps, only reads the file once. Keeping the geometries requires numpy. False by default
+| usepyramid | True if the shapefile should be drawn from the coarsest of its pre-simplified pyramid levels that still looks the same at the zoom and size of the map, which is much faster for overview maps of very detailed shapefiles. The pyramid is created the first time it is needed, see CreatePyramid. Requires numpy. False by default
 """
-    def __init__(self, shapefilepath=None, showprogress="not specified", progresstext="looping shapefile"):
+    def __init__(self, shapefilepath=None, showprogress="not specified", progresstext="looping shapefile", keepinmemory=False, usepyramid=False):
         self.showprogress = showprogress
         self.progresstext = progresstext
+        self.keepinmemory = keepinmemory
+        self.usepyramid = usepyramid
         self.selection = "all"
+        self.projection = None
+        self.spatialindex = None
+        self.geometrycache = None
+        self.pyramid = None
+        self.columns = dict()
+        self.filepath = shapefilepath
         if shapefilepath:
             self.shapefile = pyshp.Reader(shapefilepath)
             name = ".".join(shapefilepath.split(".")[:-1])
@@ -465,48 +654,201 @@ Opens and reads a shapefile. Supports looping through it to extract one PyShpSha
     def __str__(self):
         return self.filename
     def __iter__(self):
+        return self._IterInView((XMIN,YMIN,XMAX,YMAX))
+    def _IterInView(self, extent, pixelsize=None, cullsize=None, cullmode="skip", order=None):
+        "loops through the selected shapes that are within the given xmin,ymin,xmax,ymax extent, drawn with pixels of the given size if any, leaving out or collapsing the lines and polygons smaller than the cullsize in pixels, in the order of their ids or of the given list of ids"
         self._UpdateShapefile()
         #prepare progressreporting
-        if self.showprogress == "not specified":
-            if SHOWPROGRESS:
-                shellreport = "progressbar"
+        shellreport = self._ShellReport()
+        #only visit the selected shapes that are within view, jumping straight to each one
+        indices = self._ShapesInView(extent)
+        if self.selection != "all":
+            if indices is None:
+                indices = list(self.selection)
             else:
-                shellreport = None
-        else:
-            shellreport = self.showprogress
-        SHAPEFILELOOP = messages.ProgressReport(self.shapefile.iterShapes(numpyspeed=NUMPYSPEED), text=self.progresstext+" "+self.filename, shellreport=shellreport, countmethod="manual", genlength=self.shapefile.numRecords)
-        if NUMPYSPEED:
-            #loop
-            for shapeindex, shape in enumerate(SHAPEFILELOOP):
-                SHAPEFILELOOP.Increment()
-                if self.selection != "all":
-                    if shapeindex in self.selection:
-                        pyshpshape = self._PrepShape(shapeindex, shape)
-                        xmin,ymin,xmax,ymax = pyshpshape.bbox
-                        if (xmin < XMAX and xmax > XMIN) or (ymin < YMAX and ymax > YMIN):
-                            yield pyshpshape
+                indices = [shapeindex for shapeindex in indices if shapeindex in self.selection]
+        #find the lines and polygons that are too small to see from their bbox, before reading them
+        minsize = None
+        if cullsize and pixelsize and self.shapefile.shapeType in (POLYLINE,POLYLINEZ,POLYLINEM,POLYGON,POLYGONZ,POLYGONM):
+            minsize = cullsize * pixelsize
+        viewxmin,viewymin,viewxmax,viewymax = viewbox = self._ViewWithMargin(extent)
+        tiny = None
+        boxes = None
+        if NUMPYSPEED and self.filepath:
+            #test all the bboxes against the view at once, so only the shapes in view are read and prepared
+            boxes = self.shapefile.bboxes()
+            if indices is None:
+                candidates = numpy.arange(len(boxes))
+            else:
+                candidates = numpy.array(indices, dtype=int)
+            candidates = candidates[_BoxesInView(boxes[candidates], viewbox)]
+            if minsize:
+                #only the boxes of the shapes in view are measured, so zoomed in maps stay cheap
+                viewboxes = boxes[candidates]
+                small = numpy.maximum(viewboxes[:,2]-viewboxes[:,0], viewboxes[:,3]-viewboxes[:,1]) < minsize
+                if cullmode == "skip":
+                    candidates = candidates[~small]
                 else:
-                    pyshpshape = self._PrepShape(shapeindex, shape)
-                    xmin,ymin,xmax,ymax = pyshpshape.bbox
-                    if (xmin < XMAX and xmax > XMIN) or (ymin < YMAX and ymax > YMIN):
-                        yield pyshpshape
+                    #only the last of the features collapsed into the same pixel would be seen, so the rest are left out
+                    smallids = candidates[small]
+                    centers = (boxes[smallids,:2] + boxes[smallids,2:]) / 2.0
+                    pixels = numpy.floor((centers - extent[:2]) / pixelsize)
+                    if order is None:
+                        pixelorder = numpy.lexsort((pixels[:,1], pixels[:,0]))
+                    else:
+                        #the last one drawn is the last in the given order
+                        positions = numpy.zeros(len(boxes), dtype=int)
+                        positions[numpy.asarray(order, dtype=int)] = numpy.arange(len(order))
+                        pixelorder = numpy.lexsort((positions[smallids], pixels[:,1], pixels[:,0]))
+                    sortedpixels = pixels[pixelorder]
+                    lastinpixel = numpy.ones(len(pixelorder), dtype=bool)
+                    lastinpixel[:-1] = (sortedpixels[1:] != sortedpixels[:-1]).any(axis=1)
+                    hidden = numpy.ones(len(smallids), dtype=bool)
+                    hidden[pixelorder[lastinpixel]] = False
+                    hiddenincandidates = numpy.zeros(len(candidates), dtype=bool)
+                    hiddenincandidates[numpy.flatnonzero(small)[hidden]] = True
+                    candidates = candidates[~hiddenincandidates]
+                    tiny = set(smallids[~hidden].tolist())
+            #when every shape passes, leave the indices out so the dbf can still be read in one sequential scan
+            if indices is not None or len(candidates) < len(boxes):
+                indices = candidates.tolist()
+        if order is not None:
+            #jump straight to each shape in the given order instead, leaving out the ones not in view or not selected
+            if indices is None:
+                indices = list(order)
+            else:
+                inview = set(indices)
+                indices = [shapeindex for shapeindex in order if shapeindex in inview]
+        if indices is None:
+            shapeindexes = xrange(self.shapefile.numRecords)
         else:
-            for shapeindex, shape in enumerate(SHAPEFILELOOP):
-                SHAPEFILELOOP.Increment()
-                if self.selection != "all":
-                    if shapeindex in self.selection:
-                        pyshpshape = self._PrepShape(shapeindex, shape)
-                        xmin,ymin,xmax,ymax = pyshpshape.bbox
-                        if (xmin < XMAX and xmax > XMIN) or (ymin < YMAX and ymax > YMIN):
-                            yield pyshpshape
+            shapeindexes = indices
+        if not shapeindexes:
+            return
+        #pair each shape with its attribute row from one sequential scan of the dbf
+        if self.shapefile.dbf:
+            rawrecords = self.shapefile.iterRawRecords(indices=indices)
+        else:
+            rawrecords = itertools.repeat(None)
+        #the collapsed shapes are made from their bbox, so only the others need to be read
+        if tiny is None:
+            readindices = indices
+        else:
+            readindices = [shapeindex for shapeindex in shapeindexes if shapeindex not in tiny]
+        cache = self._PyramidLevel(pixelsize) or self._GeometryCache()
+        if cache:
+            shapes = cache.IterShapes(indices=readindices)
+        else:
+            shapes = self.shapefile.iterShapes(numpyspeed=NUMPYSPEED, memmap=NUMPYSPEED, indices=readindices)
+        if tiny is not None:
+            readshapes = shapes
+            shapes = (self._CollapsedShape(boxes[shapeindex], pixelsize) if shapeindex in tiny else next(readshapes) for shapeindex in shapeindexes)
+        shapesandrecords = itertools.izip(shapeindexes, shapes, rawrecords)
+        SHAPEFILELOOP = messages.ProgressReport(shapesandrecords, text=self.progresstext+" "+self.filename, shellreport=shellreport, countmethod="manual", genlength=len(shapeindexes))
+        for shapeindex, shape, rawrecord in SHAPEFILELOOP:
+            SHAPEFILELOOP.Increment()
+            if shape.shapeType == NULL:
+                continue
+            if boxes is None:
+                #without the bboxes up front each shape can only be tested once it has been read
+                if shape.shapeType in (POINT,POINTZ,POINTM):
+                    x,y = shape.points[0]
+                    bbox = [x,y,x,y]
                 else:
-                    pyshpshape = self._PrepShape(shapeindex, shape)
-                    xmin,ymin,xmax,ymax = pyshpshape.bbox
-                    if (xmin < XMAX and xmax > XMIN) or (ymin < YMAX and ymax > YMIN):
-                        yield pyshpshape
+                    bbox = shape.bbox
+                xmin,ymin,xmax,ymax = bbox
+                if not (xmin <= viewxmax and xmax >= viewxmin and ymin <= viewymax and ymax >= viewymin):
+                    continue
+                if minsize and max(xmax-xmin, ymax-ymin) < minsize:
+                    if cullmode == "skip":
+                        continue
+                    shape = self._CollapsedShape(bbox, pixelsize)
+            yield self._PrepShape(shapeindex, shape, rawrecord)
     #BASICS
-##    def SetFields(self, fieldnames):
-##        self.fieldnames = fieldnames
+    def CreateSpatialIndex(self):
+        """
+Builds a spatial index of where all the features are located, so that looping through the shapefile when the map is zoomed in only needs to read the features that fall within view. The index is saved next to the shapefile as a .gvx file and is automatically reused until the shapefile changes. Normally there is no need to call this, since the index is created automatically the first time a zoomed in map is drawn, but it can be used to prepare the index in advance. Requires numpy.
+"""
+        self._UpdateShapefile()
+        self.spatialindex = spatialindex.Build(self.shapefile.bboxes())
+        try:
+            self.spatialindex.Save(self._SpatialIndexPath(), self.filepath)
+        except EnvironmentError:
+            #the index still works for this session even if it cannot be saved, eg in a read-only folder
+            pass
+    def CreatePyramid(self, levels=4):
+        """
+Builds a pyramid of pre-simplified versions of the shapefile's lines and polygons, so that maps that show it at a small scale can read and draw far fewer points. The coarsest level looks the same as the original on a 256 pixel wide map of the whole shapefile, and each next level on a map four times as wide. The pyramid is saved in the geometry cache format in a .gvp folder next to the shapefile, and is automatically reused until the shapefile changes. Normally there is no need to call this, since the pyramid is created automatically the first time a map is drawn with the usepyramid option, but it can be used to prepare the pyramid in advance. Requires numpy.
+
+| __option__    | __description__ 
+| --- | --- 
+| levels | the number of pyramid levels to build (default is 4)
+"""
+        self._UpdateShapefile()
+        xmin,ymin,xmax,ymax = self.shapefile.bbox
+        #the tolerances are half a pixel of each level's map width
+        coarsest = max(xmax-xmin, ymax-ymin) / 256.0 / 2.0
+        tolerances = [coarsest / 4**level for level in xrange(levels)]
+        cache = self._GeometryCache() or geometrycache.Build(self.shapefile)
+        self.pyramid = geometrycache.BuildPyramid(cache, tolerances)
+        try:
+            geometrycache.SavePyramid(self.pyramid, self._PyramidPath(), self.filepath)
+            #use the saved files so the memory can be shared with other processes
+            self.pyramid = geometrycache.LoadPyramid(self._PyramidPath(), self.filepath) or self.pyramid
+        except EnvironmentError:
+            #the pyramid still works for this session even if it cannot be saved
+            pass
+    def GetExtent(self):
+        """
+Returns the combined bounding box of all the selected features as a list of [xmin,ymin,xmax,ymax], or None if no features are selected. With numpyspeed enabled this only reads the bounding box stored with each feature, so it is fast even for large shapefiles. Useful for zooming the map to fit a shapefile, for instance:
+
+    xmin,ymin,xmax,ymax = shapefile.GetExtent()
+    SetMapZoom([xmin,xmax], [ymin,ymax])
+"""
+        self._UpdateShapefile()
+        if NUMPYSPEED:
+            boxes = self.shapefile.bboxes()
+            if self.selection != "all":
+                boxes = boxes[self.selection.mask]
+            boxes = boxes[~numpy.isnan(boxes).any(axis=1)]
+            if not len(boxes):
+                return None
+            return boxes[:,:2].min(axis=0).tolist() + boxes[:,2:].max(axis=0).tolist()
+        else:
+            extent = None
+            if self.selection == "all":
+                indices = None
+            else:
+                indices = list(self.selection)
+            for shape in self.shapefile.iterShapes(indices=indices):
+                if shape.shapeType == NULL:
+                    continue
+                elif shape.shapeType in (POINT,POINTZ,POINTM):
+                    x,y = shape.points[0]
+                    bbox = [x,y,x,y]
+                else:
+                    bbox = shape.bbox
+                if extent is None:
+                    extent = list(bbox)
+                else:
+                    extent = [min(extent[0],bbox[0]), min(extent[1],bbox[1]), max(extent[2],bbox[2]), max(extent[3],bbox[3])]
+            return extent
+    def SetFields(self, fieldnames=None):
+        """
+Limits which attribute fields are read when calling GetAttributes() on the looped features, so that the bytes of all other fields are skipped instead of parsed. Useful for shapefiles with many fields when only a few are needed. The features' fieldnames attribute will only list the chosen fields, in their original order.
+
+| __option__    | __description__ 
+| --- | --- 
+| *fieldnames | a list of fieldnames to read (default is None, which reads all fields again)
+"""
+        self._UpdateShapefile()
+        if fieldnames is None:
+            self.projection = None
+        else:
+            unknown = [fieldname for fieldname in fieldnames if fieldname not in self.fieldnames]
+            if unknown:
+                raise ValueError("fieldnames must be among: %s" % ", ".join(self.fieldnames))
+            self.projection = [fieldname for fieldname in self.fieldnames if fieldname in fieldnames]
 ##    def GetFeature(self, shapeindex):
 ##        self._UpdateShapefile()
 ##        shape = self.shapefile.shape(shapeindex, numpyspeed=NUMPYSPEED)
@@ -563,47 +905,90 @@ Opens and reads a shapefile. Supports looping through it to extract one PyShpSha
 ##        shapewriter.save(savepath)
 ##        # finally copy prj file from original if exists
 ##        self._SaveProjection(shapefilename, savepath)
-    def SelectByQuery(self, query, inverted=False):
+    def GetColumn(self, fieldname):
+        """
+Returns all the values of one attribute field at once, ordered by feature id and ignoring any selection. If numpyspeed is enabled the field is decoded straight from the dbf file as a typed numpy array (numbers, dates, booleans or strings), which is much faster than reading one row at a time; otherwise a normal list is returned.
+
+| __option__    | __description__ 
+| --- | --- 
+| fieldname | the name of the attribute field to return (required)
+"""
+        self._UpdateShapefile()
+        if fieldname not in self.fieldnames:
+            raise ValueError("fieldname must be one of: %s" % ", ".join(self.fieldnames))
+        if fieldname in self.columns:
+            return self.columns[fieldname]
+        if NUMPYSPEED:
+            column = self.shapefile.column(fieldname)
+        else:
+            column = []
+            for rawrecord in self.shapefile.iterRawRecords():
+                row = self.shapefile.decodeRecord(rawrecord, [fieldname])
+                if row:
+                    column.append(row[0])
+                else:
+                    column.append(None)
+        if self.keepinmemory:
+            self.columns[fieldname] = column
+        return column
+    def SelectByQuery(self, query, inverted=False, selectmode="new"):
         """
 Make a query selection on the shapefile so that only those features where the query evaluates to True are returned.
 
 | __option__    | __description__ 
 | --- | --- 
-| query | a string containing Python-like syntax (required). Feature values for fieldnames can be grabbed by specifying the fieldname as if it were a variable (case-sensitive). Note that evaluating string expressions is currently case-sensitive, which becomes particularly unintuitive for less-than/more-than alphabetic queries.
+| query | a string containing Python-like syntax (required). Feature values for fieldnames can be grabbed by specifying the fieldname as if it were a variable (case-sensitive), and the feature itself as the variable "shape". Note that evaluating string expressions is currently case-sensitive, which becomes particularly unintuitive for less-than/more-than alphabetic queries. Blank numeric values count as 0. When numpyspeed is enabled, queries that only use fieldnames, values, comparisons, arithmetic, "in" lists and and/or/not are run on entire columns at once, which is much faster; any other query is run one feature at a time.
 | *inverted | a boolean specifying whether to invert the selection (default is False).
+| *selectmode | how to combine the matching features with the current selection, either "new" to replace it (default), "add" to add them to it, "subset" to only keep those that were already selected, or "remove" to unselect them.
 """
+        if selectmode not in ("new","add","subset","remove"):
+            raise ValueError("selectmode must be one of: new, add, subset, remove")
         self._UpdateShapefile()
+        oldselection = self.selection
         self.ClearSelection()
         self.progresstext = "making selection for"
+        #parse and check the query only once
+        query = querying.Query(query, self.fieldnames, globals())
+        #try to run it on entire columns at once
+        mask = None
+        if NUMPYSPEED:
+            #each field is only decoded once even if the query refers to it several times
+            columns = dict()
+            def getcolumn(fieldname):
+                if fieldname not in columns:
+                    columns[fieldname] = self._QueryColumn(fieldname)
+                return columns[fieldname]
+            mask = query.EvaluateColumns(getcolumn, len(self))
+            if mask is not None:
+                if inverted:
+                    mask = ~mask
+                mask &= self.shapefile.recordArray(["DeletionFlag"])["DeletionFlag"] == " "
+                return self._CombineSelection(oldselection, _Selection(len(self), mask=mask), selectmode)
+        #otherwise run the compiled query one feature at a time
         tempselection = []
-        for shape in self:
-            attributes = dict(zip(self.fieldnames, shape.GetAttributes()))
-            #first make temp variables out of all fieldnames
-            for field in self.fieldnames:
-                value = attributes[field]
-                if isinstance(value, basestring):
-                    value = '"""'+str(value)+'"""'
-                elif isinstance(value, (int,float)):
-                    value = str(value)
-                code = str(field)+" = "+value
-                exec(code)
-            #then run query
-            queryresult = eval(query)
-            if queryresult:
-                tempselection.append(shape.id)
-        self.selection = tempselection
-        if inverted:
-            self.InvertSelection()
-        return self.selection
+        fieldtypes = [fieldinfo[1] for fieldname in query.fields for fieldinfo in self.shapefile.fields if fieldinfo[0] == fieldname]
+        if query.needsshape:
+            for shape in self:
+                row = self._QueryRow(shape._GetRow(query.fields), fieldtypes)
+                if row is not None and query.Matches(row, shape) != inverted:
+                    tempselection.append(shape.id)
+        else:
+            #no need to read the geometries
+            SHAPEFILELOOP = messages.ProgressReport(self.shapefile.iterRawRecords(), text=self.progresstext+" "+self.filename, shellreport=self._ShellReport(), countmethod="manual", genlength=self.shapefile.numRecords)
+            for shapeindex, rawrecord in enumerate(SHAPEFILELOOP):
+                SHAPEFILELOOP.Increment()
+                row = self._QueryRow(self.shapefile.decodeRecord(rawrecord, query.fields), fieldtypes)
+                if row is not None and query.Matches(row) != inverted:
+                    tempselection.append(shapeindex)
+        return self._CombineSelection(oldselection, _Selection(len(self), ids=tempselection), selectmode)
     def InvertSelection(self):
         """
 Inverts the current selection
 """
-        self.progresstext = "inverting selection for"
-        oldselection = self.selection
-        self.ClearSelection()
-        tempselection = [shape.id for shape in self if shape.id not in oldselection]
-        self.selection = tempselection
+        if self.selection == "all":
+            self.selection = _Selection(len(self))
+        else:
+            self.selection = ~self.selection
     def ClearSelection(self):
         """
 Clears the current selection so that all shapes will be looped
@@ -628,29 +1013,200 @@ Assigns a field to contain the time dimension of a shapefile. Used by the NewMap
             #only do this first time done on a previously empty shapefile
             self.filename = "custom_shapefile"
             self.fieldnames = [fieldinfo[0] for fieldinfo in self.shapefile.fields[1:]]
-    def _PrepShape(self, shapeindex, shape):
+    def _CombineSelection(self, oldselection, newselection, selectmode):
+        if oldselection == "all":
+            oldselection = ~_Selection(len(self))
+        if selectmode == "add":
+            self.selection = oldselection | newselection
+        elif selectmode == "subset":
+            self.selection = oldselection & newselection
+        elif selectmode == "remove":
+            self.selection = oldselection - newselection
+        else:
+            self.selection = newselection
+        return self.selection
+    def _GeometryCache(self):
+        #returns the cached geometries if the geometrycache rendering option is set, caching them first if needed
+        #or if the shapefile keeps its geometries in memory, reading them all the first time
+        if not (GEOMETRYCACHE or self.keepinmemory) or not NUMPYSPEED or not self.filepath:
+            return None
+        if self.geometrycache is None and not GEOMETRYCACHE:
+            self.geometrycache = geometrycache.Build(self.shapefile)
+        elif self.geometrycache is None:
+            self.geometrycache = geometrycache.Load(GEOMETRYCACHE, self.filepath)
+            if self.geometrycache is None:
+                self.geometrycache = geometrycache.Build(self.shapefile)
+                try:
+                    self.geometrycache.Save(GEOMETRYCACHE, self.filepath)
+                    #use the saved files so the memory can be shared with other processes
+                    self.geometrycache = geometrycache.Load(GEOMETRYCACHE, self.filepath) or self.geometrycache
+                except EnvironmentError:
+                    #the cache still works for this session even if it cannot be saved
+                    pass
+        return self.geometrycache
+    def _SpatialIndexPath(self):
+        return os.path.splitext(self.filepath)[0] + ".gvx"
+    def _PyramidPath(self):
+        return os.path.splitext(self.filepath)[0] + ".gvp"
+    def _PyramidLevel(self, pixelsize):
+        #returns the coarsest pyramid level that still looks the same when drawn with pixels of the given size, or None if the full detail is needed
+        if not self.usepyramid or not pixelsize or not NUMPYSPEED or not self.filepath:
+            return None
+        if self.pyramid is None:
+            self.pyramid = geometrycache.LoadPyramid(self._PyramidPath(), self.filepath)
+            if self.pyramid is None:
+                self.CreatePyramid()
+        for tolerance, level in self.pyramid:
+            if tolerance <= pixelsize / 2.0:
+                return level
+        return None
+    def _ShapesInView(self, extent):
+        #returns the sorted ids of the shapes whose bbox intersects the xmin,ymin,xmax,ymax map view, or None if all of them might be in view
+        if not NUMPYSPEED or not self.filepath:
+            return None
+        viewxmin,viewymin,viewxmax,viewymax = extent
+        xmin,ymin,xmax,ymax = self.shapefile.bbox
+        if viewxmin <= xmin and xmax <= viewxmax and viewymin <= ymin and ymax <= viewymax:
+            #not zoomed in on the shapefile, so no need for the index
+            return None
+        if self.spatialindex is None:
+            self.spatialindex = spatialindex.Load(self._SpatialIndexPath(), self.filepath)
+            if self.spatialindex is None:
+                self.CreateSpatialIndex()
+        return self.spatialindex.Intersects(*self._ViewWithMargin(extent)).tolist()
+    def _IdsInView(self, extent):
+        #returns the sorted ids of the selected shapes that are within the xmin,ymin,xmax,ymax map view, the same ones as _IterInView loops through when not culling, but found without reading any of the shapes from the shp file
+        #returns None if they can only be found by reading the shapes, ie when zoomed in without numpyspeed
+        if not self.filepath:
+            return None
+        viewxmin,viewymin,viewxmax,viewymax = extent
+        xmin,ymin,xmax,ymax = self.shapefile.bbox
+        if viewxmin <= xmin and xmax <= viewxmax and viewymin <= ymin and ymax <= viewymax:
+            #not zoomed in on the shapefile, so all of them are in view
+            if self.selection == "all":
+                indices = range(self.shapefile.numRecords)
+            else:
+                indices = list(self.selection)
+        else:
+            #the bboxes in the spatial index are tested the same way as the shapes themselves
+            indices = self._ShapesInView(extent)
+            if indices is None:
+                return None
+            if self.selection != "all":
+                indices = [shapeindex for shapeindex in indices if shapeindex in self.selection]
+        nulls = self.shapefile.nullShapes(NUMPYSPEED)
+        if nulls is None:
+            return None
+        if nulls:
+            nulls = set(nulls)
+            indices = [shapeindex for shapeindex in indices if shapeindex not in nulls]
+        return indices
+    def _ViewWithMargin(self, extent):
+        #the xmin,ymin,xmax,ymax map view with a margin so that point symbols and outlines just outside it can still reach into it
+        viewxmin,viewymin,viewxmax,viewymax = extent
+        xmargin = (viewxmax-viewxmin) * 0.05
+        ymargin = (viewymax-viewymin) * 0.05
+        return (viewxmin-xmargin, viewymin-ymargin, viewxmax+xmargin, viewymax+ymargin)
+    def _CollapsedShape(self, bbox, pixelsize):
+        #a stand-in for a line or polygon too small to see, one pixel big at the center of its bbox
+        xmin,ymin,xmax,ymax = bbox
+        x,y = (xmin+xmax)/2.0, (ymin+ymax)/2.0
+        half = pixelsize/2.0
+        shape = pyshp._Shape(self.shapefile.shapeType)
+        if self.shapefile.shapeType in (POLYGON,POLYGONZ,POLYGONM):
+            points = [[x-half,y-half],[x-half,y+half],[x+half,y+half],[x+half,y-half],[x-half,y-half]]
+        else:
+            points = [[x-half,y],[x+half,y]]
+        if NUMPYSPEED:
+            shape.points = numpy.array(points)
+            shape.parts = numpy.array([0])
+        else:
+            shape.points = points
+            shape.parts = [0]
+        shape.bbox = list(bbox)
+        return shape
+    def _ShellReport(self):
+        if self.showprogress == "not specified":
+            if SHOWPROGRESS:
+                return "progressbar"
+            else:
+                return None
+        else:
+            return self.showprogress
+    def _QueryRow(self, row, fieldtypes):
+        #blank values are read as their raw padding, but queries should see them just like the columns do
+        #ie blank numbers as 0 and blank text and dates as "", and blank logicals as "?" like any other unset flag
+        if row is not None:
+            row = [self._QueryValue(value, fieldtype) for fieldtype,value in zip(fieldtypes,row)]
+        return row
+    def _QueryValue(self, value, fieldtype):
+        if fieldtype in ("N","F"):
+            return 0 if isinstance(value, basestring) else value
+        if isinstance(value, basestring) and not value.strip():
+            return "?" if fieldtype == "L" else ""
+        return value
+    def _IterValueBatches(self, uniqids, fieldname, batchsize=100000):
+        #yields the given ids and the values of one numeric field in batches of (uniqids, values), read straight from the dbf file without keeping more than one batch of them at a time, and with blank numbers as 0
+        if NUMPYSPEED:
+            #each batch is decoded on its own from the mapped dbf file, without caching the whole column
+            if len(uniqids) == len(self):
+                batches = self.shapefile.iterColumn(fieldname, batchsize=batchsize)
+            else:
+                batches = self.shapefile.iterColumn(fieldname, indices=uniqids, batchsize=batchsize)
+            for start, values in itertools.izip(xrange(0, len(uniqids), batchsize), batches):
+                yield uniqids[start:start+batchsize], values
+        else:
+            fieldtypes = [fieldinfo[1] for fieldinfo in self.shapefile.fields if fieldinfo[0] == fieldname]
+            if len(uniqids) == len(self):
+                rawrecords = self.shapefile.iterRawRecords()
+            else:
+                rawrecords = self.shapefile.iterRawRecords(indices=uniqids)
+            batchids, values = [], []
+            for uniqid, rawrecord in itertools.izip(uniqids, rawrecords):
+                row = self._QueryRow(self.shapefile.decodeRecord(rawrecord, [fieldname]), fieldtypes)
+                if row is None:
+                    #deleted record
+                    continue
+                batchids.append(uniqid)
+                values.append(row[0])
+                if len(batchids) == batchsize:
+                    yield batchids, values
+                    batchids, values = [], []
+            if batchids:
+                yield batchids, values
+    def _QueryColumn(self, fieldname):
+        #dates and booleans are given to queries as lists and "T"/"F" strings, which only the row by row evaluation can match
+        fieldtype = [fieldinfo[1] for fieldinfo in self.shapefile.fields if fieldinfo[0] == fieldname][0]
+        if fieldtype in ("D","L"):
+            return None
+        return self.GetColumn(fieldname)
+    def _PrepShape(self, shapeindex, shape, rawrecord=None):
+        if self.projection is None:
+            fieldnames = self.fieldnames
+        else:
+            fieldnames = self.projection
         if NUMPYSPEED:
             shapetype = PYSHPTYPE_AS_TEXT[shape.shapeType].lower()
             if "polygon" in shapetype:
                 if not numpy.any(shape.parts):
                     nestedcoords = [shape.points]
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, shapetype, bbox=shape.bbox)
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, "polygon", bbox=shape.bbox, rawrecord=rawrecord)
                 else:
                     coords = numpy.split(shape.points, shape.parts[1:])
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, coords, "polygon", bbox=shape.bbox)
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, coords, "polygon", bbox=shape.bbox, rawrecord=rawrecord)
             elif "line" in shapetype:
                 if not numpy.any(shape.parts):
                     nestedcoords = [shape.points]
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, shapetype, bbox=shape.bbox)
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, "line", bbox=shape.bbox, rawrecord=rawrecord)
                 else:
                     coords = numpy.split(shape.points, shape.parts[1:])
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, coords, "line", bbox=shape.bbox)
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, coords, "line", bbox=shape.bbox, rawrecord=rawrecord)
             elif "point" in shapetype:
                 if "multi" in shapetype:
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, shape.points, "point", bbox=shape.bbox)
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, shape.points, "point", bbox=shape.bbox, rawrecord=rawrecord)
                 else:
                     nestedcoords = [shape.points]
-                    return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, "point")
+                    return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, "point", rawrecord=rawrecord)
         else:
             #first set new shapetype to pass on
             shapetype = PYSHPTYPE_AS_TEXT[shape.shapeType].lower()
@@ -663,10 +1219,10 @@ Assigns a field to contain the time dimension of a shapefile. Used by the NewMap
             #then serve up points universal for all shapetypes
             if "point" in shapetype:
                 nestedcoords = [shape.points]
-                return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, newshapetype)
+                return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, newshapetype, rawrecord=rawrecord)
             elif len(shape.parts) == 1:
                 nestedcoords = [shape.points]
-                return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, newshapetype)
+                return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, newshapetype, rawrecord=rawrecord)
             else:
                 nestedcoords = []
                 shapeparts = list(shape.parts)
@@ -676,13 +1232,14 @@ Assigns a field to contain the time dimension of a shapefile. Used by the NewMap
                     eachmulti = shape.points[startindex:endindex]
                     nestedcoords.append(eachmulti)
                     startindex = endindex
-                return _PyShpShape(self.shapefile, self.fieldnames, shapeindex, nestedcoords, newshapetype)
+                return _PyShpShape(self.shapefile, fieldnames, shapeindex, nestedcoords, newshapetype, rawrecord=rawrecord)
 
 
 class _TkCanvas_Renderer:
-    def __init__(self):
+    def __init__(self, context):
         global tkFont
         import tkFont
+        self.context = context
         self.fontnames = dict([("default", "Times"),
                        ("times new roman", "Times"),
                        ("courier", "Courier"),
@@ -693,15 +1250,16 @@ this must be called before doing any rendering.
 Note: this replaces any previous image drawn on so be sure to
 retrieve the old image before calling it again to avoid losing work
 """
-        width = MAPWIDTH
-        height = MAPHEIGHT
-        background = MAPBACKGROUND
+        width = self.context.width
+        height = self.context.height
+        background = self.context.background
         self.img = None
+        _ImportTkinter()
         self.window = tk.Tk()
         self.window_frame = tk.Frame(self.window)
         self.window_frame.pack()
         screenwidth = self.window.winfo_screenwidth()
-        if MAPWIDTH >= screenwidth:
+        if self.context.width >= screenwidth:
             self.window.wm_state('zoomed')
         self.drawer = tk.Canvas(self.window_frame, width=width, height=height, bg="white")
         self.drawer.pack()
@@ -748,21 +1306,21 @@ retrieve the old image before calling it again to avoid losing work
     def RenderRectangle(self, upperleft, bottomright, customoptions):
         self.__FixHollowPolyError(customoptions)
         leftrelx, uprely = upperleft
-        leftx,upy = (int(MAPWIDTH*leftrelx), int(MAPHEIGHT*uprely))
+        leftx,upy = (int(self.context.width*leftrelx), int(self.context.height*uprely))
         rightrelx, downrely = bottomright
-        rightx,downy = (int(MAPWIDTH*rightrelx), int(MAPHEIGHT*downrely))
+        rightx,downy = (int(self.context.width*rightrelx), int(self.context.height*downrely))
         rectanglecoords = [leftx,upy, rightx,upy, rightx,downy, leftx,downy, leftx,upy]
         self._BasicPolygon(rectanglecoords, customoptions)
     def RenderCircle(self, relx, rely, fillsize, customoptions):
         customoptions["fillsize"] = fillsize
-        x = int(MAPWIDTH*relx)
-        y = int(MAPHEIGHT*rely)
+        x = int(self.context.width*relx)
+        y = int(self.context.height*rely)
         self._BasicCircle((x,y), customoptions)
     def RenderLine(self, startpos, stoppos, customoptions):
         startrelx, startrely = startpos
-        startxy = [int(MAPWIDTH*startrelx), int(MAPHEIGHT*startrely)]
+        startxy = [int(self.context.width*startrelx), int(self.context.height*startrely)]
         stoprelx, stoprely = stoppos
-        stopxy = [int(MAPWIDTH*stoprelx), int(MAPHEIGHT*stoprely)]
+        stopxy = [int(self.context.width*stoprelx), int(self.context.height*stoprely)]
         linecoords = startxy
         linecoords.extend(stopxy)
         self._BasicLine(linecoords, customoptions)
@@ -771,18 +1329,18 @@ retrieve the old image before calling it again to avoid losing work
 looks at instructions in options to decide which draw method to use
 """
         self.__FixHollowPolyError(options)
-        multishapes = shapeobj.to_tkinter()
+        multishapes = shapeobj.to_tkinter(self.context, options.get("simplify"), options.get("simplifymethod"))
         symbolizer = options.get("symbolizer")
         if shapeobj.type == "polygon":
             if symbolizer:
                 if symbolizer == "circle":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(coords, options)
                 elif symbolizer == "square":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(coords, options)
                 elif symbolizer == "pyramid":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(coords, options)
             else:
                 for coords in multishapes:
@@ -790,13 +1348,13 @@ looks at instructions in options to decide which draw method to use
         elif shapeobj.type == "line":
             if symbolizer:
                 if symbolizer == "circle":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(coords, options)
                 elif symbolizer == "square":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(coords, options)
                 elif symbolizer == "pyramid":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(coords, options)
             else:
                 for coords in multishapes:
@@ -816,7 +1374,7 @@ looks at instructions in options to decide which draw method to use
                 for coords in multishapes:
                     self._BasicCircle(coords, options)
     def RunTk(self):
-        self.drawer.create_rectangle(0,0,MAPWIDTH,MAPHEIGHT, fill="", outline=Color("black")) #this is the map outline edge
+        self.drawer.create_rectangle(0,0,self.context.width,self.context.height, fill="", outline=Color("black")) #this is the map outline edge
         self.window.mainloop()
 
     #Internal use only
@@ -835,22 +1393,22 @@ draws basic text, no effects
         if textanchor:
             textanchor = textanchor.lower()
             if textanchor == "center":
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
             else:
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
                 if "n" in textanchor:
-                    y = int(MAPHEIGHT*rely)
+                    y = int(self.context.height*rely)
                 elif "s" in textanchor:
-                    y = int(MAPHEIGHT*rely) - int(fontheight)
+                    y = int(self.context.height*rely) - int(fontheight)
                 if "e" in textanchor:
-                    x = int(MAPWIDTH*relx) - int(fontwidth)
+                    x = int(self.context.width*relx) - int(fontwidth)
                 elif "w" in textanchor:
-                    x = int(MAPWIDTH*relx)
+                    x = int(self.context.width*relx)
         if options.get("textboxfillcolor") or options.get("textboxoutlinecolor"):
-            relfontwidth, relfontheight = (fontwidth/float(MAPWIDTH), fontheight/float(MAPHEIGHT))
-            relxmid,relymid = (x/float(MAPWIDTH)+relfontwidth/2.0,y/float(MAPHEIGHT)+relfontheight/2.0)
+            relfontwidth, relfontheight = (fontwidth/float(self.context.width), fontheight/float(self.context.height))
+            relxmid,relymid = (x/float(self.context.width)+relfontwidth/2.0,y/float(self.context.height)+relfontheight/2.0)
             relupperleft = (relxmid-relfontwidth*options["textboxfillsize"]/2.0, relymid-relfontheight*options["textboxfillsize"]/2.0)
             relbottomright = (relxmid+relfontwidth*options["textboxfillsize"]/2.0, relymid+relfontheight*options["textboxfillsize"]/2.0)
             options["fillcolor"] = options["textboxfillcolor"]
@@ -920,9 +1478,11 @@ it is given instructions via a color/size/options dictionary
 """
     #NEED TO RECEIVE GENERATOR OF TRANSFORMED COORDS FROM MAPCANVAS
     #ALSO NEEDS THE Aggdraw.Draw(img) OBJECT
-    def __init__(self):
+    def __init__(self, context):
         global PIL
-        import PIL, PIL.Image, PIL.ImageDraw, PIL.ImageTk, PIL.ImageFont
+        import PIL, PIL.Image, PIL.ImageDraw, PIL.ImageFont
+        self.mapcontext = context
+        self.context = context
         self.upscaled = False
         self.sysfontfolders = dict([("windows","C:/Windows/Fonts/"),
                                     ("darwin", "/Library/Fonts/"),
@@ -940,17 +1500,22 @@ retrieve the old image before calling it again to avoid losing work
         mode = "RGBA"
         #then other specs
         if not self.upscaled:
-            global MAPWIDTH, MAPHEIGHT
-            MAPWIDTH = MAPWIDTH*2
-            MAPHEIGHT = MAPHEIGHT*2
-            _UpdateMapDims()
+            #draw at double size, using a double size copy of the map context
+            self.context = self.mapcontext.Scaled(2)
             self.upscaled = True
-        width = int(MAPWIDTH)
-        height = int(MAPHEIGHT)
-        background = MAPBACKGROUND
+        width = int(self.context.width)
+        height = int(self.context.height)
+        background = self.context.background
         dimensions = (width, height)
         self.img = PIL.Image.new(mode, dimensions, background)
         self.drawer = PIL.ImageDraw.Draw(self.img)
+    def PasteImage(self, img):
+        """
+composites a transparent image of the same size on top of
+everything drawn so far
+"""
+        self.img = PIL.Image.alpha_composite(self.img, img)
+        self.drawer = PIL.ImageDraw.Draw(self.img)
     def RenderText(self, relx, rely, text, options):
         options = options.copy()
         options["textsize"] = options["textsize"]*2
@@ -958,21 +1523,21 @@ retrieve the old image before calling it again to avoid losing work
             self._BasicText(relx, rely, text, options)
     def RenderRectangle(self, upperleft, bottomright, customoptions):
         leftrelx, uprely = upperleft
-        leftx,upy = (int(MAPWIDTH*leftrelx), int(MAPHEIGHT*uprely))
+        leftx,upy = (int(self.context.width*leftrelx), int(self.context.height*uprely))
         rightrelx, downrely = bottomright
-        rightx,downy = (int(MAPWIDTH*rightrelx), int(MAPHEIGHT*downrely))
+        rightx,downy = (int(self.context.width*rightrelx), int(self.context.height*downrely))
         rectanglecoords = [leftx,upy, rightx,upy, rightx,downy, leftx,downy, leftx,upy]
         self._BasicPolygon(rectanglecoords, customoptions)
     def RenderCircle(self, relx, rely, fillsize, customoptions):
         customoptions["fillsize"] = fillsize
-        x = int(MAPWIDTH*relx)
-        y = int(MAPHEIGHT*rely)
+        x = int(self.context.width*relx)
+        y = int(self.context.height*rely)
         self._BasicCircle((x,y), customoptions)
     def RenderLine(self, startpos, stoppos, customoptions):
         startrelx, startrely = startpos
-        startxy = [int(MAPWIDTH*startrelx), int(MAPHEIGHT*startrely)]
+        startxy = [int(self.context.width*startrelx), int(self.context.height*startrely)]
         stoprelx, stoprely = stoppos
-        stopxy = [int(MAPWIDTH*stoprelx), int(MAPHEIGHT*stoprely)]
+        stopxy = [int(self.context.width*stoprelx), int(self.context.height*stoprely)]
         linecoords = startxy
         linecoords.extend(stopxy)
         self._BasicLine(linecoords, customoptions)
@@ -983,18 +1548,18 @@ looks at instructions in options to decide which draw method to use
         #possibly use an options filterer here to enure all needed options
         #are given, otherwise snap to default
         #............
-        multishapes = shapeobj.to_PIL()
+        multishapes = shapeobj.to_PIL(self.context, options.get("simplify"), options.get("simplifymethod"), options.get("clipbox"))
         symbolizer = options.get("symbolizer")
         if shapeobj.type == "polygon":
             if symbolizer:
                 if symbolizer == "circle":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(coords, options)
                 elif symbolizer == "square":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(coords, options)
                 elif symbolizer == "pyramid":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(coords, options)
             else:
                 for coords in multishapes:
@@ -1002,13 +1567,13 @@ looks at instructions in options to decide which draw method to use
         elif shapeobj.type == "line":
             if symbolizer:
                 if symbolizer == "circle":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(coords, options)
                 elif symbolizer == "square":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(coords, options)
                 elif symbolizer == "pyramid":
-                    coords = shapeobj.GetAvgCenter()
+                    coords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(coords, options)
             else:
                 for coords in multishapes:
@@ -1028,21 +1593,17 @@ looks at instructions in options to decide which draw method to use
                 for coords in multishapes:
                     self._BasicCircle(coords, options)
     def GetImage(self):
+        global PIL
+        import PIL.ImageTk
         if self.upscaled:
-            global MAPWIDTH, MAPHEIGHT
-            MAPWIDTH = int(round(MAPWIDTH/2.0))
-            MAPHEIGHT = int(round(MAPHEIGHT/2.0))
-            _UpdateMapDims()
+            self.context = self.mapcontext
             width,height = self.img.size
             self.img = self.img.resize((int(round(width/2.0)),int(round(height/2.0))), PIL.Image.ANTIALIAS)
             self.upscaled = False
         return PIL.ImageTk.PhotoImage(self.img)
     def SaveImage(self, savepath):
         if self.upscaled:
-            global MAPWIDTH, MAPHEIGHT
-            MAPWIDTH = int(round(MAPWIDTH/2.0))
-            MAPHEIGHT = int(round(MAPHEIGHT/2.0))
-            _UpdateMapDims()
+            self.context = self.mapcontext
             width,height = self.img.size
             self.img = self.img.resize((int(round(width/2.0)),int(round(height/2.0))), PIL.Image.ANTIALIAS)
             self.upscaled = False
@@ -1071,22 +1632,22 @@ draws basic text, no effects
         if textanchor:
             textanchor = textanchor.lower()
             if textanchor == "center":
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
             else:
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
                 if "n" in textanchor:
-                    y = int(MAPHEIGHT*rely)
+                    y = int(self.context.height*rely)
                 elif "s" in textanchor:
-                    y = int(MAPHEIGHT*rely) - int(fontheight)
+                    y = int(self.context.height*rely) - int(fontheight)
                 if "e" in textanchor:
-                    x = int(MAPWIDTH*relx) - int(fontwidth)
+                    x = int(self.context.width*relx) - int(fontwidth)
                 elif "w" in textanchor:
-                    x = int(MAPWIDTH*relx)
+                    x = int(self.context.width*relx)
         if options.get("textboxfillcolor") or options.get("textboxoutlinecolor"):
-            relfontwidth, relfontheight = (fontwidth/float(MAPWIDTH), fontheight/float(MAPHEIGHT))
-            relxmid,relymid = (x/float(MAPWIDTH)+relfontwidth/2.0,y/float(MAPHEIGHT)+relfontheight/2.0)
+            relfontwidth, relfontheight = (fontwidth/float(self.context.width), fontheight/float(self.context.height))
+            relxmid,relymid = (x/float(self.context.width)+relfontwidth/2.0,y/float(self.context.height)+relfontheight/2.0)
             relupperleft = (relxmid-relfontwidth*options["textboxfillsize"]/2.0, relymid-relfontheight*options["textboxfillsize"]/2.0)
             relbottomright = (relxmid+relfontwidth*options["textboxfillsize"]/2.0, relymid+relfontheight*options["textboxfillsize"]/2.0)
             options["fillcolor"] = options["textboxfillcolor"]
@@ -1156,9 +1717,10 @@ NOTE: this class is not yet finished, only supports polygons for now...
 """
     #NEED TO RECEIVE GENERATOR OF TRANSFORMED COORDS FROM MAPCANVAS
     #ALSO NEEDS THE Aggdraw.Draw(img) OBJECT
-    def __init__(self):
+    def __init__(self, context):
         global pydraw
         import pydraw
+        self.context = context
         self.sysfontfolders = dict([("windows","C:/Windows/Fonts/"),
                                     ("darwin", "/Library/Fonts/"),
                                     ("linux", "/usr/share/fonts/truetype/") ])
@@ -1174,9 +1736,9 @@ retrieve the old image before calling it again to avoid losing work
         #first mode
         mode = "RGBA"
         #then other specs
-        width = MAPWIDTH
-        height = MAPHEIGHT
-        background = MAPBACKGROUND
+        width = self.context.width
+        height = self.context.height
+        background = self.context.background
         dimensions = (width, height)
         self.img = pydraw.Image().new(width=width, height=height, background=background)
         self.drawer = self.img
@@ -1184,18 +1746,18 @@ retrieve the old image before calling it again to avoid losing work
         """
 looks at instructions in options to decide which draw method to use
 """
-        multishapes = shapeobj.to_pydraw()
+        multishapes = shapeobj.to_pydraw(self.context, options.get("simplify"), options.get("simplifymethod"))
         symbolizer = options.get("symbolizer")
         if shapeobj.type == "polygon":
             if symbolizer:
                 if symbolizer == "circle":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(centercoords, options)
                 elif symbolizer == "square":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(centercoords, options)
                 elif symbolizer == "pyramid":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(centercoords, options)
             else:
                 for coords in multishapes:
@@ -1203,13 +1765,13 @@ looks at instructions in options to decide which draw method to use
         elif shapeobj.type == "line":
             if symbolizer:
                 if symbolizer == "circle":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(centercoords, options)
                 elif symbolizer == "square":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(centercoords, options)
                 elif symbolizer == "pyramid":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(centercoords, options)
             else:
                 for coords in multishapes:
@@ -1233,21 +1795,21 @@ looks at instructions in options to decide which draw method to use
             self._BasicText(relx, rely, text, options)
     def RenderRectangle(self, upperleft, bottomright, customoptions):
         leftrelx, uprely = upperleft
-        leftx,upy = (int(MAPWIDTH*leftrelx), int(MAPHEIGHT*uprely))
+        leftx,upy = (int(self.context.width*leftrelx), int(self.context.height*uprely))
         rightrelx, downrely = bottomright
-        rightx,downy = (int(MAPWIDTH*rightrelx), int(MAPHEIGHT*downrely))
+        rightx,downy = (int(self.context.width*rightrelx), int(self.context.height*downrely))
         rectanglecoords = [leftx,upy, rightx,upy, rightx,downy, leftx,downy, leftx,upy]
         self._BasicPolygon(rectanglecoords, customoptions)
     def RenderCircle(self, relx, rely, fillsize, customoptions):
         customoptions["fillsize"] = fillsize
-        x = int(MAPWIDTH*relx)
-        y = int(MAPHEIGHT*rely)
+        x = int(self.context.width*relx)
+        y = int(self.context.height*rely)
         self._BasicCircle((x,y), customoptions)
     def RenderLine(self, startpos, stoppos, customoptions):
         startrelx, startrely = startpos
-        startxy = [int(MAPWIDTH*startrelx), int(MAPHEIGHT*startrely)]
+        startxy = [int(self.context.width*startrelx), int(self.context.height*startrely)]
         stoprelx, stoprely = stoppos
-        stopxy = [int(MAPWIDTH*stoprelx), int(MAPHEIGHT*stoprely)]
+        stopxy = [int(self.context.width*stoprelx), int(self.context.height*stoprely)]
         linecoords = startxy
         linecoords.extend(stopxy)
         self._BasicLine(linecoords, customoptions)
@@ -1268,22 +1830,22 @@ draws basic text, no effects
         if textanchor:
             textanchor = textanchor.lower()
             if textanchor == "center":
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
             else:
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
                 if "n" in textanchor:
-                    y = int(MAPHEIGHT*rely)
+                    y = int(self.context.height*rely)
                 elif "s" in textanchor:
-                    y = int(MAPHEIGHT*rely) - int(fontheight)
+                    y = int(self.context.height*rely) - int(fontheight)
                 if "e" in textanchor:
-                    x = int(MAPWIDTH*relx) - int(fontwidth)
+                    x = int(self.context.width*relx) - int(fontwidth)
                 elif "w" in textanchor:
-                    x = int(MAPWIDTH*relx)
+                    x = int(self.context.width*relx)
         if options.get("textboxfillcolor") or options.get("textboxoutlinecolor"):
-            relfontwidth, relfontheight = (fontwidth/float(MAPWIDTH), fontheight/float(MAPHEIGHT))
-            relxmid,relymid = (x/float(MAPWIDTH)+relfontwidth/2.0,y/float(MAPHEIGHT)+relfontheight/2.0)
+            relfontwidth, relfontheight = (fontwidth/float(self.context.width), fontheight/float(self.context.height))
+            relxmid,relymid = (x/float(self.context.width)+relfontwidth/2.0,y/float(self.context.height)+relfontheight/2.0)
             relupperleft = (relxmid-relfontwidth*options["textboxfillsize"]/2.0, relymid-relfontheight*options["textboxfillsize"]/2.0)
             relbottomright = (relxmid+relfontwidth*options["textboxfillsize"]/2.0, relymid+relfontheight*options["textboxfillsize"]/2.0)
             options["fillcolor"] = options["textboxfillcolor"]
@@ -1379,9 +1941,10 @@ it is given instructions via a color/size/options dictionary
 """
     #NEED TO RECEIVE GENERATOR OF TRANSFORMED COORDS FROM MAPCANVAS
     #ALSO NEEDS THE Aggdraw.Draw(img) OBJECT
-    def __init__(self):
+    def __init__(self, context):
         global aggdraw, PIL
-        import aggdraw, PIL, PIL.Image, PIL.ImageDraw, PIL.ImageTk
+        import aggdraw, PIL, PIL.Image, PIL.ImageDraw
+        self.context = context
         self.sysfontfolders = dict([("windows","C:/Windows/Fonts/"),
                                     ("darwin", "/Library/Fonts/"),
                                     ("linux", "/usr/share/fonts/truetype/") ])
@@ -1397,28 +1960,36 @@ retrieve the old image before calling it again to avoid losing work
         #first mode
         mode = "RGBA"
         #then other specs
-        width = int(MAPWIDTH)
-        height = int(MAPHEIGHT)
-        background = MAPBACKGROUND
+        width = int(self.context.width)
+        height = int(self.context.height)
+        background = self.context.background
         dimensions = (width, height)
         self.img = PIL.Image.new(mode, dimensions, background)
         self.drawer = aggdraw.Draw(self.img)
+    def PasteImage(self, img):
+        """
+composites a transparent image of the same size on top of
+everything drawn so far
+"""
+        self.drawer.flush()
+        self.img = PIL.Image.alpha_composite(self.img, img)
+        self.drawer = aggdraw.Draw(self.img)
     def RenderShape(self, shapeobj, options):
         """
 looks at instructions in options to decide which draw method to use
 """
-        multishapes = shapeobj.to_aggdraw()
+        multishapes = shapeobj.to_aggdraw(self.context, options.get("simplify"), options.get("simplifymethod"), options.get("clipbox"))
         symbolizer = options.get("symbolizer")
         if shapeobj.type == "polygon":
             if symbolizer:
                 if symbolizer == "circle":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(centercoords, options)
                 elif symbolizer == "square":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(centercoords, options)
                 elif symbolizer == "pyramid":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(centercoords, options)
             else:
                 for coords in multishapes:
@@ -1426,13 +1997,13 @@ looks at instructions in options to decide which draw method to use
         elif shapeobj.type == "line":
             if symbolizer:
                 if symbolizer == "circle":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicCircle(centercoords, options)
                 elif symbolizer == "square":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._BasicSquare(centercoords, options)
                 elif symbolizer == "pyramid":
-                    centercoords = shapeobj.GetAvgCenter()
+                    centercoords = shapeobj.GetAvgCenter(self.context)
                     self._Pyramid(centercoords, options)
             else:
                 for coords in multishapes:
@@ -1456,25 +2027,27 @@ looks at instructions in options to decide which draw method to use
             self._BasicText(relx, rely, text, options)
     def RenderRectangle(self, upperleft, bottomright, customoptions):
         leftrelx, uprely = upperleft
-        leftx,upy = (int(MAPWIDTH*leftrelx), int(MAPHEIGHT*uprely))
+        leftx,upy = (int(self.context.width*leftrelx), int(self.context.height*uprely))
         rightrelx, downrely = bottomright
-        rightx,downy = (int(MAPWIDTH*rightrelx), int(MAPHEIGHT*downrely))
+        rightx,downy = (int(self.context.width*rightrelx), int(self.context.height*downrely))
         rectanglecoords = [leftx,upy, rightx,upy, rightx,downy, leftx,downy, leftx,upy]
         self._BasicPolygon(rectanglecoords, customoptions)
     def RenderCircle(self, relx, rely, fillsize, customoptions):
         customoptions["fillsize"] = fillsize
-        x = int(MAPWIDTH*relx)
-        y = int(MAPHEIGHT*rely)
+        x = int(self.context.width*relx)
+        y = int(self.context.height*rely)
         self._BasicCircle((x,y), customoptions)
     def RenderLine(self, startpos, stoppos, customoptions):
         startrelx, startrely = startpos
-        startxy = [int(MAPWIDTH*startrelx), int(MAPHEIGHT*startrely)]
+        startxy = [int(self.context.width*startrelx), int(self.context.height*startrely)]
         stoprelx, stoprely = stoppos
-        stopxy = [int(MAPWIDTH*stoprelx), int(MAPHEIGHT*stoprely)]
+        stopxy = [int(self.context.width*stoprelx), int(self.context.height*stoprely)]
         linecoords = startxy
         linecoords.extend(stopxy)
         self._BasicLine(linecoords, customoptions)
     def GetImage(self):
+        global PIL
+        import PIL.ImageTk
         self.drawer.flush()
         return PIL.ImageTk.PhotoImage(self.img)
     def SaveImage(self, savepath):
@@ -1493,22 +2066,22 @@ draws basic text, no effects
         if textanchor:
             textanchor = textanchor.lower()
             if textanchor == "center":
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
             else:
-                x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-                y = int(MAPHEIGHT*rely) - int(fontheight/2.0)
+                x = int(self.context.width*relx) - int(fontwidth/2.0)
+                y = int(self.context.height*rely) - int(fontheight/2.0)
                 if "n" in textanchor:
-                    y = int(MAPHEIGHT*rely)
+                    y = int(self.context.height*rely)
                 elif "s" in textanchor:
-                    y = int(MAPHEIGHT*rely) - int(fontheight)
+                    y = int(self.context.height*rely) - int(fontheight)
                 if "e" in textanchor:
-                    x = int(MAPWIDTH*relx) - int(fontwidth)
+                    x = int(self.context.width*relx) - int(fontwidth)
                 elif "w" in textanchor:
-                    x = int(MAPWIDTH*relx)
+                    x = int(self.context.width*relx)
         if options.get("textboxfillcolor") or options.get("textboxoutlinecolor"):
-            relfontwidth, relfontheight = (fontwidth/float(MAPWIDTH), fontheight/float(MAPHEIGHT))
-            relxmid,relymid = (x/float(MAPWIDTH)+relfontwidth/2.0,y/float(MAPHEIGHT)+relfontheight/2.0)
+            relfontwidth, relfontheight = (fontwidth/float(self.context.width), fontheight/float(self.context.height))
+            relxmid,relymid = (x/float(self.context.width)+relfontwidth/2.0,y/float(self.context.height)+relfontheight/2.0)
             relupperleft = (relxmid-relfontwidth*options["textboxfillsize"]/2.0, relymid-relfontheight*options["textboxfillsize"]/2.0)
             relbottomright = (relxmid+relfontwidth*options["textboxfillsize"]/2.0, relymid+relfontheight*options["textboxfillsize"]/2.0)
             options["fillcolor"] = options["textboxfillcolor"]
@@ -1612,9 +2185,10 @@ it is given instructions via a color/size/options dictionary
 """
     #NEED TO RECEIVE GENERATOR OF TRANSFORMED COORDS FROM MAPCANVAS
     #ALSO NEEDS THE Aggdraw.Draw(img) OBJECT
-    def __init__(self):
+    def __init__(self, context):
         global cairo
         import cairo
+        self.context = context
         self.fontnames = dict([("default", "cursive"),
                                ("serif", "serif"),
                                ("sans-serif", "sans-serif"),
@@ -1630,36 +2204,36 @@ retrieve the old image before calling it again to avoid losing work
         #first mode
         mode = cairo.FORMAT_ARGB32
         #then other specs
-        width = MAPWIDTH
-        height = MAPHEIGHT
-        background = MAPBACKGROUND
-        self.img = cairo.ImageSurface(mode, int(MAPWIDTH), int(MAPHEIGHT))
+        width = self.context.width
+        height = self.context.height
+        background = self.context.background
+        self.img = cairo.ImageSurface(mode, int(self.context.width), int(self.context.height))
         self.drawer = cairo.Context(self.img)
         if background:
             backgroundcolor = self.__hex_to_rgb(background)
             self.drawer.set_source_rgb(*backgroundcolor)
-            self.drawer.rectangle(0,0,MAPWIDTH,MAPHEIGHT)
+            self.drawer.rectangle(0,0,self.context.width,self.context.height)
             self.drawer.fill()
     def RenderText(self, relx, rely, text, options):
         if not options.get("texteffect"):
             self._BasicText(relx, rely, text, options)
     def RenderRectangle(self, upperleft, bottomright, customoptions):
         leftrelx, uprely = upperleft
-        leftx,upy = (int(MAPWIDTH*leftrelx), int(MAPHEIGHT*uprely))
+        leftx,upy = (int(self.context.width*leftrelx), int(self.context.height*uprely))
         rightrelx, downrely = bottomright
-        rightx,downy = (int(MAPWIDTH*rightrelx), int(MAPHEIGHT*downrely))
+        rightx,downy = (int(self.context.width*rightrelx), int(self.context.height*downrely))
         rectanglecoords = [(leftx,upy), (rightx,upy), (rightx,downy), (leftx,downy), (leftx,upy)]        
         self._BasicPolygon(rectanglecoords, customoptions)
     def RenderCircle(self, relx, rely, fillsize, customoptions):
         customoptions["fillsize"] = fillsize
-        x = int(MAPWIDTH*relx)
-        y = int(MAPHEIGHT*rely)
+        x = int(self.context.width*relx)
+        y = int(self.context.height*rely)
         self._BasicCircle([(x,y)], customoptions)
     def RenderLine(self, startpos, stoppos, customoptions):
         startrelx, startrely = startpos
-        startxy = (int(MAPWIDTH*startrelx), int(MAPHEIGHT*startrely))
+        startxy = (int(self.context.width*startrelx), int(self.context.height*startrely))
         stoprelx, stoprely = stoppos
-        stopxy = (int(MAPWIDTH*stoprelx), int(MAPHEIGHT*stoprely))
+        stopxy = (int(self.context.width*stoprelx), int(self.context.height*stoprely))
         linecoords = [startxy, stopxy]
         self._BasicLine(linecoords, customoptions)
     def RenderShape(self, shapeobj, options):
@@ -1669,7 +2243,7 @@ looks at instructions in options to decide which draw method to use
         #possibly use an options filterer here to enure all needed options
         #are given, otherwise snap to default
         #............
-        multishapes = shapeobj.to_pycairo()
+        multishapes = shapeobj.to_pycairo(self.context, options.get("simplify"), options.get("simplifymethod"))
         for coords in multishapes:
             if shapeobj.type == "polygon":
                 self._BasicPolygon(coords, options)
@@ -1679,6 +2253,7 @@ looks at instructions in options to decide which draw method to use
                 self._BasicCircle(coords, options)
     def GetImage(self):
         self.img.write_to_png("tempgif.gif")
+        _ImportTkinter()
         gifimg = tk.PhotoImage(file="tempgif.gif")
         os.remove("tempgif.gif")
         return gifimg
@@ -1696,8 +2271,8 @@ Draws basic text, no effects
         self.drawer.select_font_face(self.fontnames[options["textfont"]])
         self.drawer.set_font_size(options["textsize"]) # em-square height is 90 pixels
         _, _, fontwidth, fontheight, _, _ = self.drawer.text_extents(text)
-        x = int(MAPWIDTH*relx) - int(fontwidth/2.0)
-        y = int(MAPHEIGHT*rely) + int(fontheight/2.0) #NOTICE: for some odd reason height has to be plussed, not minused
+        x = int(self.context.width*relx) - int(fontwidth/2.0)
+        y = int(self.context.height*rely) + int(fontheight/2.0) #NOTICE: for some odd reason height has to be plussed, not minused
         self.drawer.move_to(x, y) # move to point (x, y) = (10, 90)
         textcolor = self.__hex_to_rgb(options["textcolor"])
         self.drawer.set_source_rgb(*textcolor) # yellow
@@ -1768,17 +2343,20 @@ Draw polygon with color fill
 
 class _Renderer:
     #builtins
-    def __init__(self):
-        if RENDERER == "tkinter":
-            self.renderer = _TkCanvas_Renderer()
-        elif RENDERER == "PIL":
-            self.renderer = _PIL_Renderer()
-        elif RENDERER == "pydraw":
-            self.renderer = _Pydraw_Renderer()
-        elif RENDERER == "aggdraw":
-            self.renderer = _Aggdraw_Renderer()
-        elif RENDERER == "pycairo":
-            self.renderer = _PyCairo_Renderer()
+    def __init__(self, context=None):
+        if context is None:
+            context = _MapContext()
+        self.context = context
+        if context.renderer == "tkinter":
+            self.renderer = _TkCanvas_Renderer(context)
+        elif context.renderer == "PIL":
+            self.renderer = _PIL_Renderer(context)
+        elif context.renderer == "pydraw":
+            self.renderer = _Pydraw_Renderer(context)
+        elif context.renderer == "aggdraw":
+            self.renderer = _Aggdraw_Renderer(context)
+        elif context.renderer == "pycairo":
+            self.renderer = _PyCairo_Renderer(context)
         #automatically create blank image
         self.NewImage()
         self.layers = dict()
@@ -1794,12 +2372,55 @@ class _Renderer:
         self._RenderMapTitle(shapefilepath, customoptions)
         self._SaveRenderedShapefile(savepath)
     #internal use only
+    def _DrawingContext(self):
+        "the context of the image being drawn on, which is twice the size of the map while the PIL renderer is drawing"
+        return self.renderer.context
+    def _MapShapes(self, shapes, batchsize=1000):
+        """
+converts the coordinates of the lines and polygons to pixels a batch of shapes at a time, in one buffer shared by the whole batch, and gives each shape float32 views into it, so the PIL and aggdraw renderers do not have to convert and copy each part on its own
+"""
+        if not (NUMPYSPEED and self.context.renderer in ("PIL","aggdraw")):
+            for shape in shapes:
+                yield shape
+            return
+        context = self._DrawingContext()
+        shapes = iter(shapes)
+        while True:
+            batch = list(itertools.islice(shapes, batchsize))
+            if not batch:
+                break
+            tomap = [shape for shape in batch if shape.type != "point"]
+            parts = [eachmulti for shape in tomap for eachmulti in shape.coords]
+            if parts:
+                #transform in place at full precision so zoomed in maps stay exact, and only then make the float32 copy that is drawn
+                pixelcoords = numpy.concatenate(parts).astype(numpy.float64, copy=False)
+                pixelcoords += context.translation
+                pixelcoords *= context.scaling
+                pixelcoords = pixelcoords.astype(numpy.float32)
+                partends = numpy.cumsum([len(eachmulti) for eachmulti in parts])
+                views = iter(numpy.split(pixelcoords, partends[:-1]))
+                for shape in tomap:
+                    shape._pixelcoords = [next(views) for eachmulti in shape.coords]
+                    shape._pixelcontext = context
+            for shape in batch:
+                yield shape
     def _RelSizesToPixels(self, customoptions):
+        context = self._DrawingContext()
         customoptions = customoptions.copy()
-        customoptions["fillsize"] = MAPWIDTH*customoptions["fillsize"]/100.0
-        customoptions["fillwidth"] = MAPWIDTH*customoptions["fillwidth"]/100.0
-        customoptions["fillheight"] = MAPHEIGHT*customoptions["fillheight"]/100.0
-        customoptions["outlinewidth"] = MAPWIDTH*customoptions["outlinewidth"]/100.0
+        #the simplify tolerance is given in pixels of the map, which may be drawn at a larger size
+        simplify = customoptions.get("simplify")
+        if simplify is None and REDUCEVECTORS and NUMPYSPEED:
+            simplify = 0.5
+        if simplify:
+            customoptions["simplify"] = simplify*context.width/float(self.context.width)
+        customoptions["fillsize"] = context.width*customoptions["fillsize"]/100.0
+        customoptions["fillwidth"] = context.width*customoptions["fillwidth"]/100.0
+        customoptions["fillheight"] = context.height*customoptions["fillheight"]/100.0
+        customoptions["outlinewidth"] = context.width*customoptions["outlinewidth"]/100.0
+        if customoptions.get("clip"):
+            #clip just outside the image, far enough that the edges made by clipping are hidden under even the widest stroke
+            margin = customoptions["fillsize"] + customoptions["outlinewidth"]*2 + 2
+            customoptions["clipbox"] = (-margin, -margin, context.width+margin, context.height+margin)
         return customoptions
     def _RenderMapTitle(self, shapefilepath, customoptions):
         #unless not specified, default maptitle is set to name of shapefile
@@ -1809,7 +2430,7 @@ class _Renderer:
             customoptions["maptitle"] = shapefilename
         #unless asked not to show maptitle, generate default textoptions except large text size
         if customoptions.get("maptitle"):
-            textoptions = _CheckTextOptions(dict([("textsize",0.0452)]))
+            textoptions = _CheckTextOptions(dict([("textsize",0.0452)]), self._DrawingContext())
             self._RenderText(0.5, 0.05, customoptions["maptitle"], textoptions)
     def _RenderText(self, relx, rely, text, textoptions):
         self.renderer.RenderText(relx, rely, text, textoptions)
@@ -1843,7 +2464,8 @@ class _Renderer:
             shapefile.SelectByQuery(excludequery, inverted=True)
         #then iterate through shapes and render each
         shapefile.progresstext = "rendering"
-        for eachshape in shapefile:
+        order = self._RenderOrder(shapefile, customoptions)
+        for eachshape in self._MapShapes(shapefile._IterInView(self.context.Extent(), self.context.PixelSize(), customoptions.get("cullsize"), customoptions.get("cullmode"), order)):
             #then send to be rendered
             self._RenderShape(eachshape, customoptions)
     def _RenderLayer(self, layer):
@@ -1857,17 +2479,82 @@ class _Renderer:
             shapefile.SelectByQuery(excludequery, inverted=True)
         #then iterate through shapes and render each
         shapefile.progresstext = "rendering"
-        for eachshape in shapefile:
-            #then send to be rendered
-            self._RenderShape(eachshape, customoptions)
+        order = self._RenderOrder(shapefile, customoptions)
+        if self._CanRenderInParallel(shapefile):
+            if order is not None:
+                shapeids = order
+            elif shapefile.selection == "all":
+                shapeids = range(len(shapefile))
+            else:
+                shapeids = list(shapefile.selection)
+            self._RenderInParallel(shapefile, shapeids, customoptions)
+        else:
+            for eachshape in self._MapShapes(shapefile._IterInView(self.context.Extent(), self.context.PixelSize(), customoptions.get("cullsize"), customoptions.get("cullmode"), order)):
+                #then send to be rendered
+                self._RenderShape(eachshape, customoptions)
+    def _RenderOrder(self, shapefile, customoptions, classifier=None):
+        "the ids of the selected shapes in the order set by the renderorder option, or None to draw them in the order they are stored"
+        renderorder = customoptions.get("renderorder")
+        if not renderorder:
+            return None
+        if classifier is not None and renderorder in classifier.symbols:
+            #by classified symbol size, from big to small
+            if renderorder not in ("fillsize","fillwidth","fillheight","outlinewidth"):
+                raise ValueError("renderorder can only be a classified symboltype if it is a size, one of: fillsize, fillwidth, fillheight, outlinewidth")
+            order = classifier.GetIdsBySymbol(renderorder)
+        elif renderorder in shapefile.fieldnames:
+            #by attribute value, from low to high
+            column = shapefile.GetColumn(renderorder)
+            if NUMPYSPEED:
+                order = numpy.argsort(column, kind="mergesort").tolist()
+            else:
+                order = sorted(xrange(len(column)), key=column.__getitem__)
+            if shapefile.selection != "all":
+                order = [uniqid for uniqid in order if uniqid in shapefile.selection]
+        else:
+            raise ValueError("renderorder must be one of the fieldnames: %s, or a classified size symboltype" % ", ".join(shapefile.fieldnames))
+        if customoptions.get("renderdescending"):
+            order.reverse()
+        return order
+    def _CanRenderInParallel(self, shapefile):
+        return PROCESSES > 1 and self.context.renderer in ("PIL","aggdraw") and shapefile.filepath
+    def _RenderInParallel(self, shapefile, shapeids, customoptions, classifier=None):
+        "splits the shapes into one chunk per process, renders each chunk onto a separate transparent image, and then pastes them on top of the map in order"
+        #leave out shapes outside the view up front, which also makes sure any spatial index is ready before the processes need it
+        inview = shapefile._ShapesInView(self.context.Extent())
+        if inview is not None:
+            inview = set(inview)
+            shapeids = [uniqid for uniqid in shapeids if uniqid in inview]
+        #the processes get their own copy of the map context, and of the rendering options
+        state = dict((name, globals()[name]) for name in ("NUMPYSPEED","REDUCEVECTORS","GEOMETRYCACHE"))
+        chunksize = int(math.ceil(len(shapeids)/float(PROCESSES)))
+        jobs = []
+        for start in xrange(0, len(shapeids), chunksize):
+            chunk = shapeids[start:start+chunksize]
+            if classifier is None:
+                chunksymbols = None
+            else:
+                chunksymbols = dict((uniqid, classifier.GetSymbols(uniqid)) for uniqid in chunk)
+            jobs.append((state, self.context, shapefile.filepath, shapefile.usepyramid, chunk, customoptions, chunksymbols))
+        if not jobs:
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(min(PROCESSES, len(jobs)))
+        try:
+            for size, imgbytes in pool.imap(_RenderChunk, jobs):
+                self.renderer.PasteImage(PIL.Image.frombytes("RGBA", size, imgbytes))
+        finally:
+            pool.close()
+            pool.join()
     def _AddLayerInfo(self, layername, allclassifications):
         self.layers[layername] = allclassifications
     def _ViewRenderedShapefile(self):
         #finally open image in tkinter
-        if RENDERER == "tkinter":
+        if self.context.renderer == "tkinter":
             #if tkinter is the renderer then all that is needed is to run the mainloop
             self.renderer.RunTk()
         else:
+            _ImportTkinter()
             def ViewInTkinter():
                 #setup GUI
                 window = tk.Tk()
@@ -1877,8 +2564,8 @@ class _Renderer:
                 #embed image in a canvas
                 tkimg = self.renderer.GetImage()
                 screenwidth = window.winfo_screenwidth()
-                viewimgwidth,viewimgheight = (MAPWIDTH,MAPHEIGHT)
-                if MAPWIDTH >= screenwidth:
+                viewimgwidth,viewimgheight = (self.context.width,self.context.height)
+                if self.context.width >= screenwidth:
                     viewimgwidth,viewimgheight = (screenwidth,int(screenwidth/2.0))
                     resizedimg = self.renderer.img.resize((viewimgwidth,viewimgheight), PIL.Image.ANTIALIAS)
                     tkimg = PIL.ImageTk.PhotoImage(image=resizedimg)
@@ -1886,7 +2573,7 @@ class _Renderer:
                 canvas = tk.Canvas(window_frame, width=viewimgwidth, height=viewimgheight, bg="white")
                 canvas.pack()
                 x0,y0,x1,y1 = ( -int(viewimgwidth/50.0), int(viewimgwidth/50.0), viewimgwidth-int(viewimgwidth/50.0), viewimgheight+int(viewimgwidth/50.0) )
-                if MAPBACKGROUND:
+                if self.context.background:
                     canvas.create_rectangle(x0,y0,x1,y1, fill="Gray80", outline="") #this is the shadow
                 canvas.create_image(0,0, anchor="nw", image=tkimg)
                 canvas.create_rectangle(0,0,viewimgwidth,viewimgheight, fill="", outline=Color("black")) #this is the map outline edge
@@ -1931,10 +2618,11 @@ class _Renderer:
                 savebutton.place(x=5, y=5, anchor="nw")
                 #open window
                 window.mainloop()
+            import threading
             tkthread = threading.Thread(target=ViewInTkinter)
             tkthread.start()
     def _SaveRenderedShapefile(self, savepath):
-        if RENDERER == "tkinter":
+        if self.context.renderer == "tkinter":
             raise AttributeError("The Tkinter map renderer does not have a function to save the map as an image \
 due to the limited options of the Tkinter Canvas. If possible try using any of the other renderers instead")
         else:
@@ -1997,6 +2685,7 @@ the user wants to remember which shapefile was picked and hardcode it in the scr
 | --- | --- 
 | *text | an optional string to identify what purpose the shapefile was chosen for when printing the result as text.
 """
+    _ImportTkinter()
     tempwindow = tk.Tk()
     tempwindow.state("withdrawn")
     shapefilepath = tkFileDialog.askopenfilename(parent=tempwindow, filetypes=[("shapefile",".shp")], title="choose shapefile for "+text)
@@ -2043,6 +2732,7 @@ the user wants to remember which color was picked and hardcode it in the script.
 | *text | an optional string to identify what purpose the color was chosen for when printing the result as text.
 """
     def askcolor():
+        _ImportTkinter()
         tempwindow = tk.Tk()
         tempwindow.state("withdrawn")
         rgb,hexcolor = tkColorChooser.askcolor(parent=tempwindow, title="choose color for "+text) ;
@@ -2085,15 +2775,20 @@ Creates and returns a thematic layer instance (a visual representation of a geog
 
 | __option__ | __description__ 
 | --- | --- 
-| filepath | the path string of the geographic file to add, including the file extension.
+| filepath | the path string of the geographic file to add, including the file extension, or an already opened Shapefile instance, eg one that keeps its geometries in memory so it can be drawn on many maps without reading the file again.
+| *usepyramid | True if the layer should be drawn from the coarsest of the shapefile's pre-simplified pyramid levels that still looks the same at the zoom and size of the map, see the Shapefile usepyramid option. Has no effect if filepath is a Shapefile instance, in which case its own usepyramid option is used. False by default.
 | **customoptions | any series of named arguments of how to style the shapefile visualization (optional). Valid arguments are: fillcolor, fillsize (determines the circle size for point shapefiles, line width for line shapefiles, and has no effect for polygon shapefiles), outlinecolor, outlinewidth. For more info see the special section on how to stylize a layer. 
 """
-    def __init__(self, filepath, **customoptions):
-        self.filepath = filepath
-        self.fileobj = Shapefile(shapefilepath=filepath, progresstext="loading layer")
+    def __init__(self, filepath, usepyramid=False, **customoptions):
+        if isinstance(filepath, Shapefile):
+            self.fileobj = filepath
+            self.filepath = filepath.filepath
+        else:
+            self.filepath = filepath
+            self.fileobj = Shapefile(shapefilepath=filepath, progresstext="loading layer", usepyramid=usepyramid)
         self.customoptions = _CheckOptions(customoptions)
         self.classifier = None
-    def AddClassification(self, symboltype, valuefield, symbolrange=None, classifytype="equal interval", nrclasses=5):
+    def AddClassification(self, symboltype, valuefield, symbolrange=None, classifytype="equal interval", nrclasses=5, quantileerror=0.01):
         """
 Adds a classification/instruction to the layer on how to symbolize a particular symbol part (e.g. fillcolor) based on a shapefile's attribute values.
 
@@ -2104,6 +2799,7 @@ Adds a classification/instruction to the layer on how to symbolize a particular
 | symbolrange | a list or tuple of the range of symbol values that should be used for the symbol type being classified. You only need to assign the edge/breakpoints in an imaginary gradient of symbol values representing the transition from low to high value classes; the values in between will be interpolated if needed. The symbol values must be floats or integers when classifying a size-based symbol type, or hex color strings when classifying a color-based symbol type. | list or tuple
 | classifytype | a string with the name of the mathematical algorithm used to calculate the break points that separate the classes in the attribute values. | For valid classification type names see list below 
 | nrclasses | an integer or float for how many classes to subdivide the data and symbol values into. | Integer or float  
+| quantileerror | how far off the rank of each break may be when the classifytype is "approximate quantiles", as a fraction of the number of features, eg 0.01 means that about 1 percent of the features may end up in a neighbouring class (default is 0.01). Smaller values keep a bigger sample. | float between 0 and 1
 
 Valid names for the classifytype option are:  
 
@@ -2113,14 +2809,18 @@ Valid names for the classifytype option are:
   Makes sure that there are equally many features in each class, which means that features with the same attribute values can be found in multiple classes
 - __"equal interval"__  
   Classes are calculated so that each class only contains features that fall within a value range that is equally large for all classes
+- __"quantiles"__  
+  Like "equal classes" there are about equally many features in each class, but the breaks are values, so that features with the same attribute value are always in the same class, which can make some classes bigger than others. With numpyspeed enabled only the values at the breaks are searched for, without sorting all the values
+- __"approximate quantiles"__  
+  The same as "quantiles", but the breaks are estimated from a small sample of the values, kept in a KLL sketch that the values are streamed through straight from the dbf file, so that the classes of layers with many millions of features can be calculated with little memory and time, as the values themselves are never all kept. How close the breaks must be is set with the quantileerror option
 - __"natural breaks"__  
-  The Fisher-Jenks natural breaks algorithm, adapted from the Python implementation by Daniel J. Lewis (http://danieljlewis.org/files/2010/06/Jenks.pdf), is used to find 'natural' breaks in the shapefile dataset, i.e. where the value range within each class is as similar as possible and where the classes are as different as possible from each other. This algorithm is notorious for being slow for large datasets, so for datasets larger than 1000 records the calculation will be limited to a random sample of 1000 records (thanks to Carston Farmer for that idea, see: http://www.carsonfarmer.com/2010/09/adding-a-bit-of-classification-to-qgis/), and in addition that calculation will be performed 6 times, with the final break points being the sample mean of all the calculations. For large datasets this means that the natural breaks algorithm and the resultant map classification may turn out differently each time; however, the results should be somewhat consistent especially due to the random nature of the approach and the multiple sample means
+  The Fisher-Jenks natural breaks algorithm, adapted from the Python implementation by Daniel J. Lewis (http://danieljlewis.org/files/2010/06/Jenks.pdf), is used to find 'natural' breaks in the shapefile dataset, i.e. where the value range within each class is as similar as possible and where the classes are as different as possible from each other. The breaks are calculated exactly from all the records, so the same dataset is always classified the same way. Only the distinct values are compared and, with the divide and conquer speedup of the algorithm, each needs only a few comparisons, so even datasets of millions of records can be classified directly, especially when numpyspeed is enabled
 
 """
         if not self.classifier:
             #create classifier if this is the first classification being added
             self.classifier = _Classifier()
-        self.classifier.AddClassification(symboltype, valuefield, symbolrange=symbolrange, classifytype=classifytype, nrclasses=nrclasses)
+        self.classifier.AddClassification(symboltype, valuefield, symbolrange=symbolrange, classifytype=classifytype, nrclasses=nrclasses, quantileerror=quantileerror)
     def AssignTime(self, yearfield=0, monthfield=1, dayfield=1, hourfield=0, minutefield=0, secondfield=0):
         """
 Assigns a field to contain the time dimension of a shapefile. Used by the NewMap SaveTimeSequence method to determine the time of multiple shapefiles simultaneously.
@@ -2129,26 +2829,35 @@ Assigns a field to contain the time dimension of a shapefile. Used by the NewMap
         
         
 #RENDERING OPTIONS
-def SetRenderingOptions(renderer="not set", numpyspeed="not set", reducevectors="not set"):
+def SetRenderingOptions(renderer="not set", numpyspeed="not set", reducevectors="not set", geometrycache="not set", processes="not set"):
     """
 Sets certain rendering options that apply to all visualizations or map images.
 
 | __option__    | __description__
 | --- | --- 
-| *renderer | a string describing which Python module will be used for rendering. This means you need to have the specified module installed. Valid renderer values are 'aggdraw' (default), 'PIL', 'pycairo', 'tkinter'. Notes: If you have no renderers installed, then use Tkinter which comes with all Python installations, be aware that it is significantly slow, memory-limited, and cannot be used to save images. Currently PyCairo is not very well optimized, and is particularly slow to render line shapefiles. 
+| *renderer | a string describing which Python module will be used for rendering. This means you need to have the specified module installed. Valid renderer values are 'aggdraw', 'PIL', 'pycairo', 'tkinter', and the renderer module is imported right away. By default the first of these that is installed is used, which is only looked up when the first map is made. Notes: If you have no renderers installed, then use Tkinter which comes with all Python installations, be aware that it is significantly slow, memory-limited, and cannot be used to save images. Currently PyCairo is not very well optimized, and is particularly slow to render line shapefiles. 
 | *numpyspeed | specifies whether to use numpy to speed up shapefile reading and coordinate-to-pixel conversion. Must be True (default) or False.
-| *reducevectors | specifies whether to reduce the number of vectors to be rendered. This can speed up rendering time, but may lower the quality of the rendered image, especially for line shapefiles. Must be True or False (default).
+| *reducevectors | specifies whether to reduce the number of vectors to be rendered. This can speed up rendering time, but may lower the quality of the rendered image, especially for line shapefiles. With numpy this simplifies all layers that do not set their own simplify option with a tolerance of half a pixel, otherwise the coordinates are rounded to whole pixels. Must be True or False (default).
+| *geometrycache | a folder path where the geometries of every shapefile that is read will be cached in a flat binary format, so that later sessions can load them almost instantly instead of reading the shapefile again. A cache is only used as long as its shapefile has not changed, and can be shared by many processes at once. Requires numpy. Set to None to stop using the cache (default).
+| *processes | the number of processes to use for rendering the layers added to a map, each rendering its own share of the features before they are all combined into the final map image. Only works with the 'aggdraw' and 'PIL' renderers. Note that on Windows this requires that your script is protected by an if __name__ == "__main__": block. Must be a whole number of at least 1. Default is 1, which renders everything in the current process.
 """
+    if processes != "not set" and (isinstance(processes, bool) or not isinstance(processes, (int,long)) or processes < 1):
+        raise ValueError("processes must be a whole number of at least 1")
     if renderer != "not set":
         global RENDERER
-        RENDERER = renderer
+        RENDERER = _ImportRenderer(renderer)
     if numpyspeed != "not set":
         global NUMPYSPEED
         NUMPYSPEED = numpyspeed
-        _UpdateMapDims() #this bc map dimensions have to be recalculated to/from numpyspeed format
     if reducevectors != "not set":
         global REDUCEVECTORS
         REDUCEVECTORS = reducevectors
+    if geometrycache != "not set":
+        global GEOMETRYCACHE
+        GEOMETRYCACHE = geometrycache
+    if processes != "not set":
+        global PROCESSES
+        PROCESSES = processes
         
 #STYLE CUSTOMIZING
 def Color(basecolor, intensity="not specified", brightness="not specified", style=None):
@@ -2229,31 +2938,39 @@ This classifier is also needed to render a shapefile's legend.
 
 """
     def __init__(self):
+        #the values of each symboltype by feature id
         self.values = dict()
+        #the class index of each feature id for each symboltype, -1 for none, and the symbol of each class
         self.symbols = dict()
+        self.classsymbols = dict()
+        #the ids of the features whose values were streamed instead of added
+        self.streamedids = []
         self.allclassifications = []
         self.name = "unnamed classifier"
-    def AddClassification(self, symboltype, valuefield, symbolrange=None, classifytype="equal interval", nrclasses=5):        
+    def AddClassification(self, symboltype, valuefield, symbolrange=None, classifytype="equal interval", nrclasses=5, quantileerror=0.01):        
         if not symbolrange and classifytype!="categorical":
             raise TypeError("since you have chosen a gradual classification you must specify a range of symbol values to choose from")
         classification = dict([("symboltype",symboltype),
                                ("valuefield",valuefield),
                                ("symbolrange",symbolrange),
                                ("classifytype",classifytype),
-                               ("nrclasses",nrclasses) ])
+                               ("nrclasses",nrclasses),
+                               ("quantileerror",quantileerror) ])
         self.allclassifications.append(classification)
     def AddCustomClass(self, symboltype, valuefield, valuemin, valuemax):
         #first loop through existing classes and delete/reset maxmin values to make room for the new class value range
         #then create and insert class at appropriate position
         pass
     def AddValue(self, index, symboltype, value):
-        if self.values.get(index):
+        if symboltype in self.values:
             #add to dict if already exits
-            self.values[index][symboltype] = value
+            self.values[symboltype][index] = value
         else:
             #or create new dict if not
-            self.values[index] = dict([(symboltype, value)])
-        self.symbols[index] = dict()
+            self.values[symboltype] = dict([(index, value)])
+    def AddValues(self, indexes, symboltype, values):
+        #adds the values of many features at once, pairing each index with the value in the same position
+        self.values.setdefault(symboltype, dict()).update(itertools.izip(indexes, values))
     def CalculateClasses(self, classification):
         classifytype = classification.get("classifytype")
         #calculate classes based on classifytype
@@ -2269,15 +2986,72 @@ This classifier is also needed to render a shapefile's legend.
         elif classifytype.lower() == "natural breaks":
             self._NaturalBreaks(classification)
             self.__AssignMembershipByValue(classification)
+        elif classifytype.lower() == "quantiles":
+            self._Quantiles(classification)
+            self.__AssignMembershipByValue(classification)
+        elif classifytype.lower() == "approximate quantiles":
+            self._Quantiles(classification, approximate=True)
+            self.__AssignMembershipByValue(classification)
         else:
             raise TypeError("classifytype must be one of: ...")
+    def StreamClasses(self, classification, valuebatches):
+        #calculates approximate quantile classes from values that are read one batch at a time instead of being added, so that they are never all kept
+        #valuebatches is a function that returns a new iterator of (uniqids, values) batches each time it is called, since the values are gone through twice
+        symboltype = classification.get("symboltype")
+        nrclasses = int(classification.get("nrclasses"))
+        #initiate
+        self.__CustomSymbolRange(classification)
+        #first stream the values through a small sketch to find the breaks
+        sketch = classbreaks.QuantileSketch(classification.get("quantileerror"), NUMPYSPEED)
+        uniqids = []
+        for batchids, values in valuebatches():
+            sketch.Add(values)
+            uniqids.extend(batchids)
+        self.__QuantileClasses(classification, sketch.Breaks(nrclasses))
+        #then read the values again to find the class of each
+        classes = classification["classes"]
+        classindexes = [self.__ClassIndexes(classes, values) for batchids, values in valuebatches()]
+        if NUMPYSPEED:
+            classindexes = numpy.concatenate(classindexes) if classindexes else []
+        else:
+            classindexes = list(itertools.chain.from_iterable(classindexes))
+        self.__SetMembership(symboltype, classes, uniqids, classindexes)
+        self.streamedids = sorted(set(self.streamedids) | set(uniqids))
     def GetSymbol(self, uniqid, symboltype):
-        #for each class test value for membership
-        featuresymbols = self.symbols.get(uniqid)
-        if featuresymbols:
-            symbol = featuresymbols.get(symboltype)
+        #look up the class the feature was assigned to
+        membership = self.symbols.get(symboltype)
+        if membership is not None and uniqid < len(membership):
+            classindex = membership[uniqid]
+            if classindex >= 0:
+                return self.classsymbols[symboltype][classindex]
+    def GetSymbols(self, uniqid):
+        #the symbols of all the symboltypes the feature was successfully classified for
+        symbols = dict()
+        for symboltype in self.symbols:
+            symbol = self.GetSymbol(uniqid, symboltype)
             if symbol:
-                return symbol
+                symbols[symboltype] = symbol
+        return symbols
+    def GetIds(self):
+        #the sorted ids of all the features that were given or streamed values
+        uniqids = set(self.streamedids)
+        for values in self.values.itervalues():
+            uniqids.update(values)
+        return sorted(uniqids)
+    def GetIdsBySymbol(self, symboltype):
+        #the ids of all the features that were given values, from the biggest to the smallest size symbol of the symboltype, keeping features of the same size in id order
+        #features without a class for the symboltype come first
+        uniqids = self.GetIds()
+        classsizes = list(self.classsymbols[symboltype])
+        membership = self.symbols[symboltype]
+        if NUMPYSPEED:
+            uniqids = numpy.array(uniqids, dtype=int)
+            #class index -1 picks the last size, so an infinite size puts them first
+            sizes = numpy.array(classsizes + [float("inf")], dtype=numpy.float64)[numpy.asarray(membership)[uniqids]]
+            return uniqids[numpy.argsort(-sizes, kind="mergesort")].tolist()
+        else:
+            sizes = classsizes + [float("inf")]
+            return sorted(uniqids, key=lambda uniqid: -sizes[membership[uniqid]])
     def GetValues(self):
         return self.sortedvalues
     def GetClassifications(self):
@@ -2287,40 +3061,73 @@ This classifier is also needed to render a shapefile's legend.
     def __AssignMembershipByValue(self, classification):
         symboltype = classification.get("symboltype")
         classes = classification.get("classes")
-        #loop through values and assign class symbol to each for the specified symboltype
-        for uniqid, value in self.sortedvalues:
-            value = value[symboltype]
-            #for each class test value for membership
-            for eachclass in classes:
-                #membership true if within minmax range of that class
-                if value >= eachclass._min and value <= eachclass._max:
-                    #assign classsymbol
-                    self.symbols[uniqid][symboltype] = eachclass.classsymbol
-                    break
+        #the values can be in any order, so there is no need to sort them
+        uniqids = self.values[symboltype].keys()
+        values = self.values[symboltype].values()
+        self.__SetMembership(symboltype, classes, uniqids, self.__ClassIndexes(classes, values))
+    def __ClassIndexes(self, classes, values):
+        #the first class whose max is not below the value is the only one it can be a member of, if it is not below that class' min either
+        classmins = [eachclass._min for eachclass in classes]
+        classmaxs = [eachclass._max for eachclass in classes]
+        if NUMPYSPEED:
+            values = numpy.array(values, dtype=numpy.float64)
+            classindexes = numpy.searchsorted(classmaxs, values, side="left")
+            member = classindexes < len(classes)
+            member[member] = values[member] >= numpy.array(classmins)[classindexes[member]]
+            classindexes[~member] = -1
+        else:
+            classindexes = []
+            for value in values:
+                classindex = bisect.bisect_left(classmaxs, value)
+                if classindex < len(classes) and value >= classmins[classindex]:
+                    classindexes.append(classindex)
+                else:
+                    classindexes.append(-1)
+        return classindexes
     def __AssignMembershipByIndex(self, classification):
         symboltype = classification.get("symboltype")
         classes = classification.get("classes")
-        #loop through values and assign class symbol to each for the specified symboltype
-        for index, (uniqid, value) in enumerate(self.sortedvalues):
-            value = value[symboltype]
-            #for each class test value for membership
-            for eachclass in classes:
-                #membership true if within minmax range of that class
-                if index >= eachclass._min and index <= eachclass._max:
-                    #assign classsymbol
-                    self.symbols[uniqid][symboltype] = eachclass.classsymbol
-                    break
+        classmaxs = [eachclass._max for eachclass in classes]
+        uniqids = [uniqid for uniqid, value in self.sortedvalues]
+        #the classes are ranges of positions in the sorted values, each starting where the previous one ended
+        if NUMPYSPEED:
+            classindexes = numpy.searchsorted(classmaxs, numpy.arange(len(uniqids)), side="left")
+        else:
+            classindexes = [bisect.bisect_left(classmaxs, index) for index in xrange(len(uniqids))]
+        self.__SetMembership(symboltype, classes, uniqids, classindexes)
     def __AssignMembershipByUnique(self, classification):
         symboltype = classification.get("symboltype")
-        classes = (each for each in classification.get("classes"))
-        #loop through values and assign class symbol to each for the specified symboltype
-        oldvalue = None
-        for index, (uniqid, value) in enumerate(self.sortedvalues):
-            value = value[symboltype]
-            if value != oldvalue:
-                eachclass = next(classes)
-            self.symbols[uniqid][symboltype] = eachclass.classsymbol
-            oldvalue = value
+        classes = classification.get("classes")
+        uniqids = [uniqid for uniqid, value in self.sortedvalues]
+        values = [value for uniqid, value in self.sortedvalues]
+        #there is one class for each unique value, in sorted order
+        if NUMPYSPEED:
+            values = numpy.array(values, dtype=object)
+            classindexes = numpy.zeros(len(values), dtype=numpy.int32)
+            classindexes[1:] = numpy.cumsum(values[1:] != values[:-1])
+        else:
+            classindexes = []
+            classindex = -1
+            oldvalue = object()
+            for value in values:
+                if value != oldvalue:
+                    classindex += 1
+                classindexes.append(classindex)
+                oldvalue = value
+        self.__SetMembership(symboltype, classes, uniqids, classindexes)
+    def __SetMembership(self, symboltype, classes, uniqids, classindexes):
+        #remember the class index of each feature in one compact array indexed by feature id, so that looking up a symbol is just an array lookup
+        size = max(uniqids) + 1 if uniqids else 0
+        if NUMPYSPEED:
+            membership = numpy.empty(size, dtype=numpy.int32)
+            membership.fill(-1)
+            membership[numpy.array(uniqids, dtype=int)] = classindexes
+        else:
+            membership = array.array("i", [-1]) * size
+            for uniqid, classindex in itertools.izip(uniqids, classindexes):
+                membership[uniqid] = classindex
+        self.symbols[symboltype] = membership
+        self.classsymbols[symboltype] = [eachclass.classsymbol for eachclass in classes]
     def __CustomSymbolRange(self, classification):
         symbolrange = classification.get("symbolrange")
         nrclasses = classification.get("nrclasses")
@@ -2348,8 +3155,8 @@ Remember, with unique categories the symbolrange doesn't matter, and only works
         if not "color" in symboltype:
             raise TypeError("the categorical classification can only be used with color related symboltypes")
         #initiate
-        self.sortedvalues = sorted([(uniqid, value) for uniqid, value in self.values.iteritems()], key=operator.itemgetter(1))
-        sortedvalues = [value[symboltype] for uniqid,value in self.sortedvalues]
+        self.sortedvalues = sorted(self.values[symboltype].iteritems(), key=operator.itemgetter(1))
+        sortedvalues = [value for uniqid,value in self.sortedvalues]
         #populate classes
         classes = []
         #then set symbols
@@ -2373,8 +3180,8 @@ Remember, with unique categories the symbolrange doesn't matter, and only works
         #initiate
         self.__CustomSymbolRange(classification)
         symbolrange = classification["symbolrange"]
-        self.sortedvalues = sorted([(uniqid, value) for uniqid, value in self.values.iteritems()], key=operator.itemgetter(1))
-        sortedvalues = [value[symboltype] for uniqid,value in self.sortedvalues]
+        self.sortedvalues = sorted(self.values[symboltype].iteritems(), key=operator.itemgetter(1))
+        sortedvalues = [value for uniqid,value in self.sortedvalues]
         lowerbound = sortedvalues[0]
         upperbound = sortedvalues[-1]
         intervalsize = int( (upperbound-lowerbound)/float(nrclasses) )        
@@ -2402,8 +3209,8 @@ Remember, with unique categories the symbolrange doesn't matter, and only works
         #initiate
         self.__CustomSymbolRange(classification)
         symbolrange = classification["symbolrange"]
-        self.sortedvalues = sorted([(uniqid, value) for uniqid, value in self.values.iteritems()], key=operator.itemgetter(1))
-        sortedvalues = [value[symboltype] for uniqid,value in self.sortedvalues]
+        self.sortedvalues = sorted(self.values[symboltype].iteritems(), key=operator.itemgetter(1))
+        sortedvalues = [value for uniqid,value in self.sortedvalues]
         classsize = int( len(sortedvalues)/float(nrclasses) )
         #populate classes
         classmin = 0
@@ -2429,82 +3236,12 @@ Remember, with unique categories the symbolrange doesn't matter, and only works
         #initiate
         self.__CustomSymbolRange(classification)
         symbolrange = classification["symbolrange"]
-        self.sortedvalues = sorted([(uniqid, value) for uniqid, value in self.values.iteritems()], key=operator.itemgetter(1))
-        sortedvalues = [value[symboltype] for uniqid,value in self.sortedvalues]
-        lowerbound = sortedvalues[0]
-        upperbound = sortedvalues[-1]
-        def getJenksBreaks(dataList, numClass ):
-            "taken from http://danieljlewis.org/files/2010/06/Jenks.pdf"
-            dataList = sorted(dataList)
-            #in mat1, populate empty classlists of zeros
-            zeros = [0 for j in xrange(0,numClass+1)]
-            zeroandones = [0]
-            zeroandones.extend([1 for i in xrange(1,numClass+1)])
-            mat1 = [list(zeros), zeroandones]
-            mat1.extend([list(zeros) for i in xrange(2,len(dataList)+1)])
-            #...while classes in element 1 are set to 1, except for first class which remains zero
-            for i in xrange(1,numClass+1):
-                mat1[1][i] = 1
-            #in mat2, classes in element 0 and 1 are set to 0
-            mat2 = [list(zeros),list(zeros)]
-            #...while the classes in elements 2 and up are set to infinity, except for first class which is a zero
-            mat2classes = [0]
-            mat2classes.extend([float('inf') for i in xrange(1,numClass+1)])
-            mat2ext = [list(mat2classes) for j in xrange(2,len(dataList)+1)]
-            mat2.extend(mat2ext)
-            #then the main work (everything prior to this has been optimized/changed from original code)
-            v = 0.0
-            for l in xrange(2,len(dataList)+1):
-                s1 = 0.0
-                s2 = 0.0
-                w = 0.0
-                for m in xrange(1,l+1):
-                    i3 = l - m + 1
-                    val = float(dataList[i3-1])
-                    s2 += val * val
-                    s1 += val
-                    w += 1
-                    v = s2 - (s1 * s1) / w
-                    i4 = i3 - 1
-                    if i4 != 0:
-                        for j in xrange(2,numClass+1):
-                            if mat2[l][j] >= (v + mat2[i4][j - 1]):
-                                mat1[l][j] = i3
-                                mat2[l][j] = v + mat2[i4][j - 1]  
-                mat1[l][1] = 1
-                mat2[l][1] = v         
-            k = len(dataList)
-            kclass = []
-            for i in xrange(0,numClass+1):
-                kclass.append(dataList[0])
-            kclass[numClass] = float(dataList[-1])
-            countNum = numClass
-            while countNum >= 2:
-                #print "rank = " + str(mat1[k][countNum])
-                id = int((mat1[k][countNum]) - 2)
-                #print "val = " + str(dataList[id])
-                kclass[countNum - 1] = dataList[id]
-                k = int((mat1[k][countNum] - 1))
-                countNum -= 1
-            return kclass
+        self.sortedvalues = sorted(self.values[symboltype].iteritems(), key=operator.itemgetter(1))
+        sortedvalues = [value for uniqid,value in self.sortedvalues]
         #populate classes
-        highthresh = 1000
-        if len(sortedvalues) > highthresh:
-            #the idea of using random sampling for large datasets came from a blogpost by Carson Farmer. I just added the idea of calculating the breaks several times and using the sample means for the final break values.
-            #see: http://www.carsonfarmer.com/2010/09/adding-a-bit-of-classification-to-qgis/
-            allrandomsamples = []
-            samplestotake = 6
-            for _ in xrange(samplestotake):
-                randomsample = sorted(random.sample(sortedvalues, highthresh))
-                randomsample[0] = lowerbound
-                randomsample[-1] = upperbound
-                tempbreaks = getJenksBreaks(randomsample, nrclasses)
-                allrandomsamples.append(tempbreaks)
-            jenksbreaks = [sum(allbreakvalues)/float(len(allbreakvalues)) for allbreakvalues in itertools.izip(*allrandomsamples)]
-        else:
-            jenksbreaks = getJenksBreaks(sortedvalues, nrclasses)
+        jenksbreaks = classbreaks.NaturalBreaks(sortedvalues, nrclasses, NUMPYSPEED)
         breaksgen = (each for each in jenksbreaks[1:])
-        classmin = lowerbound
+        classmin = jenksbreaks[0]
         classes = []
         for index, classsymbol in enumerate(symbolrange):
             classmax = next(breaksgen)
@@ -2516,6 +3253,36 @@ Remember, with unique categories the symbolrange doesn't matter, and only works
             #prep for next
             classmin = classmax
         classification["classes"] = classes
+    def _Quantiles(self, classification, approximate=False):
+        symboltype = classification.get("symboltype")
+        nrclasses = int(classification.get("nrclasses"))
+        #initiate
+        self.__CustomSymbolRange(classification)
+        #only the values at the breaks are needed, so the values are not sorted
+        if approximate:
+            #stream the values through a small sketch
+            quantilebreaks = classbreaks.ApproximateQuantiles(self.values[symboltype].itervalues(), nrclasses, classification.get("quantileerror"), NUMPYSPEED)
+        elif NUMPYSPEED:
+            values = numpy.fromiter(self.values[symboltype].itervalues(), dtype=numpy.float64, count=len(self.values[symboltype]))
+            quantilebreaks = classbreaks.Quantiles(values, nrclasses, NUMPYSPEED)
+        else:
+            quantilebreaks = classbreaks.Quantiles(self.values[symboltype].itervalues(), nrclasses, NUMPYSPEED)
+        self.__QuantileClasses(classification, quantilebreaks)
+    def __QuantileClasses(self, classification, quantilebreaks):
+        symbolrange = classification["symbolrange"]
+        #populate classes
+        classmin = quantilebreaks[0]
+        classes = []
+        for index, classsymbol in enumerate(symbolrange):
+            classmax = quantilebreaks[index+1]
+            #determine min and max value
+            minvalue = classmin
+            maxvalue = classmax
+            #create and add class
+            classes.append( _SymbolClass(classmin, classmax, minvalue, maxvalue, index, classsymbol) )
+            #prep for next
+            classmin = classmax
+        classification["classes"] = classes
 
 
 def _CheckOptions(customoptions):
@@ -2534,19 +3301,27 @@ def _CheckOptions(customoptions):
         customoptions["outlinecolor"] = Color("black")
     if not customoptions.get("outlinewidth"):
         customoptions["outlinewidth"] = 0.09 #percent of map
+    if not customoptions.get("simplifymethod"):
+        customoptions["simplifymethod"] = "douglas-peucker"
+    if not customoptions.get("cullmode"):
+        customoptions["cullmode"] = "skip"
+    elif customoptions["cullmode"] not in ("skip","pixel"):
+        raise ValueError("cullmode must be one of: skip, pixel")
+    if customoptions.get("clip") is None:
+        customoptions["clip"] = True
     return customoptions
-def _CheckTextOptions(customoptions):
+def _CheckTextOptions(customoptions, context):
     customoptions = customoptions.copy()
     #text and font
     if not customoptions.get("textfont"):
         customoptions["textfont"] = "default"
     if not customoptions.get("textsize"):
-        customoptions["textsize"] = MAPWIDTH*0.0055 #equivalent to textsize 7
+        customoptions["textsize"] = context.width*0.0055 #equivalent to textsize 7
     else:
-        #input is percent textheight of MAPWIDTH
+        #input is percent textheight of the map width
         percentheight = customoptions["textsize"]
         #so first get pixel height
-        pixelheight = MAPWIDTH*percentheight
+        pixelheight = context.width*percentheight
         #to get textsize
         textsize = int(round(pixelheight*0.86))
         customoptions["textsize"] = textsize
@@ -2573,15 +3348,83 @@ def _CheckTextOptions(customoptions):
     if not customoptions.get("textboxopacity"):
         customoptions["textboxopacity"] = 0 #both fill and outline
     return customoptions
-def _ScreenToWorldCoords(xy):
+def _RenderChunk(job):
+    """
+Internal use only.
+Renders a chunk of shapes onto a transparent image in a separate process, and returns the image size and bytes.
+"""
+    state, context, filepath, usepyramid, shapeids, customoptions, symbols = job
+    #recreate the rendering options of the main process, and draw on a transparent copy of its map
+    globals().update(state)
+    global SHOWPROGRESS
+    SHOWPROGRESS = False
+    context.background = (0,0,0,0)
+    renderer = _Renderer(context)
+    shapefile = Shapefile(filepath, usepyramid=usepyramid)
+    shapefile.selection = _Selection(len(shapefile), ids=shapeids)
+    for shape in renderer._MapShapes(shapefile._IterInView(context.Extent(), context.PixelSize(), customoptions.get("cullsize"), customoptions.get("cullmode"), shapeids)):
+        options = customoptions
+        if symbols is not None:
+            #only render the shape if at least one of its classifications were successful
+            shapesymbols = symbols[shape.id]
+            if not shapesymbols:
+                continue
+            options = customoptions.copy()
+            options.update(shapesymbols)
+        renderer._RenderShape(shape, options)
+    if context.renderer == "aggdraw":
+        renderer.renderer.drawer.flush()
+    img = renderer.renderer.img
+    return img.size, img.tobytes()
+def _BatchWorkerSetup(state):
+    """
+Internal use only.
+Prepares a batch rendering process with the map settings and rendering options of the main process.
+"""
+    globals().update(state)
+    global SHOWPROGRESS, PROCESSES, _BATCHSHAPEFILES
+    SHOWPROGRESS = False
+    PROCESSES = 1
+    #the shapefiles opened by this process, kept open between jobs
+    _BATCHSHAPEFILES = dict()
+def _RenderBatchJob(job):
     """
 Internal use only.
-Converts a screen pixel coordinate to world coordinate, takes only a single pixel point
+Renders one job of a batch in a batch rendering process, reusing the shapefiles opened by earlier jobs.
+"""
+    return _RenderMapSpec(job, _BATCHSHAPEFILES)
+def _RenderMapSpec(job, shapefiles):
+    """
+Internal use only.
+Makes and saves the map described by a batch job, taking any shapefile that was already opened from the shapefiles dictionary and adding the ones it opens, and returns its savepath.
+"""
+    mapsettings = dict((key, job[key]) for key in ("width","height","x2x","y2y","background","renderer") if key in job)
+    newmap = NewMap(**mapsettings)
+    for layerspec in job.get("layers", []):
+        layerspec = layerspec.copy()
+        filepath = layerspec.pop("filepath")
+        usepyramid = layerspec.pop("usepyramid", False)
+        classifications = layerspec.pop("classifications", [])
+        shapefile = shapefiles.get((filepath, usepyramid))
+        if shapefile is None:
+            shapefile = shapefiles[(filepath, usepyramid)] = Shapefile(shapefilepath=filepath, progresstext="rendering", keepinmemory=True, usepyramid=usepyramid)
+        #any selection made for an earlier map should not carry over
+        shapefile.ClearSelection()
+        layer = Layer(shapefile, **layerspec)
+        for classification in classifications:
+            layer.AddClassification(**classification)
+        newmap.AddToMap(layer)
+    newmap.SaveMap(job["savepath"])
+    return job["savepath"]
+def _ScreenToWorldCoords(xy, context):
+    """
+Internal use only.
+Converts a screen pixel coordinate of the given map context to world coordinate, takes only a single pixel point
 """
     x,y = xy
-    relx = x/float(MAPWIDTH)
-    rely = y/float(MAPHEIGHT)
-    worldxy = (XMIN+relx*XWIDTH, YMIN+(1-rely)*YHEIGHT)
+    relx = x/float(context.width)
+    rely = y/float(context.height)
+    worldxy = (context.xmin+relx*context.xwidth, context.ymin+(1-rely)*context.yheight)
     return worldxy
 
 #QUICK TASKS
@@ -2615,11 +3458,21 @@ Quick task to save a shapefile to an image.
 class NewMap:
     """
 Creates and returns a new map based on previously defined mapsettings.
+Each map keeps its own copy of these settings, so changing them afterwards only affects the maps that are made after that, and several maps can be drawn at the same time in different threads.
+Any of the mapsettings can also be given directly to a single map, overriding the previously defined ones just for that map.
 
-*Takes no arguments*
-"""
-    def __init__(self):
-        self.renderer = _Renderer()
+| __option__ | __description__ 
+| --- | --- 
+| *width | the pixel width of the map image, an integer (default is the width set with SetMapDimensions).
+| *height | the pixel height of the map image, an integer (default is the height set with SetMapDimensions).
+| *x2x | a two-item list of the x-extents to zoom the map to, in longitude format (default is the zoom set with SetMapZoom).
+| *y2y | a two-item list of the y-extents to zoom the map to, in latitude format (default is the zoom set with SetMapZoom).
+| *background | the hex color of the map background, or None for transparent (default is the background set with SetMapBackground).
+| *renderer | the name of the renderer to draw the map with (default is the renderer set with SetRenderingOptions).
+"""
+    def __init__(self, width=None, height=None, x2x=None, y2y=None, background="not specified", renderer=None):
+        self.context = _MapContext(width, height, x2x, y2y, background, renderer)
+        self.renderer = _Renderer(self.context)
     def AddShape(self, shapeobj, **customoptions):
         """
 This adds an individual shape instead of an entire file.
@@ -2645,7 +3498,7 @@ Add and render a layer instance to the map.
             self._AutoClassifyShapefile(layer)
         else:
             self.renderer._RenderLayer(layer)
-    def AddLegend(self, layer, upperleft, bottomright, legendtitle="not specified", boxcolor=Color("gray",brightness=0.8), boxoutlinecolor=Color("black"), boxoutlinewidth=0.08):
+    def AddLegend(self, layer, upperleft, bottomright, legendtitle="not specified", boxcolor="not specified", boxoutlinecolor="not specified", boxoutlinewidth=0.08):
         """
 Draws a basic legend for a given layer.
 
@@ -2660,6 +3513,12 @@ Draws a basic legend for a given layer.
 | boxoutlinewidth | the thickness of the boxoutline color relative to the box size, so 0.10 is 10 percent of the box size
 """
         classifier = layer.classifier
+        context = self.renderer._DrawingContext()
+        #default colors are only made here so that the colour module is not needed when importing geovis
+        if boxcolor == "not specified":
+            boxcolor = Color("gray",brightness=0.8)
+        if boxoutlinecolor == "not specified":
+            boxoutlinecolor = Color("black")
         #first set positions
         relx1,rely1 = upperleft
         relx2,rely2 = bottomright
@@ -2726,9 +3585,9 @@ Draws a basic legend for a given layer.
                     if symbolizer:
                         if symbolizer == "circle":
                             tempoptions = _CheckOptions(dict(fillsize=symbol, fillcolor=None, symbolizer=symbolizer))
-                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(MAPHEIGHT)
+                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(context.height)
                             temprelx,temprely = (leftpart.center[0], rely+relyincr*len(classes)-symbolheight/2.0)
-                            xy = [[_ScreenToWorldCoords((temprelx*MAPWIDTH, temprely*MAPHEIGHT))]]
+                            xy = [[_ScreenToWorldCoords((temprelx*context.width, temprely*context.height), context)]]
                             shape = _PyShpShape(shapefile=None, fieldnames=None, uniqid=None, coords=xy, shapetype="point")
                             self.renderer._RenderShape(shape, tempoptions)
                             rely -= relyincr
@@ -2740,9 +3599,9 @@ Draws a basic legend for a given layer.
                             self.AddText(rightpart.center[0], rely+relyincr*(len(classes)+1)-symbolheight, text=textlabel, textsize=0.0111)
                         elif symbolizer == "square":
                             tempoptions = _CheckOptions(dict(fillsize=symbol, fillcolor=None, symbolizer=symbolizer))
-                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(MAPHEIGHT)
+                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(context.height)
                             temprelx,temprely = (leftpart.center[0], rely+relyincr*len(classes)-symbolheight/2.0)
-                            xy = [[_ScreenToWorldCoords((temprelx*MAPWIDTH, temprely*MAPHEIGHT))]]
+                            xy = [[_ScreenToWorldCoords((temprelx*context.width, temprely*context.height), context)]]
                             shape = _PyShpShape(shapefile=None, fieldnames=None, uniqid=None, coords=xy, shapetype="point")
                             self.renderer._RenderShape(shape, tempoptions)
                             rely -= relyincr
@@ -2754,9 +3613,9 @@ Draws a basic legend for a given layer.
                             self.AddText(rightpart.center[0], rely+relyincr*(len(classes)+1)-symbolheight, text=textlabel, textsize=0.0111)
                         elif symbolizer == "pyramid":
                             tempoptions = _CheckOptions(dict(fillsize=symbol, fillcolor=None, symbolizer=symbolizer))
-                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(MAPHEIGHT)
+                            symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(context.height)
                             temprelx,temprely = (leftpart.center[0], rely+relyincr*len(classes))
-                            xy = [[_ScreenToWorldCoords((temprelx*MAPWIDTH, temprely*MAPHEIGHT))]]
+                            xy = [[_ScreenToWorldCoords((temprelx*context.width, temprely*context.height), context)]]
                             shape = _PyShpShape(shapefile=None, fieldnames=None, uniqid=None, coords=xy, shapetype="point")
                             self.renderer._RenderShape(shape, tempoptions)
                             rely -= relyincr
@@ -2768,9 +3627,9 @@ Draws a basic legend for a given layer.
                             self.AddText(rightpart.center[0], rely+relyincr*(len(classes)+1)-symbolheight, text=textlabel, textsize=0.0111)
                     else:
                         tempoptions = _CheckOptions(dict(fillsize=symbol, fillcolor=None, symbolizer=symbolizer))
-                        symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(MAPHEIGHT)
+                        symbolheight = self.renderer._RelSizesToPixels(tempoptions)["fillsize"]/float(context.height)
                         temprelx,temprely = (leftpart.center[0], rely+relyincr*len(classes)-symbolheight/2.0)
-                        xy = [[_ScreenToWorldCoords((temprelx*MAPWIDTH, temprely*MAPHEIGHT))]]
+                        xy = [[_ScreenToWorldCoords((temprelx*context.width, temprely*context.height), context)]]
                         shape = _PyShpShape(shapefile=None, fieldnames=None, uniqid=None, coords=xy, shapetype="point")
                         self.renderer._RenderShape(shape, tempoptions)
                         rely -= relyincr
@@ -2813,7 +3672,7 @@ Writes text on the map.
 | text | the text to add to the map, as a string
 | **customoptions | any number of named arguments to style the text
 """
-        textoptions = _CheckTextOptions(textoptions)
+        textoptions = _CheckTextOptions(textoptions, self.renderer._DrawingContext())
         self.renderer._RenderText(relx, rely, text, textoptions)
     def DrawRectangle(self, upperleft, bottomright, **customoptions):
         """
@@ -2910,6 +3769,8 @@ Still experimental: Currently creates new map for each time period (so previous
         shapefile = layer.fileobj
         classifier.name = shapefile.filename
         classifier.symbolizer = options.get("symbolizer")
+        view = self.renderer.context.Extent()
+        pixelsize = self.renderer.context.PixelSize()
         #exclude values if specified
         excludequery = options.get("excludequery")
         if excludequery:
@@ -2917,49 +3778,86 @@ Still experimental: Currently creates new map for each time period (so previous
         #classify values into symbols
         shapefile.progresstext = "classifying"
         #first populate values from classification fields
-        for eachshape in shapefile:
-            row = dict(zip(shapefile.fieldnames, eachshape.GetAttributes()))
-            for classification in allclassifications:
-                field_to_classify = classification["valuefield"]
-                attributevalue = row[field_to_classify]
-                classifier.AddValue(eachshape.id, classification["symboltype"], attributevalue)
+        #the features in view can usually be found without reading their shapes, so this only reads the dbf file and the shapes are read just once when rendering
+        #approximate quantiles are streamed from the dbf file afterwards so their values are never all kept
+        streamed = [classification for classification in allclassifications if classification["classifytype"].lower() == "approximate quantiles"]
+        kept = [classification for classification in allclassifications if classification not in streamed]
+        fieldnames = []
+        for classification in kept:
+            if classification["valuefield"] not in fieldnames:
+                fieldnames.append(classification["valuefield"])
+        #blank numbers are read as blank strings row by row, but are classified as 0 just like in the numpy columns
+        fieldtypes = [fieldinfo[1] for fieldname in fieldnames for fieldinfo in shapefile.shapefile.fields if fieldinfo[0] == fieldname]
+        uniqids = shapefile._IdsInView(view)
+        if uniqids is not None and NUMPYSPEED:
+            #leave out deleted records up front, the same ones that the rows leave out below
+            uniqids = numpy.asarray(uniqids, dtype=int)
+            uniqids = uniqids[shapefile.shapefile.recordArray(["DeletionFlag"])["DeletionFlag"][uniqids] == " "].tolist()
+        if uniqids is None:
+            #eg when zoomed in without numpyspeed, the shapes have to be read to know which ones are in view, so their rows are taken from the same pass
+            uniqids, rows = [], []
+            for eachshape in shapefile._IterInView(view, pixelsize):
+                uniqids.append(eachshape.id)
+                rows.append(shapefile._QueryRow(eachshape._GetRow(fieldnames), fieldtypes))
+        elif not kept:
+            rows = []
+        elif NUMPYSPEED:
+            #decode only the classification fields, one whole column at a time, and add the values of the features in view a batch at a time
+            columns = dict((fieldname, shapefile.GetColumn(fieldname)) for fieldname in fieldnames)
+            ids = numpy.asarray(uniqids, dtype=int)
+            for start in xrange(0, len(ids), 100000):
+                batchids = ids[start:start+100000]
+                batchidlist = batchids.tolist()
+                for classification in kept:
+                    classifier.AddValues(batchidlist, classification["symboltype"], columns[classification["valuefield"]][batchids].tolist())
+            rows = None
+        else:
+            #only parse the fields that are being classified, reading the rows in one sequential scan if all of them are needed
+            if len(uniqids) == len(shapefile):
+                rawrecords = shapefile.shapefile.iterRawRecords()
+            else:
+                rawrecords = shapefile.shapefile.iterRawRecords(indices=uniqids)
+            rows = (shapefile._QueryRow(shapefile.shapefile.decodeRecord(rawrecord, fieldnames), fieldtypes) for rawrecord in rawrecords)
+        if kept and rows is not None:
+            ROWLOOP = messages.ProgressReport(itertools.izip(uniqids, rows), text=shapefile.progresstext+" "+shapefile.filename, shellreport=shapefile._ShellReport(), countmethod="manual", genlength=len(uniqids))
+            for uniqid, row in ROWLOOP:
+                ROWLOOP.Increment()
+                if row is None:
+                    #deleted record
+                    continue
+                row = dict(itertools.izip(fieldnames, row))
+                for classification in kept:
+                    attributevalue = row[classification["valuefield"]]
+                    classifier.AddValue(uniqid, classification["symboltype"], attributevalue)
         #then calculate classes
         for classification in allclassifications:
-            classifier.CalculateClasses(classification)
+            if classification in streamed:
+                valuebatches = lambda valuefield=classification["valuefield"]: shapefile._IterValueBatches(uniqids, valuefield)
+                classifier.StreamClasses(classification, valuebatches)
+            else:
+                classifier.CalculateClasses(classification)
         #then send classifier to renderer so can remember its layer and legend properties
         self.renderer._AddLayerInfo(shapefile.filename, classifier)
         ####RENDER THAT CLASSIFIED SHAPEFILE
         #loop sorted/classified ids and get and render each
         shapefile.progresstext = "rendering shapes"
-        for shape in shapefile:
-            classificationsuccess = False
-            #populate a custom options dict based on classifications
-            for classification in allclassifications:
-                symboltype = classification["symboltype"]
-                #retrieve class color for each shape id
-                symbol = classifier.GetSymbol(shape.id, symboltype)
-                if symbol:
-                    options[symboltype] = symbol
-                    classificationsuccess = True #as long as at least one classification was successful it will display it later, but only those shapes that were not excluded will be given symbols based on classification algorithm (the rest will only use default)
-            #render only if at least one of the options were successful
-            if classificationsuccess:
-                self.renderer._RenderShape(shape, options)
-
-        ####OR RENDER IN SORTED ORDER (NEED TO ADD CUSTOM SHAPE RENDERING ORDER AND SPECIAL SHAPE CACHING TO FILE BEFORE USING THIS BC GRABBING ONE SHAPE AT A TIME IS CURRENTLY QUITE SLOW)
-        "finish this later..."
-##        #loop sorted/classified ids and get and render each
-##        for uniqid, value in messages.ProgressReport(classifier.GetValues(), text="rendering shapes"):
-##            #populate a custom options dict based on classifications
-##            for classification in allclassifications:
-##                symboltype = classification["symboltype"]
-##                #retrieve class color for each shape id
-##                symbol = classifier.GetSymbol(uniqid, symboltype)
-##                if symbol:
-##                    options[symboltype] = symbol
-##            #render only if at least one of the options were successful
-##            if options:
-##                shape = shapefile.GetShape(uniqid)
-##                self.renderer._RenderShape(shape, options)
+        order = self.renderer._RenderOrder(shapefile, options, classifier)
+        if self.renderer._CanRenderInParallel(shapefile):
+            self.renderer._RenderInParallel(shapefile, order or classifier.GetIds(), options, classifier=classifier)
+        else:
+            for shape in self.renderer._MapShapes(shapefile._IterInView(view, pixelsize, options.get("cullsize"), options.get("cullmode"), order)):
+                classificationsuccess = False
+                #populate a custom options dict based on classifications
+                for classification in allclassifications:
+                    symboltype = classification["symboltype"]
+                    #retrieve class color for each shape id
+                    symbol = classifier.GetSymbol(shape.id, symboltype)
+                    if symbol:
+                        options[symboltype] = symbol
+                        classificationsuccess = True #as long as at least one classification was successful it will display it later, but only those shapes that were not excluded will be given symbols based on classification algorithm (the rest will only use default)
+                #render only if at least one of the options were successful
+                if classificationsuccess:
+                    self.renderer._RenderShape(shape, options)
 
         ####FINALLY ADD LABELS FOR THAT SHAPEFILE
         "need more work here........."
@@ -2982,20 +3880,78 @@ Still experimental: Currently creates new map for each time period (so previous
 ##                self.AddText(relx, rely, str(eachshape.id), **textoptions)
 
 
+#BATCH RENDERING
+def RenderBatch(jobs, workers=None):
+    """
+Renders and saves many maps at once, spread over a number of worker processes, and returns the list of their savepaths in the same order as the jobs.
+Each worker opens a shapefile the first time one of its jobs needs it, and then keeps it open, with its geometries and classified attribute columns in memory, for the rest of the jobs. This avoids reading the same shapefiles again for every map, which is what takes most of the time when making many small maps of the same few shapefiles one at a time with NewMap. If the geometrycache rendering option is set the workers share the cached geometries instead of each keeping their own copy in memory.
+The maps use the current map settings and rendering options for anything a job does not specify.
+Note that on Windows this requires that your script is protected by an if __name__ == "__main__": block.
+
+| __option__ | __description__ 
+| --- | --- 
+| jobs | a list of maps to render, each a dictionary with the keys described below.
+| *workers | the number of worker processes (default is the number of CPUs). If 1, the maps are rendered one after another in the current process, still keeping the shapefiles open between maps.
+
+Each job dictionary can have the following keys:
+
+| __key__ | __description__ 
+| --- | --- 
+| savepath | the path string of where to save the map image, including the image type extension (required).
+| *layers | a list of the layers to draw on the map, from bottom to top. Each layer is a dictionary with a "filepath" key of the path string of the shapefile, an optional "classifications" key of a list of dictionaries with the arguments to pass to the Layer AddClassification method, and any other keys as the named arguments of how to style the layer, as given to Layer.
+| *width | the pixel width of the map image.
+| *height | the pixel height of the map image.
+| *x2x | a two-item list of the x-extents to zoom the map to, in longitude format.
+| *y2y | a two-item list of the y-extents to zoom the map to, in latitude format.
+| *background | the hex color of the map background, or None for transparent.
+| *renderer | the name of the renderer to draw the map with. 
+
+For instance, to save a map of the population of each region:
+
+    jobs = []
+    for name,x2x,y2y in regions:
+        layer = dict(filepath="countries.shp", classifications=[dict(symboltype="fillcolor", valuefield="POP", symbolrange=[Color("white"),Color("red")])])
+        jobs.append(dict(savepath=name+".png", layers=[layer], width=400, height=200, x2x=x2x, y2y=y2y))
+    RenderBatch(jobs, workers=4)
+"""
+    global RENDERER
+    import multiprocessing
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(jobs) <= 1:
+        shapefiles = dict()
+        return [_RenderMapSpec(job, shapefiles) for job in jobs]
+    #settle the map settings that are looked up when the first map is made, so the workers do not each have to
+    _MapDimsFromScreen()
+    if RENDERER is None:
+        RENDERER = _ImportRenderer()
+    state = dict((name, globals()[name]) for name in ("NUMPYSPEED","REDUCEVECTORS","GEOMETRYCACHE","RENDERER","MAPSIZEFROMSCREEN","MAPWIDTH","MAPHEIGHT","MAPBACKGROUND","PROJ_XYRATIO",
+                                                      "XMIN","XMAX","YMIN","YMAX","XWIDTH","YHEIGHT","XOFFSET","YOFFSET"))
+    workers = min(workers, len(jobs))
+    #hand out a few jobs at a time, which is faster when there are many small maps
+    chunksize = max(1, len(jobs) // (workers*4))
+    pool = multiprocessing.Pool(workers, _BatchWorkerSetup, (state,))
+    try:
+        savepaths = list(pool.imap(_RenderBatchJob, jobs, chunksize))
+    finally:
+        pool.close()
+        pool.join()
+    return savepaths
+
 #MAP SPECS
 def SetMapDimensions(width, height):
     """
-Sets the width and height of the next map image. At startup the width and height are set to the dimensions of the window screen.
+Sets the width and height of the next map image. By default the first map is made as big as the window screen, or 1600 by 800 pixels if there is no screen. The default size can also be set as "WIDTHxHEIGHT" with the GEOVIS_MAPSIZE environment variable, in which case the screen is never looked at.
 
 | __option__ | __description__ 
 | --- | --- 
 | width | the pixel width of the final map image to be rendered, an integer.
 | height | the pixel height of the final map image to be rendered, an integer.
 """
-    global MAPWIDTH, MAPHEIGHT
+    global MAPWIDTH, MAPHEIGHT, MAPSIZEFROMSCREEN
     MAPWIDTH = width
     MAPHEIGHT = height
-    _UpdateMapDims()
+    MAPSIZEFROMSCREEN = False
 def SetMapBackground(mapbackground):
     """
 Sets the mapbackground of the next map to be made. At startup the mapbackground is transparent (None).
@@ -3016,29 +3972,8 @@ Zooms the map to the given mapextents.
 | y2y | a two-item list of the y-extents in latitude format, from the bottommost to the topmost latitude, default is full extent [-90, 90]
 """
     global XMIN,XMAX,YMIN,YMAX
-    XMIN,XMAX = (x2x[0],x2x[1])
-    YMIN,YMAX = (y2y[0],y2y[1])
     global XWIDTH,YHEIGHT,XOFFSET,YOFFSET
-    inxwidth = XMAX-XMIN
-    inyheight = YMAX-YMIN
-    #SUMTIN WEIRD, BOTH ZOOMS NEED TO BE TRUE AND MAYBE CHANGED, NOT JUST ONE, SO MAYBE ALWAYS TIMES UP AND NEVER DIVIDE DOWN
-    if inxwidth > inyheight*PROJ_XYRATIO:
-        #automatically override xlimits to be centered middle of given extents, but with a new width thats proportional to the projection widt/height ratio
-        midx = sum(x2x)/float(len(x2x))
-        halfxwidth = inyheight/PROJ_XYRATIO/2.0
-        XMIN,XMAX = (midx-halfxwidth, midx+halfxwidth)
-    elif inyheight*PROJ_XYRATIO > inxwidth:
-        #automatically override ylimits to be centered middle of given extents, but with a new height thats proportional to the projection widt/height ratio
-        midy = sum(y2y)/float(len(y2y))
-        halfyheight = inxwidth/PROJ_XYRATIO/2.0
-        YMIN,YMAX = (midy-halfyheight, midy+halfyheight)
-    nw = (-1*min(x2x),max(y2y))
-    #cant use old width/height from original input but instead recalculate using the updated X/YMAX/MIN bc they were changed to preserve a certain ratio
-    XWIDTH = XMAX-XMIN
-    YHEIGHT = YMAX-YMIN
-    XOFFSET = nw[0]
-    YOFFSET = nw[1]
-    _UpdateMapDims()
+    XMIN,XMAX,YMIN,YMAX,XWIDTH,YHEIGHT,XOFFSET,YOFFSET = _ZoomExtents(x2x, y2y)
 
 
 ### END OF SCRIPT ###
@@ -0,0 +1,296 @@
+#IMPORTS
+import itertools, math, random, bisect
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+
+
+#FUNCTIONS
+def NaturalBreaks(values, nrclasses, numpyspeed=True):
+    """
+Returns the Jenks natural breaks of a sequence of numbers, as a list of the lowest value followed by the highest value of each class. The classes are chosen so that the values within each class are as close to each other as possible, measured as the sum of squared differences from the class means. The breaks are exact and always the same for the same values, found by dynamic programming over all the distinct values, where the divide and conquer optimization only has to look at a few possible class starts for each value. That makes it fast enough to classify millions of values directly.
+
+| __options__ | __description__
+| --- | ---
+| values | a sequence of numbers, in any order. Blank values count as 0
+| nrclasses | the number of classes to split the values into. If there are fewer distinct values than classes, the last classes are empty and end at the highest value
+| numpyspeed | whether to look at all the possible class starts of many values at once using numpy (default is True)
+"""
+    if numpyspeed:
+        uniques, counts = numpy.unique(_NumberArray(values), return_counts=True)
+        starts = _NumpyClassStarts(uniques, counts, min(nrclasses, len(uniques)))
+        uniques = uniques.tolist()
+    else:
+        uniques = []
+        counts = []
+        for value, group in itertools.groupby(sorted(_Number(value) for value in values)):
+            uniques.append(value)
+            counts.append(float(sum(1 for _ in group)))
+        starts = _ClassStarts(uniques, counts, min(nrclasses, len(uniques)))
+    breaks = [uniques[0]] + [uniques[start-1] for start in starts[1:]] + [uniques[-1]]
+    breaks.extend([uniques[-1]] * (nrclasses + 1 - len(breaks)))
+    return breaks
+
+def Quantiles(values, nrclasses, numpyspeed=True):
+    """
+Returns the exact quantile breaks of a sequence of numbers, as a list of the lowest value followed by the highest value of each class, where each class holds as close to the same number of values as possible. Values equal to a break belong to the lower class, so many equal values can make some classes bigger than others. Only the values at the breaks are searched for, which with numpy takes the time of about one pass over the values instead of sorting them all.
+
+| __options__ | __description__
+| --- | ---
+| values | a sequence of numbers, in any order. Blank values count as 0
+| nrclasses | the number of classes to split the values into
+| numpyspeed | whether to find the breaks with numpy's partition instead of sorting the values (default is True)
+"""
+    if numpyspeed:
+        values = _NumberArray(values)
+    else:
+        values = sorted(_Number(value) for value in values)
+    #the position of the last value of each class if the values were sorted
+    count = len(values)
+    positions = [0] + [max(0, nrclass*count//nrclasses - 1) for nrclass in xrange(1, nrclasses)] + [count-1]
+    if numpyspeed:
+        return [float(value) for value in numpy.partition(values, positions)[positions]]
+    else:
+        return [float(values[position]) for position in positions]
+
+def ApproximateQuantiles(values, nrclasses, error=0.01, numpyspeed=True, batchsize=100000):
+    """
+Returns approximate quantile breaks of a sequence of numbers in the same way as Quantiles, but reads the values one batch at a time into a QuantileSketch, so that the values can come from a generator and only a small sample of them is ever kept in memory. The lowest and highest values are exact.
+
+| __options__ | __description__
+| --- | ---
+| values | an iterable of numbers, in any order. Blank values count as 0
+| nrclasses | the number of classes to split the values into
+| error | how far off the rank of each break may be, as a fraction of the number of values (default is 0.01)
+| numpyspeed | whether to keep and compact the sample in numpy arrays (default is True)
+| batchsize | how many values to read at a time (default is 100000)
+"""
+    sketch = QuantileSketch(error, numpyspeed)
+    if hasattr(values, "__len__"):
+        #lists and arrays can be sliced without copying each value
+        for start in xrange(0, len(values), batchsize):
+            sketch.Add(values[start:start+batchsize])
+    else:
+        values = iter(values)
+        while True:
+            batch = list(itertools.islice(values, batchsize))
+            if not batch:
+                break
+            sketch.Add(batch)
+    return sketch.Breaks(nrclasses)
+
+
+#CLASSES
+class QuantileSketch:
+    """
+A KLL sketch that estimates the quantiles of a stream of numbers from a small sample of them. The values are added to the lowest of a stack of buffers, and whenever a buffer is full it is sorted and every other value is moved up to the next buffer, where each value stands for twice as many. The higher buffers are larger, so the sample only grows with the logarithm of the number of values.
+
+| __options__ | __description__
+| --- | ---
+| error | how far off the rank of an estimated quantile may be, as a fraction of the number of values (default is 0.01)
+| numpyspeed | whether to keep and compact the buffers as numpy arrays (default is True)
+"""
+    def __init__(self, error=0.01, numpyspeed=True):
+        #the size of the largest buffer needed for the error, with some margin over the bound in the KLL paper
+        self.buffersize = max(8, int(math.ceil(3.0 / error)))
+        self.numpyspeed = numpyspeed
+        #which half of a buffer is moved up is picked at random, but always the same way so the same values give the same breaks
+        self.random = random.Random(0)
+        self.buffers = []
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._Grow()
+    def Add(self, values):
+        """
+Adds a sequence of numbers to the sketch, where blank values count as 0.
+"""
+        if self.numpyspeed:
+            values = _NumberArray(values).ravel()
+            if not len(values):
+                return
+            self.buffers[0] = numpy.concatenate((self.buffers[0], values))
+            low, high = float(values.min()), float(values.max())
+        else:
+            values = [_Number(value) for value in values]
+            if not values:
+                return
+            self.buffers[0].extend(values)
+            low, high = min(values), max(values)
+        self.count += len(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self._Compact()
+    def Quantile(self, fraction):
+        """
+Returns the estimated value below which the given fraction of the values lie.
+"""
+        return self._AtRanks([fraction * self.count])[0]
+    def Breaks(self, nrclasses):
+        """
+Returns the estimated quantile breaks as a list of the lowest value followed by the highest value of each class, in the same way as the Quantiles function.
+"""
+        if not self.count:
+            raise ValueError("cannot calculate the breaks of an empty sketch")
+        ranks = [nrclass*self.count//nrclasses - 1 for nrclass in xrange(1, nrclasses)]
+        return [self.min] + [min(max(value, self.min), self.max) for value in self._AtRanks(ranks)] + [self.max]
+    #INTERNAL USE ONLY
+    def _Grow(self):
+        if self.numpyspeed:
+            self.buffers.append(numpy.empty(0, dtype=numpy.float64))
+        else:
+            self.buffers.append([])
+    def _Capacity(self, level):
+        #each buffer below the top is two thirds the size of the one above it
+        return int(math.ceil(self.buffersize * (2/3.0) ** (len(self.buffers) - level - 1))) + 1
+    def _Compact(self):
+        level = 0
+        while level < len(self.buffers):
+            buff = self.buffers[level]
+            if len(buff) < self._Capacity(level):
+                level += 1
+                continue
+            if level == len(self.buffers) - 1:
+                self._Grow()
+            #keep the odd one out, and move every other of the rest up, starting from a random one of the first two
+            offset = self.random.randint(0, 1)
+            if self.numpyspeed:
+                buff = numpy.sort(buff)
+                even = len(buff) - len(buff) % 2
+                self.buffers[level+1] = numpy.concatenate((self.buffers[level+1], buff[offset:even:2]))
+                self.buffers[level] = buff[even:]
+            else:
+                buff.sort()
+                even = len(buff) - len(buff) % 2
+                self.buffers[level+1].extend(buff[offset:even:2])
+                self.buffers[level] = buff[even:]
+            #the capacities shrink as the stack grows, so start over from the bottom
+            level = 0
+    def _AtRanks(self, ranks):
+        #the values of the sample at the given ranks, counting each value as many times as it stands for
+        if self.numpyspeed:
+            values = numpy.concatenate(self.buffers)
+            weights = numpy.concatenate([numpy.repeat(2.0**level, len(buff)) for level, buff in enumerate(self.buffers)])
+            order = numpy.argsort(values, kind="mergesort")
+            values, cumweights = values[order], numpy.cumsum(weights[order])
+            positions = numpy.searchsorted(cumweights, numpy.asarray(ranks, dtype=numpy.float64), side="right")
+            return values[numpy.minimum(positions, len(values)-1)].tolist()
+        else:
+            sample = sorted((value, 2.0**level) for level, buff in enumerate(self.buffers) for value in buff)
+            cumweights = []
+            total = 0.0
+            for value, weight in sample:
+                total += weight
+                cumweights.append(total)
+            return [sample[min(bisect.bisect_right(cumweights, rank), len(sample)-1)][0] for rank in ranks]
+
+
+#INTERNAL USE ONLY
+def _Number(value):
+    "the value as a float, where blank numbers, which the dbf reader gives as blank strings, count as 0 just like in the numpy columns"
+    if isinstance(value, basestring) and not value.strip():
+        return 0.0
+    return float(value)
+
+def _NumberArray(values):
+    "the values as a numpy float array, with blank numbers as 0"
+    if not hasattr(values, "__len__"):
+        values = list(values)
+    try:
+        return numpy.asarray(values, dtype=numpy.float64)
+    except ValueError:
+        return numpy.array([_Number(value) for value in values], dtype=numpy.float64)
+
+def _ClassStarts(uniques, counts, nrclasses):
+    "the index of the first of the distinct values in each of the best classes, one possible class start at a time"
+    count = len(uniques)
+    #the sums of the counts, values and squared values up to each value, shifted to around the mean so the squares stay small
+    mean = sum(value*weight for value,weight in zip(uniques,counts)) / sum(counts)
+    weights, sums, squaresums = [0.0], [0.0], [0.0]
+    for value, weight in zip(uniques, counts):
+        value -= mean
+        weights.append(weights[-1] + weight)
+        sums.append(sums[-1] + weight*value)
+        squaresums.append(squaresums[-1] + weight*value*value)
+    def Cost(start, end):
+        #the sum of squared differences from the mean of the values from start to end
+        total = sums[end+1] - sums[start]
+        return squaresums[end+1] - squaresums[start] - total*total / (weights[end+1] - weights[start])
+    #the best cost of one class for the values up to each value
+    previous = [Cost(0, end) for end in xrange(count)]
+    beststarts = []
+    for nrclass in xrange(1, nrclasses):
+        current = [float("inf")] * count
+        beststart = [0] * count
+        #the best start of the last class never moves back as the values it ends at move up, so each range of ends only has to look at the starts between those of its neighbours
+        todo = [(nrclass, count-1, nrclass, count-1)]
+        while todo:
+            endmin, endmax, startmin, startmax = todo.pop()
+            middle = (endmin + endmax) // 2
+            best, bestcost = None, float("inf")
+            for start in xrange(startmin, min(startmax, middle) + 1):
+                cost = previous[start-1] + Cost(start, middle)
+                if cost < bestcost:
+                    best, bestcost = start, cost
+            current[middle] = bestcost
+            beststart[middle] = best
+            if endmin < middle:
+                todo.append((endmin, middle-1, startmin, best))
+            if middle < endmax:
+                todo.append((middle+1, endmax, best, startmax))
+        beststarts.append(beststart)
+        previous = current
+    return _Backtrack(beststarts, count)
+
+def _NumpyClassStarts(uniques, counts, nrclasses):
+    "the index of the first of the distinct values in each of the best classes, looking at all the ranges of ends at the same depth of the divide and conquer at once"
+    count = len(uniques)
+    values = uniques - (uniques*counts).sum() / float(counts.sum())
+    weights = numpy.concatenate(([0.0], numpy.cumsum(counts, dtype=numpy.float64)))
+    sums = numpy.concatenate(([0.0], numpy.cumsum(counts*values)))
+    squaresums = numpy.concatenate(([0.0], numpy.cumsum(counts*values*values)))
+    def Cost(starts, ends):
+        totals = sums[ends+1] - sums[starts]
+        return squaresums[ends+1] - squaresums[starts] - totals*totals / (weights[ends+1] - weights[starts])
+    previous = Cost(numpy.zeros(count, dtype=int), numpy.arange(count))
+    beststarts = []
+    for nrclass in xrange(1, nrclasses):
+        current = numpy.empty(count)
+        current[:nrclass] = numpy.inf
+        beststart = numpy.zeros(count, dtype=int)
+        #each range of ends to fill in, and the range of starts to look for its middle's best start in
+        endmins, endmaxs = numpy.array([nrclass]), numpy.array([count-1])
+        startmins, startmaxs = numpy.array([nrclass]), numpy.array([count-1])
+        while len(endmins):
+            middles = (endmins + endmaxs) // 2
+            #lay out the possible starts of all the ranges after each other
+            lengths = numpy.minimum(startmaxs, middles) - startmins + 1
+            ranges = numpy.repeat(numpy.arange(len(middles)), lengths)
+            rangefirsts = numpy.cumsum(lengths) - lengths
+            starts = numpy.arange(len(ranges)) - rangefirsts[ranges] + startmins[ranges]
+            costs = previous[starts-1] + Cost(starts, middles[ranges])
+            #find the first of the cheapest starts of each range
+            rangemincosts = numpy.minimum.reduceat(costs, rangefirsts)
+            cheapest = numpy.flatnonzero(costs == rangemincosts[ranges])
+            cheapest = cheapest[numpy.concatenate(([True], ranges[cheapest][1:] != ranges[cheapest][:-1]))]
+            bests = starts[cheapest]
+            current[middles] = rangemincosts
+            beststart[middles] = bests
+            #then split each range of ends in the parts below and above its middle
+            below = endmins < middles
+            above = middles < endmaxs
+            endmins, endmaxs = numpy.concatenate((endmins[below], middles[above]+1)), numpy.concatenate((middles[below]-1, endmaxs[above]))
+            startmins, startmaxs = numpy.concatenate((startmins[below], bests[above])), numpy.concatenate((bests[below], startmaxs[above]))
+        beststarts.append(beststart)
+        previous = current
+    return _Backtrack(beststarts, count)
+
+def _Backtrack(beststarts, count):
+    "follows the best start of each class back from the last value, and returns the starts of all the classes from the first"
+    starts = []
+    end = count - 1
+    for beststart in reversed(beststarts):
+        start = int(beststart[end])
+        starts.append(start)
+        end = start - 1
+    starts.append(0)
+    return starts[::-1]
@@ -0,0 +1,102 @@
+#IMPORTS
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+
+
+#FUNCTIONS
+def ClipPolygon(coords, box):
+    """
+Clips a polygon ring given as an array of xy coordinates to a rectangular box with the Sutherland-Hodgman algorithm, and returns the clipped ring, or an empty array if no part of the ring is inside the box. Rings that are entirely inside the box are returned as they are, and the clipped coordinates keep the number type of the originals. Requires numpy.
+
+| __options__ | __description__
+| --- | ---
+| coords | a numpy array of xy coordinates, one row per point
+| box | the xmin,ymin,xmax,ymax of the box to clip to
+"""
+    if _IsWithin(coords, box):
+        return coords
+    xmin,ymin,xmax,ymax = box
+    clipped = coords
+    #clip to one side of the box at a time, each time looking at all the edges of the ring at once
+    for axis, value, keepbelow in ((0,xmin,False), (0,xmax,True), (1,ymin,False), (1,ymax,True)):
+        clipped = _ClipToSide(clipped, axis, value, keepbelow)
+        if not len(clipped):
+            return clipped
+    #close the ring again, since where it starts may have been clipped away
+    if (clipped[0] != clipped[-1]).any():
+        clipped = numpy.concatenate((clipped, clipped[:1]))
+    return clipped
+
+def ClipLine(coords, box):
+    """
+Clips a line given as an array of xy coordinates to a rectangular box with the Liang-Barsky algorithm, and returns a list of the pieces of the line that are inside the box, since a line that leaves and enters the box again is cut in several pieces. Lines that are entirely inside the box are returned as the only piece, as they are, and the clipped coordinates keep the number type of the originals. Requires numpy.
+
+| __options__ | __description__
+| --- | ---
+| coords | a numpy array of xy coordinates, one row per point
+| box | the xmin,ymin,xmax,ymax of the box to clip to
+"""
+    if _IsWithin(coords, box):
+        return [coords]
+    if len(coords) < 2:
+        return []
+    xmin,ymin,xmax,ymax = box
+    starts, ends = coords[:-1], coords[1:]
+    deltas = ends - starts
+    #how far along each segment it enters and leaves the box, narrowed down by one axis at a time
+    enters = numpy.zeros(len(starts))
+    leaves = numpy.ones(len(starts))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        #segments that never enter the box may get meaningless numbers here, but are left out anyway
+        for axis, low, high in ((0,xmin,xmax), (1,ymin,ymax)):
+            delta = deltas[:,axis]
+            start = starts[:,axis]
+            lowcross = (low - start) / delta
+            highcross = (high - start) / delta
+            #segments running alongside the sides are either entirely between them or entirely outside
+            alongside = delta == 0
+            between = (start >= low) & (start <= high)
+            enters = numpy.maximum(enters, numpy.where(alongside, numpy.where(between, -numpy.inf, numpy.inf), numpy.minimum(lowcross, highcross)))
+            leaves = numpy.minimum(leaves, numpy.where(alongside, numpy.where(between, numpy.inf, -numpy.inf), numpy.maximum(lowcross, highcross)))
+        visible = enters <= leaves
+        #a new piece starts at each visible segment that does not carry on from where the previous one left the box
+        carrieson = numpy.zeros(len(starts), dtype=bool)
+        carrieson[1:] = visible[:-1] & (leaves[:-1] == 1) & visible[1:] & (enters[1:] == 0)
+        startspiece = visible & ~carrieson
+        #lay out the entry point of the segments that start a piece, followed by the exit point of every visible segment
+        points = numpy.empty((len(starts), 2, 2), dtype=coords.dtype)
+        points[:,0] = starts + enters[:,None] * deltas
+        points[:,1] = starts + leaves[:,None] * deltas
+    keep = numpy.column_stack((startspiece, visible)).ravel()
+    clipped = points.reshape(-1, 2)[keep]
+    if not len(clipped):
+        return []
+    piecestarts = (numpy.cumsum(keep) - 1)[0::2][startspiece]
+    return numpy.split(clipped, piecestarts[1:])
+
+
+#INTERNAL USE ONLY
+def _IsWithin(coords, box):
+    "whether all the coordinates are inside the box"
+    xmin,ymin,xmax,ymax = box
+    return bool(len(coords)) and coords[:,0].min() >= xmin and coords[:,0].max() <= xmax and coords[:,1].min() >= ymin and coords[:,1].max() <= ymax
+
+def _ClipToSide(coords, axis, value, keepbelow):
+    "the ring clipped to only the side of the line at value along the given axis that is below or above it"
+    starts = coords
+    ends = numpy.roll(coords, -1, axis=0)
+    if keepbelow:
+        startsin, endsin = starts[:,axis] <= value, ends[:,axis] <= value
+    else:
+        startsin, endsin = starts[:,axis] >= value, ends[:,axis] >= value
+    crosses = startsin != endsin
+    #each edge adds where it crosses the line if it does, followed by its end point if that is inside
+    points = numpy.empty((len(coords), 2, 2), dtype=coords.dtype)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        #only the edges that cross the line are kept, so the others may divide by zero
+        along = (value - starts[:,axis]) / (ends[:,axis] - starts[:,axis])
+        points[:,0] = starts + along[:,None] * (ends - starts)
+    points[:,0,axis] = value
+    points[:,1] = ends
+    keep = numpy.column_stack((crosses, endsin)).ravel()
+    return points.reshape(-1, 2)[keep]
@@ -0,0 +1,189 @@
+#IMPORTS
+import sys, os, hashlib, shutil, tempfile
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+import shapefile_fork as pyshp
+import simplification
+
+#GLOBALS
+#the flat arrays that make up a cached shapefile, each saved as its own .npy file
+ARRAYNAMES = ("coords", "pointstarts", "parts", "partstarts", "bboxes", "types")
+POINTTYPES = (pyshp.POINT, pyshp.POINTZ, pyshp.POINTM)
+#each level of a pyramid is saved in its own subfolder named after its tolerance
+LEVELPREFIX = "level_"
+
+
+#FUNCTIONS
+def CacheFolder(cachefolder, shapefilepath):
+    """
+Returns the subfolder where the geometries of a shapefile are cached. The name is unique to the shapefile's full path, size and modification time, so a changed shapefile is never read from an old cache.
+"""
+    shapefilepath = os.path.abspath(shapefilepath)
+    stat = os.stat(shapefilepath)
+    key = hashlib.sha1("%s|%i|%r" % (shapefilepath, stat.st_size, stat.st_mtime)).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(shapefilepath))[0]
+    return os.path.join(cachefolder, "%s_%s" % (name, key))
+
+def Build(reader):
+    """
+Reads all the geometries of a shapefile Reader into a new GeometryCache, held in memory until it is saved. Requires numpy.
+"""
+    coords, pointstarts, parts, partstarts, types = [], [0], [], [0], []
+    for shape in reader.iterShapes(numpyspeed=True, memmap=True):
+        types.append(shape.shapeType)
+        if shape.shapeType != pyshp.NULL:
+            coords.append(shape.points)
+            if hasattr(shape, "parts"):
+                parts.append(shape.parts)
+        pointstarts.append(pointstarts[-1] + len(shape.points))
+        partstarts.append(partstarts[-1] + len(getattr(shape, "parts", [])))
+    arrays = dict(coords = numpy.concatenate(coords) if coords else numpy.empty((0,2)),
+                  pointstarts = numpy.array(pointstarts, dtype=numpy.int64),
+                  parts = numpy.concatenate(parts).astype(numpy.int32) if parts else numpy.empty(0, dtype=numpy.int32),
+                  partstarts = numpy.array(partstarts, dtype=numpy.int64),
+                  bboxes = reader.bboxes(),
+                  types = numpy.array(types, dtype=numpy.int32))
+    return GeometryCache(arrays)
+
+def Load(cachefolder, shapefilepath):
+    """
+Opens the cached geometries of a shapefile as read-only memory-mapped arrays, so nothing is read until it is needed and the same pages are shared by all processes using the cache. Returns None if the shapefile has not been cached yet.
+"""
+    folder = CacheFolder(cachefolder, shapefilepath)
+    if not os.path.isdir(folder):
+        return None
+    try:
+        arrays = dict((name, numpy.load(os.path.join(folder, name+".npy"), mmap_mode="r")) for name in ARRAYNAMES)
+    except (EnvironmentError, ValueError):
+        return None
+    return GeometryCache(arrays)
+
+def BuildPyramid(cache, tolerances):
+    """
+Builds a pyramid of pre-simplified versions of the geometries in a GeometryCache, one for each of the given tolerances, and returns it as a list of (tolerance, GeometryCache) pairs from the coarsest to the finest level. Each level has the same shapes in the same order, with the same bounding boxes, only with fewer points. Requires numpy.
+"""
+    return [(tolerance, cache.Simplified(tolerance)) for tolerance in sorted(tolerances, reverse=True)]
+
+def SavePyramid(pyramid, pyramidfolder, shapefilepath):
+    """
+Writes each level of a pyramid to its own subfolder of the pyramid folder, replacing any previously saved pyramid. The levels are written to a temporary folder first and then moved into place, so other processes never see a half-written pyramid, and a previous pyramid that other processes may still be reading is moved aside instead of being deleted in place.
+"""
+    parentfolder = os.path.dirname(os.path.abspath(pyramidfolder))
+    tempfolder = tempfile.mkdtemp(dir=parentfolder)
+    oldfolder = None
+    try:
+        for tolerance, cache in pyramid:
+            cache.Save(os.path.join(tempfolder, LEVELPREFIX + repr(tolerance)), shapefilepath)
+        if os.path.isdir(pyramidfolder):
+            oldfolder = tempfile.mkdtemp(dir=parentfolder)
+            os.rename(pyramidfolder, os.path.join(oldfolder, os.path.basename(pyramidfolder)))
+        os.rename(tempfolder, pyramidfolder)
+    except EnvironmentError:
+        shutil.rmtree(tempfolder, ignore_errors=True)
+        #another process may have saved its pyramid in the meantime
+        if not os.path.isdir(pyramidfolder):
+            raise
+    finally:
+        if oldfolder:
+            #files that are still memory-mapped elsewhere cannot be deleted on Windows, but they are out of the way
+            shutil.rmtree(oldfolder, ignore_errors=True)
+
+def LoadPyramid(pyramidfolder, shapefilepath):
+    """
+Opens all the levels of a saved pyramid as memory-mapped GeometryCaches, and returns them as a list of (tolerance, GeometryCache) pairs from the coarsest to the finest level. Returns None if there is no pyramid for the current version of the shapefile.
+"""
+    if not os.path.isdir(pyramidfolder):
+        return None
+    pyramid = []
+    for name in os.listdir(pyramidfolder):
+        if not name.startswith(LEVELPREFIX):
+            continue
+        cache = Load(os.path.join(pyramidfolder, name), shapefilepath)
+        if cache is None:
+            return None
+        pyramid.append((float(name[len(LEVELPREFIX):]), cache))
+    if not pyramid:
+        return None
+    return sorted(pyramid, reverse=True)
+
+
+#CLASSES
+class GeometryCache:
+    """
+The coordinates, parts, bounding boxes and shapetypes of all the shapes in a shapefile, stored as a few flat numpy arrays.
+The points of shape i are coords[pointstarts[i]:pointstarts[i+1]], and its parts are parts[partstarts[i]:partstarts[i+1]], counted from its first point.
+"""
+    def __init__(self, arrays):
+        self.arrays = arrays
+    def __len__(self):
+        return len(self.arrays["types"])
+    def Shape(self, i):
+        """
+Returns shape i as a pyshp shape object whose points and parts are views into the cached arrays.
+"""
+        arrays = self.arrays
+        shapetype = int(arrays["types"][i])
+        shape = pyshp._Shape(shapetype)
+        if shapetype == pyshp.NULL:
+            return shape
+        shape.points = arrays["coords"][arrays["pointstarts"][i]:arrays["pointstarts"][i+1]]
+        if shapetype not in POINTTYPES:
+            shape.bbox = arrays["bboxes"][i]
+            shape.parts = arrays["parts"][arrays["partstarts"][i]:arrays["partstarts"][i+1]]
+        return shape
+    def IterShapes(self, indices=None):
+        """
+Serves up all the shapes, or only those whose indices are given, one at a time.
+"""
+        if indices is None:
+            indices = xrange(len(self))
+        for i in indices:
+            yield self.Shape(i)
+    def Simplified(self, tolerance):
+        """
+Returns a new GeometryCache, held in memory, where every line and polygon ring is simplified so it strays no more than about the tolerance from the original, in the units of the coordinates. Points are kept as they are.
+"""
+        arrays = self.arrays
+        coords, pointstarts, parts, partstarts = [], [0], [], [0]
+        for i in xrange(len(self)):
+            shapecoords = arrays["coords"][arrays["pointstarts"][i]:arrays["pointstarts"][i+1]]
+            shapeparts = arrays["parts"][arrays["partstarts"][i]:arrays["partstarts"][i+1]]
+            if not len(shapeparts):
+                #points have no parts and are kept as they are
+                shapepoints = [shapecoords]
+                newparts = shapeparts
+            else:
+                shapepoints = []
+                newparts = []
+                ends = list(shapeparts[1:]) + [len(shapecoords)]
+                for start, end in zip(shapeparts, ends):
+                    newparts.append(sum(len(points) for points in shapepoints))
+                    shapepoints.append(simplification.Simplify(shapecoords[start:end], tolerance))
+            coords.extend(shapepoints)
+            parts.append(numpy.asarray(newparts, dtype=numpy.int32))
+            pointstarts.append(pointstarts[-1] + sum(len(points) for points in shapepoints))
+            partstarts.append(partstarts[-1] + len(newparts))
+        simplified = dict(coords = numpy.concatenate(coords) if coords else numpy.empty((0,2)),
+                          pointstarts = numpy.array(pointstarts, dtype=numpy.int64),
+                          parts = numpy.concatenate(parts).astype(numpy.int32) if parts else numpy.empty(0, dtype=numpy.int32),
+                          partstarts = numpy.array(partstarts, dtype=numpy.int64),
+                          bboxes = arrays["bboxes"],
+                          types = arrays["types"])
+        return GeometryCache(simplified)
+    def Save(self, cachefolder, shapefilepath):
+        """
+Writes the arrays into the cache folder of the given shapefile. The files are written to a temporary folder first and then moved into place, so other processes never see a half-written cache.
+"""
+        folder = CacheFolder(cachefolder, shapefilepath)
+        if not os.path.isdir(cachefolder):
+            os.makedirs(cachefolder)
+        tempfolder = tempfile.mkdtemp(dir=cachefolder)
+        try:
+            for name in ARRAYNAMES:
+                numpy.save(os.path.join(tempfolder, name+".npy"), numpy.ascontiguousarray(self.arrays[name]))
+            os.rename(tempfolder, folder)
+        except EnvironmentError:
+            shutil.rmtree(tempfolder, ignore_errors=True)
+            #another process may have cached the same shapefile in the meantime
+            if not os.path.isdir(folder):
+                raise
@@ -0,0 +1,42 @@
+#IMPORTS
+import sys, imp
+
+
+#FUNCTIONS
+def IsInstalled(modulename):
+    """
+Checks whether a top-level module can be found on the Python path, without importing it.
+"""
+    if modulename in sys.modules:
+        return True
+    try:
+        filehandle, path, description = imp.find_module(modulename)
+    except ImportError:
+        return False
+    if filehandle:
+        filehandle.close()
+    return True
+
+
+#CLASSES
+class LazyModule:
+    """
+Stands in for a module that is only imported the first time one of its attributes is used, so that a heavy module which may not even be needed does not slow down importing geovis.
+When first used it imports the real module and puts it in its own place in the namespace it was given, so that after that the real module is used directly.
+Raises an ImportError at that point if the module is not installed.
+
+| __options__ | __description__
+| --- | ---
+| modulename | the name of the module to import, which may also be a module in the same package as the namespace
+| namespace | the globals() dictionary of the module that uses it
+"""
+    def __init__(self, modulename, namespace):
+        self._modulename = modulename
+        self._namespace = namespace
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            #do not import just because something is inspecting the stand-in itself
+            raise AttributeError(attr)
+        module = __import__(self._modulename, self._namespace, None, ["__name__"])
+        self._namespace[self._modulename] = module
+        return getattr(module, attr)
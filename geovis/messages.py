@@ -1,5 +1,5 @@
 # Import main modules
-import sys, pickle, Queue
+import sys, pickle
 # Import custom modules
 from textual import txt
 import timetaker as timer
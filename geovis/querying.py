@@ -0,0 +1,175 @@
+#IMPORTS
+import sys, ast, warnings, datetime, __builtin__
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+
+#GLOBALS
+#comparison and arithmetic nodes that can be run on whole columns at once
+COMPARISONS = {ast.Eq: lambda a,b: a == b,
+               ast.NotEq: lambda a,b: a != b,
+               ast.Lt: lambda a,b: a < b,
+               ast.LtE: lambda a,b: a <= b,
+               ast.Gt: lambda a,b: a > b,
+               ast.GtE: lambda a,b: a >= b}
+ARITHMETICS = {ast.Add: lambda a,b: a + b,
+               ast.Sub: lambda a,b: a - b,
+               ast.Mult: lambda a,b: a * b,
+               ast.Div: lambda a,b: a / b,
+               ast.FloorDiv: lambda a,b: a // b,
+               ast.Mod: lambda a,b: a % b,
+               ast.Pow: lambda a,b: a ** b}
+CONSTANTNAMES = {"True":True, "False":False, "None":None}
+SCALARTYPES = (int, long, float, basestring, bool, type(None), datetime.date, datetime.datetime)
+
+
+#CLASSES
+class _NotVectorizable(Exception):
+    pass
+
+class Query:
+    """
+A query string that has been parsed and checked once, so that it can then be run on many features without having to be reinterpreted each time.
+The query uses normal Python expression syntax, where the fieldnames of the shapefile act as variables holding the values of each feature (case-sensitive), and the current feature itself can be referred to as "shape".
+
+| __options__ | __description__
+| --- | ---
+| querystring | the query expression as a string
+| fieldnames | a list of all the fieldnames that the query may refer to
+| *namespace | a dictionary of any other variables that the query may refer to (default is None)
+"""
+    def __init__(self, querystring, fieldnames, namespace=None):
+        self.querystring = querystring
+        self.namespace = namespace or dict()
+        self.tree = ast.parse(querystring.strip(), mode="eval")
+        self.code = compile(self.tree, "<query>", "eval")
+        #check that all variables exist
+        names = set(node.id for node in ast.walk(self.tree) if isinstance(node, ast.Name))
+        unknown = [name for name in names if name not in fieldnames and name != "shape"
+                   and name not in self.namespace and not hasattr(__builtin__, name)]
+        if unknown:
+            raise NameError("The query refers to unknown names %s, the available fieldnames are: %s" % (", ".join(sorted(unknown)), ", ".join(fieldnames)))
+        #remember which fields are needed, in their original order
+        self.fields = [fieldname for fieldname in fieldnames if fieldname in names]
+        self.needsshape = "shape" in names and "shape" not in fieldnames
+    def EvaluateColumns(self, getcolumn, length):
+        """
+Runs the query on entire columns of attribute values at once, and returns a numpy boolean array with one True or False per feature.
+If the query cannot be run column-wise, for instance because it calls a function or uses the shape variable, None is returned and the query has to be run one feature at a time with Matches instead.
+
+| __options__ | __description__
+| --- | ---
+| getcolumn | a function that returns a numpy array of all the values of the fieldname given to it, or None if that field cannot be handled column-wise
+| length | the number of features
+"""
+        if self.needsshape:
+            return None
+        self._getcolumn = getcolumn
+        try:
+            #numpy only warns when it cannot compare two arrays elementwise, so treat those warnings as failures
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                result = self._Truth(self._Evaluate(self.tree.body))
+        except (_NotVectorizable, TypeError, ValueError, ArithmeticError, Warning):
+            return None
+        finally:
+            del self._getcolumn
+        if not isinstance(result, numpy.ndarray):
+            #the query did not involve any fields so gives the same result for all features
+            result = numpy.repeat(bool(result), length)
+        if result.shape != (length,):
+            return None
+        return result
+    def Matches(self, values, shape=None):
+        """
+Runs the query on a single feature and returns True or False.
+
+| __options__ | __description__
+| --- | ---
+| values | a list of the feature's values for each of the fieldnames listed in the fields attribute of the query
+| *shape | the feature itself, if the query refers to it (default is None)
+"""
+        variables = dict(zip(self.fields, values))
+        if self.needsshape:
+            variables["shape"] = shape
+        return bool(eval(self.code, self.namespace, variables))
+
+    # INTERNAL USE ONLY
+    def _Evaluate(self, node):
+        if isinstance(node, ast.Name):
+            if node.id in self.fields:
+                column = self._getcolumn(node.id)
+                if column is None:
+                    raise _NotVectorizable()
+                return column
+            elif node.id in CONSTANTNAMES:
+                return CONSTANTNAMES[node.id]
+            value = self.namespace.get(node.id)
+            if isinstance(value, SCALARTYPES):
+                return value
+            raise _NotVectorizable()
+        elif isinstance(node, ast.Num):
+            return node.n
+        elif isinstance(node, ast.Str):
+            return node.s
+        elif isinstance(node, ast.Compare):
+            left = self._Evaluate(node.left)
+            result = True
+            for op, comparatornode in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    right = self._Collection(comparatornode)
+                    if not isinstance(left, numpy.ndarray):
+                        raise _NotVectorizable()
+                    compared = numpy.in1d(left, right)
+                    if isinstance(op, ast.NotIn):
+                        compared = ~compared
+                elif type(op) in COMPARISONS:
+                    right = self._Evaluate(comparatornode)
+                    compared = COMPARISONS[type(op)](left, right)
+                else:
+                    raise _NotVectorizable()
+                result = result & compared
+                left = right
+            return result
+        elif isinstance(node, ast.BoolOp):
+            results = [self._Truth(self._Evaluate(valuenode)) for valuenode in node.values]
+            if isinstance(node.op, ast.And):
+                return reduce(lambda a,b: a & b, results)
+            else:
+                return reduce(lambda a,b: a | b, results)
+        elif isinstance(node, ast.UnaryOp):
+            operand = self._Evaluate(node.operand)
+            if isinstance(node.op, ast.Not):
+                return ~self._Truth(operand) if isinstance(operand, numpy.ndarray) else not operand
+            elif isinstance(node.op, ast.USub):
+                return -operand
+            elif isinstance(node.op, ast.UAdd):
+                return +operand
+            raise _NotVectorizable()
+        elif isinstance(node, ast.BinOp) and type(node.op) in ARITHMETICS:
+            left = self._Evaluate(node.left)
+            right = self._Evaluate(node.right)
+            for value in (left, right):
+                if isinstance(value, numpy.ndarray) and value.dtype.kind not in "biuf":
+                    #string concatenation etc is left to the row by row fallback
+                    raise _NotVectorizable()
+            return ARITHMETICS[type(node.op)](left, right)
+        raise _NotVectorizable()
+    def _Collection(self, node):
+        "the right side of an 'in' test must be a list of plain values"
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            values = [self._Evaluate(eltnode) for eltnode in node.elts]
+            if any(isinstance(value, numpy.ndarray) for value in values):
+                raise _NotVectorizable()
+            return values
+        raise _NotVectorizable()
+    def _Truth(self, value):
+        "the truth value of each item in a column, as for Python's bool()"
+        if isinstance(value, numpy.ndarray):
+            if value.dtype.kind == "b":
+                return value
+            elif value.dtype.kind in "iuf":
+                return value != 0
+            elif value.dtype.kind in "SU":
+                return numpy.char.str_len(value) > 0
+            raise _NotVectorizable()
+        return bool(value)
@@ -15,10 +15,19 @@ import time
 import array
 import tempfile
 import itertools
-try:
-    import numpy
-except:
-    pass
+import collections
+import mmap
+
+class _LazyNumpy(object):
+    """Stands in for numpy until it is first used, so that importing
+    this module neither requires numpy nor spends time importing it.
+    Raises an ImportError at that point if numpy is not installed."""
+    def __getattr__(self, attr):
+        global numpy
+        import numpy
+        return getattr(numpy, attr)
+
+numpy = _LazyNumpy()
 
 #
 # Constants for shape types
@@ -134,6 +143,35 @@ def signed_area(coords):
     ys.append(ys[1])
     return sum(xs[i]*(ys[i+1]-ys[i-1]) for i in xrange(1, len(coords)))/2.0
 
+def map_file(f):
+    """Returns the entire contents of a file object as a read-only
+    numpy byte array. Real files are memory-mapped so nothing is
+    actually read until the bytes are accessed, other file-like
+    objects are read into memory. Requires numpy."""
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        f.seek(0)
+        mapped = f.read()
+    return numpy.frombuffer(mapped, numpy.uint8)
+
+GATHER_CHUNK = 65536
+
+def gather(buf, offsets, fmt, count=1):
+    """Reads a value of the given numpy format at every one of the
+    byte offsets in a mapped file with vectorized reads, returning
+    an array with one row of count values per offset. The offsets
+    are read a chunk at a time, so the table of byte positions being
+    read stays small however many offsets there are."""
+    dtype = numpy.dtype(fmt)
+    offsets = numpy.asarray(offsets, numpy.int64)
+    steps = numpy.arange(dtype.itemsize * count)
+    values = numpy.empty((len(offsets), count), dtype)
+    for start in xrange(0, len(offsets), GATHER_CHUNK):
+        chunk = offsets[start:start+GATHER_CHUNK]
+        values[start:start+len(chunk)] = buf[chunk[:,None] + steps].view(dtype).reshape(len(chunk), count)
+    return values
+
 class _Shape:
     def __init__(self, shapeType=None):
         """Stores the geometry of the different shape types
@@ -258,6 +296,12 @@ class Reader:
         self.numRecords = None
         self.fields = []
         self.__dbfHdrLength = 0
+        self.__shpMap = None
+        self.__dbfMap = None
+        self.__bboxes = None
+        self.__fieldSlices = {}
+        self.__recordCache = collections.OrderedDict()
+        self.recordCacheSize = 1000
         # See if a shapefile name was passed as an argument
         if len(args) > 0:
             if is_string(args[0]):
@@ -422,7 +466,8 @@ class Reader:
 
     def __shapeIndex(self, i=None):
         """Returns the offset in a .shp file for a shape based on information
-        in the .shx index file."""
+        in the .shx index file. The whole index is read the first time it is
+        needed, so that any shape can then be jumped to directly."""
         shx = self.shx
         if not shx:
             return None
@@ -431,22 +476,134 @@ class Reader:
             shx.seek(24)
             shxRecordLength = (unpack(">i", shx.read(4))[0] * 2) - 100
             numRecords = shxRecordLength // 8
-            # Jump to the first record.
+            # Read all the records at once, each an offset followed by a content length
             shx.seek(100)
-            for r in xrange(numRecords):
-                # Offsets are 16-bit words just like the file length
-                self._offsets.append(unpack(">i", shx.read(4))[0] * 2)
-                shx.seek(shx.tell() + 4)
+            index = unpack(">%ii" % (numRecords * 2), shx.read(numRecords * 8))
+            # Offsets are 16-bit words just like the file length
+            self._offsets = [offset * 2 for offset in index[0::2]]
         if not i == None:
             return self._offsets[i]
+        return self._offsets
+
+    def __mapShp(self):
+        """Memory-maps the .shp file and builds a table of where the
+        header fields, parts and points of every record start. The
+        record offsets come from the .shx file if available, and the
+        per-record header fields are read for all records at once.
+        Requires numpy."""
+        if self.__shpMap is None:
+            shp = self.__getFileObj(self.shp)
+            buf = map_file(shp)
+            if self.shx:
+                shxbuf = map_file(self.shx)
+                # Offsets and content lengths are big-endian 16-bit word counts
+                index = shxbuf[100:].view(">i4").reshape(-1, 2)
+                offsets = index[:,0].astype(numpy.int64) * 2
+            else:
+                # No index so step through the record headers one by one
+                offsets = []
+                pos = 100
+                while pos + 8 <= len(buf):
+                    offsets.append(pos)
+                    pos += 8 + 2 * int(buf[pos+4:pos+8].view(">i4")[0])
+                offsets = numpy.array(offsets, numpy.int64)
+            shapeTypes = gather(buf, offsets + 8, "<i4")[:,0]
+            nParts = numpy.zeros(len(offsets), numpy.int64)
+            nPoints = numpy.zeros(len(offsets), numpy.int64)
+            pointStarts = offsets + 12
+            # Shape types with parts
+            hasParts = numpy.in1d(shapeTypes, (3,5,13,15,23,25,31))
+            nParts[hasParts] = gather(buf, offsets[hasParts] + 44, "<i4")[:,0]
+            nPoints[hasParts] = gather(buf, offsets[hasParts] + 48, "<i4")[:,0]
+            pointStarts[hasParts] = offsets[hasParts] + 52 + 4 * nParts[hasParts]
+            # Multipatch also stores the part types before the points
+            isPatch = shapeTypes == 31
+            pointStarts[isPatch] += 4 * nParts[isPatch]
+            # Multipoints have points but no parts
+            isMulti = numpy.in1d(shapeTypes, (8,18,28))
+            nPoints[isMulti] = gather(buf, offsets[isMulti] + 44, "<i4")[:,0]
+            pointStarts[isMulti] = offsets[isMulti] + 48
+            self.__shpMap = dict(buf=buf, offsets=offsets, shapeTypes=shapeTypes,
+                                 nParts=nParts, nPoints=nPoints, pointStarts=pointStarts)
+        return self.__shpMap
+
+    def __mappedShape(self, i):
+        """Returns a shape whose bbox, parts and points are numpy
+        views into the memory-mapped .shp file, so no geometry is
+        copied. Z and M values are not read in this mode."""
+        shpMap = self.__mapShp()
+        buf = shpMap["buf"]
+        offset = shpMap["offsets"][i]
+        shapeType = int(shpMap["shapeTypes"][i])
+        record = _Shape(shapeType)
+        if shapeType == 0:
+            record.points = []
+            return record
+        pointStart = shpMap["pointStarts"][i]
+        if shapeType in (1,11,21):
+            record.points = buf[pointStart:pointStart+16].view("<f8").reshape(1, 2)
+            return record
+        record.bbox = buf[offset+12:offset+44].view("<f8")
+        nParts = shpMap["nParts"][i]
+        if nParts:
+            record.parts = buf[offset+52:offset+52+4*nParts].view("<i4")
+        nPoints = shpMap["nPoints"][i]
+        record.points = buf[pointStart:pointStart+16*nPoints].view("<f8").reshape(nPoints, 2)
+        return record
 
-    def shape(self, i=0, numpyspeed=False):
+    def bboxes(self):
+        """Returns the bounding boxes of all shapes as an (N,4) numpy
+        array of xmin, ymin, xmax, ymax values. The boxes are read in
+        one vectorized pass straight from the record headers at the
+        offsets given by the shx file, so none of the parts or points
+        are read. Points get the box of their single coordinate and
+        null shapes a box of NaN values. The boxes are only read the
+        first time and the same read-only array is returned after
+        that. Requires numpy."""
+        if self.__bboxes is None:
+            shpMap = self.__mapShp()
+            buf = shpMap["buf"]
+            offsets = shpMap["offsets"]
+            shapeTypes = shpMap["shapeTypes"]
+            boxes = numpy.empty((len(offsets), 4), numpy.float64)
+            boxes[:] = numpy.nan
+            isPoint = numpy.in1d(shapeTypes, (1,11,21))
+            xy = gather(buf, offsets[isPoint] + 12, "<f8", 2)
+            boxes[isPoint] = numpy.hstack([xy, xy])
+            hasBox = (shapeTypes != 0) & ~isPoint
+            boxes[hasBox] = gather(buf, offsets[hasBox] + 12, "<f8", 4)
+            boxes.flags.writeable = False
+            self.__bboxes = boxes
+        return self.__bboxes
+
+    def nullShapes(self, numpyspeed=False):
+        """Returns a list of the indices of all null shapes, found from
+        the content length of each record in the shx index file alone,
+        so that none of the shp file is read. A null shape is the only
+        kind of record whose content is just its shape type. Returns
+        None if the shx index file is not available."""
+        shx = self.shx
+        if not shx:
+            return None
+        if numpyspeed:
+            # Content lengths are big-endian 16-bit word counts
+            lengths = map_file(shx)[100:].view(">i4").reshape(-1, 2)[:,1]
+            return numpy.flatnonzero(lengths == 2).tolist()
+        shx.seek(100)
+        index = shx.read()
+        lengths = unpack(">%ii" % (len(index) // 4), index[:len(index) // 4 * 4])[1::2]
+        return [i for i,length in enumerate(lengths) if length == 2]
+
+    def shape(self, i=0, numpyspeed=False, memmap=False):
         """Returns a shape object for a shape in the the geometry
         record file. Numpyspeed can be set to True for faster shape
         retrieval (this has no effect if shx index file exists).
-        Requires numpy."""
+        If memmap is set to True the shape geometry is returned as
+        numpy views into the memory-mapped file. Requires numpy."""
         shp = self.__getFileObj(self.shp)
         i = self.__restrictIndex(i)
+        if memmap:
+            return self.__mappedShape(i)
         offset = self.__shapeIndex(i)
         if not offset:
             # Shx index not available so iterate the full list.
@@ -471,11 +628,32 @@ class Reader:
             shapes.append(self.__shape())
         return shapes
 
-    def iterShapes(self, numpyspeed=False):
+    def iterShapes(self, numpyspeed=False, memmap=False, indices=None):
         """Serves up shapes in a shapefile as an iterator. Useful
         for handling large shapefiles. The user has the option to set numpyspeed arg to True to allow for
-        shapereading speed increase, especially for larger files. This requires numpy."""
+        shapereading speed increase, especially for larger files. Setting memmap to True instead
+        memory-maps the file once and serves every shape as zero-copy numpy views into it.
+        This requires numpy. If a sequence of shape indices is given only those
+        shapes are served, jumping straight to each one via the shx index file."""
+        if memmap:
+            if indices is None:
+                indices = xrange(len(self.__mapShp()["offsets"]))
+            for i in indices:
+                yield self.__mappedShape(i)
+            return
         shp = self.__getFileObj(self.shp)
+        if indices is not None:
+            if self.__shapeIndex() is None:
+                # Shx index not available so iterate the full list.
+                wanted = set(indices)
+                for i,shape in enumerate(self.iterShapes(numpyspeed)):
+                    if i in wanted:
+                        yield shape
+                return
+            for i in indices:
+                shp.seek(self.__shapeIndex(i))
+                yield self.__shape(numpyspeed=numpyspeed)
+            return
         shp.seek(0,2)
         self.shpLength = shp.tell()
         shp.seek(100)
@@ -530,28 +708,53 @@ class Reader:
             self.__dbfHeader()
         return (fmt, fmtSize)
 
-    def __record(self):
+    def __recordFields(self, fields=None):
+        """Returns the name, type, decimals and byte slice of each dbf
+        field to decode, in the requested order. All fields are used if
+        no field names are given."""
+        if not self.numRecords:
+            self.__dbfHeader()
+        key = fields if fields is None else tuple(fields)
+        if key not in self.__fieldSlices:
+            slices = dict()
+            position = 0
+            for (name, typ, size, deci) in self.fields:
+                slices[name] = (name, typ, deci, position, position + size)
+                position += size
+            if fields is None:
+                fields = [fieldinfo[0] for fieldinfo in self.fields[1:]]
+            missing = [name for name in fields if name not in slices]
+            if missing:
+                raise ShapefileException("Unknown dbf field(s): %s" % ", ".join(missing))
+            self.__fieldSlices[key] = [slices[name] for name in fields]
+        return self.__fieldSlices[key]
+
+    def __record(self, fields=None):
         """Reads and returns a dbf record row as a list of values."""
         f = self.__getFileObj(self.dbf)
-        #recordContents = next(self.numpyrecordsgen) #self.numpyrecread(f, self.numpyrecorddtypes, 1)[0]
-        recFmt = self.recorddtypes
-        recordContents = unpack(recFmt[0], f.read(recFmt[1]))
-        if recordContents[0] != b(' '):
+        return self.decodeRecord(f.read(self.recorddtypes[1]), fields)
+
+    def decodeRecord(self, recordContents, fields=None):
+        """Decodes the raw bytes of a dbf record row, as served up by
+        iterRawRecords(), and returns it as a list of values, or None if
+        the record is deleted. If a list of field names is given only
+        those fields are decoded, in that order, and the bytes of all
+        other fields are skipped."""
+        if recordContents[:1] != b(' '):
             # deleted record
             return None
         record = []
-        for (name, typ, size, deci), value in itertools.izip(self.fields, recordContents):
+        for (name, typ, deci, start, end) in self.__recordFields(fields):
             #bottleneck in this code, esp with string strip funcs, removing them speeds up x4
-            if name == 'DeletionFlag':
-                continue
-            elif not value.strip(): #!!
+            value = recordContents[start:end]
+            if not value.strip(): #!!
                 record.append(value)
                 continue
-            elif typ == "N":
+            elif typ in ("N", "F"):
                 value = value.replace(b('\0'), b('')).strip() #!!
                 if value == b(''):
                     value = 0
-                elif deci:
+                elif deci or typ == "F":
                     value = float(value)
                 else:
                     value = int(value)
@@ -570,42 +773,186 @@ class Reader:
             record.append(value)
         return record
 
-    def record(self, i=0):
-        """Returns a specific dbf record based on the supplied index."""
+    def record(self, i=0, fields=None):
+        """Returns a specific dbf record based on the supplied index.
+        If a list of field names is given only those fields are
+        decoded and returned, in that order. The raw bytes of the most
+        recently used records are kept in a cache of recordCacheSize
+        rows, so that repeated lookups of the same records don't have
+        to seek and read the file again."""
         f = self.__getFileObj(self.dbf)
         if not self.numRecords:
             self.__dbfHeader()
         i = self.__restrictIndex(i)
-        recSize = self.recorddtypes[1]
-        f.seek(0)
-        f.seek(self.__dbfHeaderLength() + (i * recSize))
-        return self.__record()
-
-    def records(self):
-        """Returns all records in a dbf file."""
+        recordContents = self.__recordCache.pop(i, None)
+        if recordContents is None:
+            recSize = self.recorddtypes[1]
+            f.seek(self.__dbfHeaderLength() + (i * recSize))
+            recordContents = f.read(recSize)
+            if len(self.__recordCache) >= self.recordCacheSize:
+                self.__recordCache.popitem(last=False)
+        self.__recordCache[i] = recordContents
+        return self.decodeRecord(recordContents, fields)
+
+    def records(self, fields=None):
+        """Returns all records in a dbf file, optionally limited to
+        the given list of field names."""
         if not self.numRecords:
             self.__dbfHeader()
         records = []
         f = self.__getFileObj(self.dbf)
         f.seek(self.__dbfHeaderLength())
         for i in xrange(self.numRecords):
-            r = self.__record()
+            r = self.__record(fields)
             if r:
                 records.append(r)
         return records
 
-    def iterRecords(self):
+    def iterRecords(self, fields=None):
         """Serves up records in a dbf file as an iterator.
-        Useful for large shapefiles or dbf files."""
+        Useful for large shapefiles or dbf files. If a list of
+        field names is given only those fields are decoded."""
         if not self.numRecords:
             self.__dbfHeader()
         f = self.__getFileObj(self.dbf)
         f.seek(self.__dbfHeaderLength())
         for i in xrange(self.numRecords):
-            r = self.__record()
+            r = self.__record(fields)
             if r:
                 yield r
 
+    def iterRawRecords(self, indices=None):
+        """Serves up the undecoded bytes of every dbf record row in
+        order, including deleted rows so that they always line up with
+        the shapes. The file is read sequentially in large blocks, and
+        the rows can be decoded as needed with decodeRecord(). If a
+        sequence of record indices is given only those rows are read,
+        where indices that follow closely after each other are served
+        from the same block instead of seeking for each row."""
+        if not self.numRecords:
+            self.__dbfHeader()
+        f = self.__getFileObj(self.dbf)
+        recSize = self.recorddtypes[1]
+        blockRecords = max(1, 65536 // recSize)
+        if indices is not None:
+            blockStart, block = 0, b('')
+            for i in indices:
+                start = (i - blockStart) * recSize
+                if not (0 <= start and start + recSize <= len(block)):
+                    # read a new block beginning at this row
+                    blockStart = i
+                    start = 0
+                    f.seek(self.__dbfHeaderLength() + (i * recSize))
+                    block = f.read(max(1, min(blockRecords, self.numRecords - i)) * recSize)
+                yield block[start:start + recSize]
+            return
+        position = self.__dbfHeaderLength()
+        remaining = self.numRecords
+        while remaining > 0:
+            count = min(blockRecords, remaining)
+            # seek every time in case the file was read elsewhere in between
+            f.seek(position)
+            block = f.read(count * recSize)
+            position += count * recSize
+            remaining -= count
+            for start in xrange(0, count * recSize, recSize):
+                yield block[start:start + recSize]
+
+    def recordArray(self, fields=None):
+        """Returns the raw bytes of all dbf records as a numpy structured
+        array with one string column per field, viewed directly from the
+        memory-mapped dbf file. If a list of field names is given only
+        those fields are included, and the bytes of all other fields are
+        skipped over. Deleted records are included so that row numbers
+        always match shape numbers. Requires numpy."""
+        f = self.__getFileObj(self.dbf)
+        if not self.numRecords:
+            self.__dbfHeader()
+        if self.__dbfMap is None:
+            self.__dbfMap = map_file(f)
+        names, formats, offsets = [], [], []
+        position = 0
+        for (name, typ, size, deci) in self.fields:
+            if fields is None or name in fields:
+                names.append(name)
+                formats.append("S%d" % size)
+                offsets.append(position)
+            position += size
+        if fields is not None:
+            missing = [name for name in fields if name not in names]
+            if missing:
+                raise ShapefileException("Unknown dbf field(s): %s" % ", ".join(missing))
+        dtype = numpy.dtype(dict(names=names, formats=formats, offsets=offsets,
+                                 itemsize=self.recorddtypes[1]))
+        return numpy.frombuffer(self.__dbfMap, dtype, self.numRecords, self.__dbfHeaderLength())
+
+    def column(self, field):
+        """Returns all values of a single dbf field as a typed numpy
+        array, decoding only the bytes of that field. Numeric fields
+        become integer or float arrays (with blank values as 0), date
+        fields become datetime64 arrays (with blank values as NaT),
+        logical fields become boolean arrays, and all other fields
+        become arrays of stripped strings. The column is decoded anew
+        each time, so it is up to the caller to keep it if it is needed
+        again. Requires numpy."""
+        raw = self.recordArray([field])[field]
+        (name, typ, size, deci) = [fieldinfo for fieldinfo in self.fields if fieldinfo[0] == field][0]
+        return self.__decodeColumn(raw, typ, deci)
+
+    def iterColumn(self, field, indices=None, batchsize=100000):
+        """Serves up the values of a single dbf field as typed numpy
+        arrays of at most batchsize values each, decoded the same way as
+        column() does but one batch at a time straight from the mapped
+        dbf file, so that only one batch of values is kept in memory. If a sequence of record indices is
+        given only those records are decoded, in that order. Requires
+        numpy."""
+        raw = self.recordArray([field])[field]
+        (name, typ, size, deci) = [fieldinfo for fieldinfo in self.fields if fieldinfo[0] == field][0]
+        if indices is None:
+            for start in xrange(0, len(raw), batchsize):
+                yield self.__decodeColumn(raw[start:start+batchsize], typ, deci)
+        else:
+            indices = numpy.asarray(indices, numpy.int64)
+            for start in xrange(0, len(indices), batchsize):
+                yield self.__decodeColumn(raw[indices[start:start+batchsize]], typ, deci)
+
+    def __decodeColumn(self, raw, typ, deci):
+        """Converts a column of raw dbf bytes to a typed numpy array."""
+        if typ in ("N", "F"):
+            values = numpy.char.strip(numpy.char.replace(raw, b('\0'), b('')))
+            values[values == b('')] = b('0')
+            try:
+                if deci or typ == "F":
+                    return values.astype(numpy.float64)
+                try:
+                    return values.astype(numpy.int64)
+                except ValueError:
+                    return values.astype(numpy.float64)
+            except ValueError:
+                # Overflowed or otherwise invalid numbers become nan
+                def tofloat(value):
+                    try:
+                        return float(value)
+                    except ValueError:
+                        return numpy.nan
+                return numpy.array([tofloat(value) for value in values], numpy.float64)
+        elif typ == "D":
+            values = numpy.char.strip(raw)
+            valid = numpy.char.isdigit(values) & (numpy.char.str_len(values) == 8)
+            dates = numpy.empty(len(values), "datetime64[D]")
+            dates[:] = numpy.datetime64("NaT")
+            ymd = values[valid].astype(numpy.int64)
+            months = (ymd // 10000 - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (ymd // 100 % 100 - 1)
+            dates[valid] = months.astype("datetime64[D]") + (ymd % 100 - 1)
+            return dates
+        elif typ == "L":
+            return numpy.in1d(raw, [b(flag) for flag in "YyTt"])
+        else:
+            values = numpy.char.strip(raw)
+            if PYTHON3:
+                values = numpy.char.decode(values, "utf-8")
+            return values
+
     def shapeRecord(self, i=0, numpyspeed=False):
         """Returns a combination geometry and attribute record for the
         supplied record index. If numpyspeed is set to true will speed up shaperetrieval. This requires numpy."""
@@ -624,8 +971,8 @@ class Reader:
         all records in a shapefile. The user has the option to set numpyspeed arg to True to allow for
         shapereading speed increase, especially for larger files. This requires numpy."""
         shapeRecords = []
-        return (_ShapeRecord(shape=rec[0], record=rec[1]) \
-                                for rec in itertools.izip(self.iterShapes(numpyspeed), self.iterRecords()) )
+        return (_ShapeRecord(shape=rec[0], record=self.decodeRecord(rec[1])) \
+                                for rec in itertools.izip(self.iterShapes(numpyspeed), self.iterRawRecords()) )
 
 class Writer:
     """Provides write support for ESRI Shapefiles."""
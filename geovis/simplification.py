@@ -0,0 +1,154 @@
+#IMPORTS
+import math, heapq
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+
+#GLOBALS
+METHODS = ("douglas-peucker", "visvalingam")
+#once a round of Visvalingam-Whyatt leaves out less than this share of the points, the rest are left out one at a time instead
+MINROUNDSHARE = 1/16.0
+
+
+#FUNCTIONS
+def Simplify(coords, tolerance, method="douglas-peucker"):
+    """
+Simplifies a line or polygon ring given as an array of xy coordinates, leaving out the points that hardly change its shape, and returns the simplified coordinates. The first and last points are always kept. Runs of points that are closer together than the tolerance are thinned out before the chosen algorithm is run, so the result may stray up to about twice the tolerance from the original. Requires numpy.
+
+| __options__ | __description__
+| --- | ---
+| coords | a numpy array of xy coordinates, one row per point
+| tolerance | how far, in the same units as the coordinates, the simplified line may stray from the original
+| method | the simplification algorithm to use, either "douglas-peucker" (default) or "visvalingam"
+"""
+    if len(coords) <= 2 or not tolerance:
+        return coords
+    #first cheaply thin out runs of points that are very close together
+    coords = coords[SnapToGrid(coords, tolerance/math.sqrt(2))]
+    if len(coords) <= 2:
+        return coords
+    if method == "douglas-peucker":
+        keep = DouglasPeucker(coords, tolerance)
+    elif method == "visvalingam":
+        keep = VisvalingamWhyatt(coords, tolerance)
+    else:
+        raise ValueError("simplification method must be one of: %s" % ", ".join(METHODS))
+    return coords[keep]
+
+def SnapToGrid(coords, cellsize):
+    """
+Returns a boolean array of which points to keep when leaving out the points that fall in the same grid cell as the point before them, so no point that is left out is further than the cell diagonal from one that is kept.
+"""
+    cells = numpy.floor(coords / cellsize)
+    keep = numpy.ones(len(coords), dtype=bool)
+    keep[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+    keep[-1] = True
+    return keep
+
+def DouglasPeucker(coords, tolerance):
+    """
+Returns a boolean array of which points to keep according to the Douglas-Peucker algorithm, which keeps splitting the line at the point furthest from the straight segment between the points kept so far, until no point is more than the tolerance away.
+Instead of recursing into one segment at a time, all the segments of each round are split at once.
+"""
+    count = len(coords)
+    keep = numpy.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    starts = numpy.array([0])
+    ends = numpy.array([count-1])
+    maxdist = tolerance * tolerance
+    while len(starts):
+        #the number of points in between the ends of each segment
+        lengths = ends - starts - 1
+        notempty = lengths > 0
+        starts, ends, lengths = starts[notempty], ends[notempty], lengths[notempty]
+        if not len(starts):
+            break
+        #lay out the points of all the segments after each other, and the ends of the segment each belongs to
+        segments = numpy.repeat(numpy.arange(len(starts)), lengths)
+        segmentfirsts = numpy.cumsum(lengths) - lengths
+        ids = numpy.arange(len(segments)) - segmentfirsts[segments] + starts[segments] + 1
+        dists = _SquaredSegmentDistances(coords[ids], coords[starts][segments], coords[ends][segments])
+        #find the first of the furthest points of each segment
+        segmentmaxdists = numpy.maximum.reduceat(dists, segmentfirsts)
+        furthest = numpy.flatnonzero(dists == segmentmaxdists[segments])
+        furthest = furthest[numpy.concatenate(([True], segments[furthest][1:] != segments[furthest][:-1]))]
+        #keep and split at the furthest points that are too far away, and stop with the rest
+        split = segmentmaxdists > maxdist
+        splitids = ids[furthest][split]
+        keep[splitids] = True
+        starts, ends = numpy.concatenate((starts[split], splitids)), numpy.concatenate((splitids, ends[split]))
+    return keep
+
+def VisvalingamWhyatt(coords, tolerance):
+    """
+Returns a boolean array of which points to keep according to the Visvalingam-Whyatt algorithm, which keeps leaving out the point that forms the smallest triangle with its two neighbours, until all triangles are at least the tolerance squared in area.
+Instead of leaving out one point at a time, each round leaves out all the points whose triangle is too small and also smaller than the triangles of both its neighbours.
+Where that only leaves out a few points per round, eg along smooth arcs and spirals where the triangles grow steadily, the remaining points are left out one at a time from a heap instead, so that it never takes more than a few rounds over the whole line.
+"""
+    keep = numpy.ones(len(coords), dtype=bool)
+    ids = numpy.arange(len(coords))
+    minarea = tolerance * tolerance
+    while len(ids) > 2:
+        points = coords[ids]
+        areas = _TriangleAreas(points[:-2], points[1:-1], points[2:])
+        #the first and last points have no triangles and are never left out
+        neighbours = numpy.concatenate(([numpy.inf], areas, [numpy.inf]))
+        before, after = neighbours[:-2], neighbours[2:]
+        #where neighbours have the same area, only every other point is left out, so that two neighbours are never left out in the same round
+        even = numpy.arange(len(areas)) % 2 == 0
+        smallest = ((areas < before) | ((areas == before) & even)) & ((areas < after) | ((areas == after) & even))
+        leaveout = smallest & (areas < minarea)
+        if not leaveout.any():
+            break
+        if leaveout.sum() < len(ids) * MINROUNDSHARE:
+            keep[ids[~_VisvalingamHeap(coords[ids], minarea)]] = False
+            break
+        keep[ids[1:-1][leaveout]] = False
+        ids = ids[numpy.concatenate(([True], ~leaveout, [True]))]
+    return keep
+
+
+#INTERNAL USE ONLY
+def _SquaredSegmentDistances(points, starts, ends):
+    "the squared distance from each point to the nearest spot on its straight segment from start to end"
+    segmentvectors = ends - starts
+    pointvectors = points - starts
+    segmentlengths = (segmentvectors**2).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        #how far along the segment the nearest spot is, or its start if the segment has no length, eg for a closed ring
+        along = numpy.where(segmentlengths > 0, (pointvectors*segmentvectors).sum(axis=1) / segmentlengths, 0.0)
+    along = numpy.clip(along, 0.0, 1.0)
+    offsets = pointvectors - along[:,None] * segmentvectors
+    return (offsets**2).sum(axis=1)
+
+def _VisvalingamHeap(coords, minarea):
+    "the plain Visvalingam-Whyatt algorithm, which keeps a heap of the triangle areas and leaves out the point with the smallest one at a time, returning a boolean array of which points to keep"
+    count = len(coords)
+    xs, ys = coords[:,0].tolist(), coords[:,1].tolist()
+    before, after = range(-1, count-1), range(1, count+1)
+    def area(i):
+        first, last = before[i], after[i]
+        return abs((xs[i]-xs[first])*(ys[last]-ys[first]) - (xs[last]-xs[first])*(ys[i]-ys[first])) / 2.0
+    #the first and last points have no triangles and are never left out
+    areas = [numpy.inf] + _TriangleAreas(coords[:-2], coords[1:-1], coords[2:]).tolist() + [numpy.inf]
+    heap = [(pointarea, i) for i, pointarea in enumerate(areas) if pointarea < minarea]
+    heapq.heapify(heap)
+    keep = [True] * count
+    while heap:
+        pointarea, i = heapq.heappop(heap)
+        if not keep[i] or pointarea != areas[i]:
+            #left out already, or its area has changed since it was added
+            continue
+        keep[i] = False
+        first, last = before[i], after[i]
+        after[first], before[last] = last, first
+        #the neighbours now form new triangles
+        for neighbour in (first, last):
+            if 0 < neighbour < count-1:
+                areas[neighbour] = area(neighbour)
+                if areas[neighbour] < minarea:
+                    heapq.heappush(heap, (areas[neighbour], neighbour))
+    return numpy.array(keep, dtype=bool)
+
+def _TriangleAreas(firsts, middles, lasts):
+    "the area of each triangle formed by a middle point and its two neighbours"
+    return numpy.abs((middles[:,0]-firsts[:,0])*(lasts[:,1]-firsts[:,1]) - (lasts[:,0]-firsts[:,0])*(middles[:,1]-firsts[:,1])) / 2.0
@@ -0,0 +1,118 @@
+#IMPORTS
+import sys, os, struct, warnings, tempfile
+import lazyimport
+numpy = lazyimport.LazyModule("numpy", globals())
+
+#GLOBALS
+#sidecar file layout: a fixed header followed by the record ids in packed order and the boxes of each tree level
+MAGIC = b"GVX1"
+HEADERFORMAT = "<4sqdiii"
+HEADERSIZE = struct.calcsize(HEADERFORMAT)
+NODESIZE = 16
+
+
+#FUNCTIONS
+def Build(boxes, nodesize=NODESIZE):
+    """
+Builds and returns a packed R-tree from a sequence of (xmin,ymin,xmax,ymax) boxes, one per record, using Sort-Tile-Recursive packing so that neighbouring records end up in the same tree nodes. Records with a NaN box never match any search. Requires numpy.
+"""
+    boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+    count = len(boxes)
+    #sort into vertical slices by x center, then each slice by y center
+    centers = (boxes[:,:2] + boxes[:,2:]) / 2.0
+    slicesize = nodesize * max(1, int(numpy.ceil(numpy.sqrt(count / float(nodesize)))))
+    ids = numpy.argsort(centers[:,0], kind="mergesort")
+    for start in xrange(0, count, slicesize):
+        sliceids = ids[start:start+slicesize]
+        ids[start:start+slicesize] = sliceids[numpy.argsort(centers[sliceids,1], kind="mergesort")]
+    #then group consecutive boxes into parent nodes until only one level of nodes is left
+    levels = [boxes[ids]]
+    while len(levels[-1]) > nodesize:
+        levels.append(_ParentBoxes(levels[-1], nodesize))
+    return SpatialIndex(ids.astype(numpy.int32), levels, nodesize)
+
+def Load(indexpath, sourcepath):
+    """
+Loads a spatial index from its sidecar file, but only if it was built from the current version of the source file, judging by its size and modification time. Returns None if the index file is missing, outdated or unreadable.
+"""
+    try:
+        with open(indexpath, "rb") as reader:
+            header = reader.read(HEADERSIZE)
+            magic, sourcesize, sourcemtime, count, nodesize, nrlevels = struct.unpack(HEADERFORMAT, header)
+            if magic != MAGIC or (sourcesize, sourcemtime) != _FileStamp(sourcepath):
+                return None
+            levelcounts = numpy.fromfile(reader, dtype="<i4", count=nrlevels)
+            ids = numpy.fromfile(reader, dtype="<i4", count=count)
+            levels = [numpy.fromfile(reader, dtype="<f8", count=levelcount*4).reshape(-1, 4) for levelcount in levelcounts]
+    except (EnvironmentError, struct.error, ValueError):
+        return None
+    if len(ids) != count or any(len(level) != levelcount for level,levelcount in zip(levels,levelcounts)):
+        return None
+    return SpatialIndex(ids, levels, nodesize)
+
+
+#CLASSES
+class SpatialIndex:
+    """
+A packed R-tree over the bounding boxes of all the records in a file, for quickly finding the records that fall within a given area.
+Level 0 holds the record boxes in packed order, and each node in a higher level covers the next nodesize entries of the level below.
+"""
+    def __init__(self, ids, levels, nodesize):
+        self.ids = ids
+        self.levels = levels
+        self.nodesize = nodesize
+    def __len__(self):
+        return len(self.ids)
+    def Intersects(self, xmin, ymin, xmax, ymax):
+        """
+Returns a sorted numpy array of the ids of all records whose box intersects the given box.
+"""
+        candidates = numpy.arange(len(self.levels[-1]))
+        for depth in xrange(len(self.levels)-1, -1, -1):
+            boxes = self.levels[depth][candidates]
+            hits = (boxes[:,0] <= xmax) & (boxes[:,2] >= xmin) & (boxes[:,1] <= ymax) & (boxes[:,3] >= ymin)
+            candidates = candidates[hits]
+            if depth > 0:
+                #descend into the children of the nodes that were hit
+                children = (candidates[:,None] * self.nodesize + numpy.arange(self.nodesize)).ravel()
+                candidates = children[children < len(self.levels[depth-1])]
+        return numpy.sort(self.ids[candidates])
+    def Save(self, indexpath, sourcepath):
+        """
+Writes the index to a sidecar file, stamped with the size and modification time of the source file it was built from.
+"""
+        sourcesize, sourcemtime = _FileStamp(sourcepath)
+        header = struct.pack(HEADERFORMAT, MAGIC, sourcesize, sourcemtime, len(self.ids), self.nodesize, len(self.levels))
+        #write to a temporary file first so other processes never see a half-written index
+        filehandle, temppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(indexpath)))
+        try:
+            with os.fdopen(filehandle, "wb") as writer:
+                writer.write(header)
+                numpy.array([len(level) for level in self.levels], dtype="<i4").tofile(writer)
+                self.ids.astype("<i4").tofile(writer)
+                for level in self.levels:
+                    level.astype("<f8").tofile(writer)
+            if os.path.exists(indexpath):
+                os.remove(indexpath)
+            os.rename(temppath, indexpath)
+        except EnvironmentError:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+
+
+#INTERNAL USE ONLY
+def _ParentBoxes(boxes, nodesize):
+    "the combined box of every group of nodesize consecutive boxes, ignoring NaN boxes"
+    padding = -len(boxes) % nodesize
+    padded = numpy.vstack([boxes, numpy.tile(numpy.nan, (padding, 4))]).reshape(-1, nodesize, 4)
+    with warnings.catch_warnings():
+        #groups of only NaN boxes just stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mins = numpy.nanmin(padded[:,:,:2], axis=1)
+        maxs = numpy.nanmax(padded[:,:,2:], axis=1)
+    return numpy.hstack([mins, maxs])
+
+def _FileStamp(filepath):
+    stat = os.stat(filepath)
+    return (stat.st_size, stat.st_mtime)
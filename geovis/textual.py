@@ -1,5 +1,5 @@
 # Import main modules
-import decimal
+#(decimal is only imported by encode, since it is slow to import)
 
 def txt(obj, encoding="utf-8"):
     if isinstance(obj, basestring):
@@ -19,6 +19,7 @@ def encode(obj, encoding="utf-8", strlen=150, floatlen=16, floatprec=6):
     try:
         #encode as decimal nr
         float(obj)
+        import decimal
         decimal.getcontext().prec = floatprec
         obj = str(decimal.Decimal(str(obj))) [:floatlen]
     except:
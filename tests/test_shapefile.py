@@ -0,0 +1,182 @@
+import sys, os, struct, shutil, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geovis
+from geovis import shapefile_fork as pyshp
+
+def WriteGrid(filepath, cellsize, nrcells):
+    "writes a shapefile with a square grid of polygons, every 5th of them 20 times bigger than the rest, with a blank POP value in every 17th record"
+    writer = pyshp.Writer(pyshp.POLYGON)
+    writer.field("POP", "N", 10, 0)
+    for row in xrange(nrcells):
+        for col in xrange(nrcells):
+            recordid = row*nrcells + col
+            x, y = col*cellsize*2, row*cellsize*2
+            size = cellsize*20 if recordid % 5 == 0 else cellsize
+            writer.poly(parts=[[[x,y],[x,y+size],[x+size,y+size],[x+size,y],[x,y]]])
+            writer.record("" if recordid % 17 == 0 else recordid % 50)
+    writer.save(filepath)
+
+class CullModeTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, "grid.shp")
+        #most cells are far smaller than a pixel, with several of them in each pixel
+        WriteGrid(self.filepath, 0.01, 30)
+        self.extent = (0, 0, 1.2, 1.2)
+        self.pixelsize = 0.1
+        geovis.SHOWPROGRESS = False
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        geovis.SetRenderingOptions(numpyspeed=geovis.lazyimport.IsInstalled("numpy"))
+    def IdsInView(self, cullmode, order=None):
+        shapefile = geovis.Shapefile(self.filepath)
+        return [shape.id for shape in shapefile._IterInView(self.extent, self.pixelsize, 1, cullmode, order)]
+    def test_pixel_is_superset_of_skip(self):
+        for numpyspeed in (True, False):
+            if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+                continue
+            geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+            for order in (None, range(900)[::-1]):
+                pixelids = self.IdsInView("pixel", order)
+                skipids = self.IdsInView("skip", order)
+                self.assertTrue(skipids)
+                self.assertTrue(set(pixelids) > set(skipids))
+                if order is not None:
+                    #the ids come in the given order
+                    self.assertEqual(pixelids, sorted(pixelids, reverse=True))
+    def test_unknown_cullmode(self):
+        self.assertRaises(ValueError, geovis.Layer, self.filepath, cullsize=1, cullmode="pixels")
+
+class ClassifyTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, "grid.shp")
+        WriteGrid(self.filepath, 0.01, 30)
+        geovis.SHOWPROGRESS = False
+        geovis.SetRenderingOptions(renderer="PIL")
+        geovis.SetMapDimensions(120, 120)
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        geovis.SetRenderingOptions(numpyspeed=geovis.lazyimport.IsInstalled("numpy"))
+        geovis.SetMapZoom([-180,180], [-90,90])
+    def Classify(self, classifytype):
+        layer = geovis.Layer(self.filepath)
+        layer.AddClassification("fillsize", "POP", symbolrange=[1,5], classifytype=classifytype, nrclasses=5)
+        geovis.NewMap().AddToMap(layer)
+        return dict((uniqid, layer.classifier.GetSymbol(uniqid, "fillsize")) for uniqid in xrange(900))
+    def test_blank_numbers_count_as_0(self):
+        #whole view and zoomed in, where the rows come from reading the shapes without numpyspeed
+        for zoom in ((-180,180,-90,90), (0,0.6,0,0.6)):
+            geovis.SetMapZoom(zoom[:2], zoom[2:])
+            for classifytype in ("natural breaks", "quantiles", "approximate quantiles"):
+                symbols = []
+                for numpyspeed in (True, False):
+                    if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+                        continue
+                    geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+                    symbols.append(self.Classify(classifytype))
+                #the blank values are 0, the lowest value, so they are in the first class
+                self.assertEqual(symbols[-1][0], 1)
+                self.assertEqual(symbols[0], symbols[-1])
+    def test_deleted_records_are_not_classified(self):
+        #mark every 3rd record as deleted in the dbf
+        with open(os.path.join(self.folder, "grid.dbf"), "r+b") as dbf:
+            dbf.seek(8)
+            headerlength, recordlength = struct.unpack("<HH", dbf.read(4))
+            for recordid in xrange(0, 900, 3):
+                dbf.seek(headerlength + recordid*recordlength)
+                dbf.write(b"*")
+        for classifytype in ("natural breaks", "equal interval", "quantiles", "approximate quantiles"):
+            symbols = []
+            for numpyspeed in (True, False):
+                if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+                    continue
+                geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+                symbols.append(self.Classify(classifytype))
+            self.assertFalse(any(symbols[-1][recordid] for recordid in xrange(0, 900, 3)))
+            self.assertEqual(symbols[0], symbols[-1])
+    def test_failed_classification_keeps_fields(self):
+        #a number that cannot be decoded makes the rows fail when read without numpy
+        filepath = os.path.join(self.folder, "broken.shp")
+        writer = pyshp.Writer(pyshp.POINT)
+        writer.field("NAME", "C", 10, 0)
+        writer.field("POP", "N", 10, 0)
+        for i,pop in enumerate([1, 2, "x"]):
+            writer.point(i, i)
+            writer.record("a", pop)
+        writer.save(filepath)
+        geovis.SetRenderingOptions(numpyspeed=False)
+        layer = geovis.Layer(filepath)
+        layer.fileobj.SetFields(["NAME"])
+        layer.AddClassification("fillsize", "POP", symbolrange=[1,5], classifytype="natural breaks", nrclasses=2)
+        self.assertRaises(ValueError, geovis.NewMap().AddToMap, layer)
+        #the layer still reads the fields it was set to
+        self.assertEqual(layer.fileobj.projection, ["NAME"])
+    def test_approximate_quantiles_are_streamed(self):
+        for numpyspeed in (True, False):
+            if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+                continue
+            geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+            layer = geovis.Layer(self.filepath)
+            layer.AddClassification("fillsize", "POP", symbolrange=[1,5], classifytype="approximate quantiles", nrclasses=5)
+            layer.AddClassification("fillcolor", "POP", symbolrange=["#ffffff","#ff0000"], classifytype="quantiles", nrclasses=5)
+            geovis.NewMap().AddToMap(layer)
+            classifier = layer.classifier
+            #only the exact quantiles keep their values, and both give all the features a class
+            self.assertEqual(classifier.values.keys(), ["fillcolor"])
+            self.assertEqual(classifier.GetIds(), range(900))
+            self.assertTrue(all(classifier.GetSymbol(uniqid, "fillsize") for uniqid in xrange(900)))
+
+class QueryTest(unittest.TestCase):
+    QUERIES = ['NAME == ""', 'NAME != ""', 'not NAME', 'NAME == "b"', 'NAME in ("a","b")', 'NAME not in ("a",)', 'NAME < "b"',
+               'POP == 0', 'POP > 2', 'POP * 2 + 1 >= 5', '-POP < -1', 'not POP', 'NAME == "a" or POP >= 3', 'NAME and POP == 0',
+               'RATIO == 0', 'RATIO > 0.5', 'DATE == ""', 'DATE == [2000, 1, 31]', 'FLAG == "T"', 'FLAG == "F"', 'FLAG == "?"',
+               'len(NAME) == 1', 'str(POP).startswith("1")', 'True', 'POP == 1 and FLAG == "T"']
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.folder, "points.shp")
+        writer = pyshp.Writer(pyshp.POINT)
+        writer.field("NAME", "C", 10, 0)
+        writer.field("POP", "N", 10, 0)
+        writer.field("RATIO", "F", 10, 2)
+        writer.field("DATE", "D", 8, 0)
+        writer.field("FLAG", "L", 1, 0)
+        #every field is blank in some of the records
+        rows = [("a", 1, 0.25, "20000131", "T"),
+                ("", 2, 0.75, "", "F"),
+                ("b", "", "", "19991231", " "),
+                ("", "", "", "", " "),
+                ("c", 3, 1.5, "20000131", "T")]
+        for i,row in enumerate(rows):
+            writer.point(i, i)
+            writer.record(*row)
+        writer.save(self.filepath)
+        geovis.SHOWPROGRESS = False
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        geovis.SetRenderingOptions(numpyspeed=geovis.lazyimport.IsInstalled("numpy"))
+    def Select(self, query):
+        shapefile = geovis.Shapefile(self.filepath)
+        shapefile.SelectByQuery(query)
+        return list(shapefile.selection)
+    def test_column_and_row_queries_agree(self):
+        for query in self.QUERIES:
+            selections = []
+            for numpyspeed in (True, False):
+                if numpyspeed and not geovis.lazyimport.IsInstalled("numpy"):
+                    continue
+                geovis.SetRenderingOptions(numpyspeed=numpyspeed)
+                #referring to the shape makes the query run one feature at a time
+                selections.append(self.Select(query))
+                selections.append(self.Select("shape is not None and (%s)" % query))
+            for selection in selections[1:]:
+                self.assertEqual(selection, selections[0], query)
+    def test_blank_values(self):
+        self.assertEqual(self.Select('NAME == ""'), [1,3])
+        self.assertEqual(self.Select('POP == 0'), [2,3])
+        self.assertEqual(self.Select('DATE == ""'), [1,3])
+        self.assertEqual(self.Select('FLAG == "?"'), [2,3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import sys, os, time, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geovis
+from geovis import simplification
+
+class VisvalingamTest(unittest.TestCase):
+    def setUp(self):
+        if not geovis.lazyimport.IsInstalled("numpy"):
+            self.skipTest("requires numpy")
+        import numpy
+        self.numpy = numpy
+    def Arc(self, nrpoints):
+        "a half circle whose points get further apart along it, so the triangle areas grow steadily and each round only finds one smallest triangle"
+        numpy = self.numpy
+        angles = numpy.linspace(0, 1, nrpoints)**2 * numpy.pi
+        return numpy.column_stack((numpy.cos(angles)*1000, numpy.sin(angles)*1000))
+    def test_arc_of_100k_points(self):
+        coords = self.Arc(100000)
+        tolerance = 0.5
+        started = time.time()
+        keep = simplification.VisvalingamWhyatt(coords, tolerance)
+        #leaving out one point per round over the whole line would take minutes
+        self.assertTrue(time.time() - started < 20)
+        self.assertTrue(keep[0] and keep[-1])
+        self.assertTrue(2 < keep.sum() < 1000)
+        #none of the triangles that are left are too small
+        kept = coords[keep]
+        self.assertTrue(simplification._TriangleAreas(kept[:-2], kept[1:-1], kept[2:]).min() >= tolerance**2)
+
+
+if __name__ == "__main__":
+    unittest.main()